@@ -1,94 +1,180 @@
-import csv
 import os
-import re
-import unicodedata
+import json
+import math
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime
 
 from bs4 import BeautifulSoup
-from flask import Flask, render_template, request, jsonify, session
+from flask import Flask, Response, g, render_template, request, jsonify, session
 from flask.cli import load_dotenv
-from requests import get
 from urllib.parse import urlparse, parse_qs, unquote
 
+from cache import StaleWhileRevalidate, make_cache, quantize_origin, travel_time_ttl
+import metrics
+from http_client import get
+from metrics import register_collector, span
+from result_store import make_result_store
+from singleflight import make_singleflight
+
 # Import the wait time predictor
 import sys
 sys.path.insert(0, os.path.join(os.path.dirname(__file__), 'data'))
-from data.ae_wait_predictor import run_all
+from data.ae_catalogue import AE_CATALOGUE_PATH
+from data.geocode_store import geocode_store
+from data.spatial_scan import haversine_distance
+from data.stores import VETS_GEOCODED_PATH, VETS_PATH, AECatalogueStore, TravelGridStore, VetStore, hospital_store
+from data.travel_grid import TRAVEL_GRID_PATH
+from data.wait_predictions import predict_waits, to_columnar, week_hour
 
 app = Flask(__name__)
 load_dotenv()
 GOOGLE_API_KEY = os.getenv("GOOGLE_API_KEY")
 app.secret_key = os.getenv("SECRET_KEY", "dev-secret-key-change-in-production")
 
-def normalize_hospital_name(name):
-    """
-    Normalize hospital name for fuzzy matching:
-    - Convert to lowercase
-    - Remove non-ASCII characters
-    - Sort words alphabetically
-    - Remove common words that don't help matching
-    """
-    if not name:
-        return ""
-    
-    # Convert to lowercase
-    name = name.lower()
-    
-    # Remove non-ASCII characters
-    name = unicodedata.normalize('NFKD', name)
-    name = name.encode('ascii', 'ignore').decode('ascii')
-    
-    # Remove punctuation and extra whitespace
-    name = re.sub(r'[^\w\s]', ' ', name)
-    name = re.sub(r'\s+', ' ', name).strip()
-    
-    # Split into words and sort
-    words = name.split()
-    
-    # Remove common words that don't help with matching
-    common_words = {'the', 'a', 'an', 'and', 'or', 'of', 'at', 'in', 'for', 'to'}
-    words = [w for w in words if w not in common_words]
-    
-    # Sort words to ignore order
-    words.sort()
-    
-    return ' '.join(words)
+# Parse hospital_data.csv once at startup; the store reloads it if the file changes
+hospital_store.get()
 
-def find_hospital_in_data(hospital_name, hospital_df):
-    """
-    Find a hospital in the dataframe using fuzzy name matching.
-    Returns the matched hospital name from the dataframe or None.
-    """
-    normalized_input = normalize_hospital_name(hospital_name)
-    
-    # Try exact normalized match first
-    for idx, row in hospital_df.iterrows():
-        normalized_row_name = normalize_hospital_name(row['hospital_name'])
-        if normalized_row_name == normalized_input:
-            return row['hospital_name']
-    
-    # Try partial match - check if all words from input appear in hospital name
-    input_words = set(normalized_input.split())
-    best_match = None
-    best_score = 0
-    
-    for idx, row in hospital_df.iterrows():
-        normalized_row_name = normalize_hospital_name(row['hospital_name'])
-        row_words = set(normalized_row_name.split())
-        
-        # Calculate how many input words are in the row
-        matching_words = input_words.intersection(row_words)
-        if len(matching_words) > 0:
-            score = len(matching_words) / len(input_words)
-            if score > best_score:
-                best_score = score
-                best_match = row['hospital_name']
-    
-    # Only return match if at least 50% of words matched
-    if best_score >= 0.5:
-        return best_match
-    
-    return None
+# Seed the shared geocode store with the pre-geocoded vets
+if os.path.exists(VETS_GEOCODED_PATH):
+    try:
+        geocode_store.warm_from_csv(VETS_GEOCODED_PATH)
+    except Exception as e:
+        print(f"Error warming geocode store: {e}")
+
+# Vets are kept in memory behind a nearest-neighbour scan (data/spatial_scan.py,
+# a linear numpy scan, not a tree), rebuilt when the CSV changes.
+# Use the geocoded file if it exists, otherwise the plain list.
+vet_store = VetStore(
+    VETS_GEOCODED_PATH if os.path.exists(VETS_GEOCODED_PATH) else VETS_PATH,
+    geocodes=geocode_store,
+)
+
+# Outbound travel-time lookups run concurrently on a bounded pool, and each
+# search waits at most TRAVEL_TIME_DEADLINE seconds for them
+TRAVEL_TIME_WORKERS = int(os.getenv("TRAVEL_TIME_WORKERS", "16"))
+TRAVEL_TIME_DEADLINE = float(os.getenv("TRAVEL_TIME_DEADLINE", "5"))
+travel_time_pool = ThreadPoolExecutor(max_workers=TRAVEL_TIME_WORKERS, thread_name_prefix="travel-time")
+
+# "matrix" ranks all candidates with one Distance Matrix request; "directions"
+# makes one Directions request per candidate
+TRAVEL_TIME_BACKEND = os.getenv("TRAVEL_TIME_BACKEND", "matrix")
+
+# Streaming searches rank candidates on straight-line distance until real
+# travel times arrive: road distance ~ ESTIMATE_ROAD_FACTOR x straight line,
+# driven at ESTIMATE_SPEED_KMH
+ESTIMATE_SPEED_KMH = float(os.getenv("ESTIMATE_SPEED_KMH", "30"))
+ESTIMATE_ROAD_FACTOR = float(os.getenv("ESTIMATE_ROAD_FACTOR", "1.3"))
+
+# Distance Matrix limits: 25 destinations and 100 elements per request
+DISTANCE_MATRIX_MAX_DESTINATIONS = 25
+DISTANCE_MATRIX_MAX_ELEMENTS = 100
+
+# NHS search results are cached per location cell. The "open now" filter
+# means they go stale quickly: after NHS_FRESH_TTL seconds they are served
+# while being refreshed in the background, and after NHS_STALE_TTL they are
+# refetched. If nhs.uk is slow or down the last good result is served.
+# Concurrent fetches for one cell are coalesced into a single scrape.
+NHS_TIMEOUT = float(os.getenv("NHS_TIMEOUT", "8"))
+NHS_CACHE_CELL = os.getenv("NHS_CACHE_CELL", "500")
+background_pool = ThreadPoolExecutor(max_workers=2, thread_name_prefix="background")
+nhs_results_cache = StaleWhileRevalidate(
+    lambda latitude, longitude: fetch_all_hospitals(latitude, longitude),
+    fresh_ttl=float(os.getenv("NHS_FRESH_TTL", "120")),
+    stale_ttl=float(os.getenv("NHS_STALE_TTL", "900")),
+    executor=background_pool,
+    singleflight=make_singleflight('nhs'),
+)
+
+# Candidate A&Es come from the NHS search, or from the local geocoded
+# catalogue (data/ae_catalogue.csv) once it has been built and checked, with
+# the NHS scrape only refreshing "open now" status in the background.
+# AE_CANDIDATE_SOURCE is "nhs", "catalogue" or "auto" (catalogue if built).
+AE_CANDIDATE_SOURCE = os.getenv("AE_CANDIDATE_SOURCE", "nhs")
+AE_CANDIDATES = int(os.getenv("AE_CANDIDATES", "5"))
+NHS_OPEN_CHECK = os.getenv("NHS_OPEN_CHECK", "1") == "1"
+ae_catalogue_store = AECatalogueStore(AE_CATALOGUE_PATH)
+
+# Travel times are cached per (origin grid cell, destination). Use the sqlite
+# backend to share the cache between worker processes on one machine.
+TRAVEL_CACHE_CELL = os.getenv("TRAVEL_CACHE_CELL", "200")  # metres, or "geohash:<precision>"
+travel_cache = make_cache(
+    os.getenv("TRAVEL_CACHE_BACKEND", "memory"),
+    maxsize=int(os.getenv("TRAVEL_CACHE_SIZE", "10000")),
+    path=os.getenv("TRAVEL_CACHE_PATH"),
+)
+# Identical routing requests from one origin cell that are in flight at the
+# same time are made once and shared
+travel_flight = make_singleflight('travel')
+
+# Travel times to catalogue A&Es are read from the precomputed grid
+# (data/travel_grid.bin) when it has a fresh entry for the origin's cell;
+# anything it doesn't cover is routed live
+TRAVEL_GRID = os.getenv("TRAVEL_GRID", "1") == "1"
+TRAVEL_GRID_MAX_AGE = float(os.getenv("TRAVEL_GRID_MAX_AGE", str(30 * 24 * 60 * 60)))
+travel_grid_store = TravelGridStore(TRAVEL_GRID_PATH)
+travel_grid_lookups = metrics.Counter(
+    'travel_grid_lookups_total', 'Places looked up in the precomputed travel-time grid', ['outcome'])
+
+# Search results live server-side; the session cookie only carries their id.
+# The sqlite backend lets any worker process serve the follow-up requests
+# (/api/get-destination etc.); memory only works with a single worker.
+result_store = make_result_store(
+    os.getenv("RESULT_STORE_BACKEND", "sqlite"),
+    ttl=float(os.getenv("RESULT_TTL", str(2 * 60 * 60))),
+    path=os.getenv("RESULT_STORE_PATH"),
+)
+
+def save_search_result(hospitals, latitude, longitude, service_type):
+    """Store a ranked list server-side and point the session at it"""
+    with span('save_result'):
+        session['result_id'] = result_store.create({
+            'hospitals': hospitals,
+            'user_location': {'latitude': latitude, 'longitude': longitude},
+        })
+    session['service_type'] = service_type
+
+def current_search_result():
+    """The session's stored search result, or an empty one"""
+    with span('load_result'):
+        return result_store.get(session.get('result_id')) or {}
+
+@app.before_request
+def start_request_metrics():
+    g.request_started = time.perf_counter()
+    g.request_timings_token = metrics.start_request()
+
+@app.after_request
+def finish_request_metrics(response):
+    token = g.pop('request_timings_token', None)
+    if token is None:
+        return response
+    timings = metrics.end_request(token)
+    endpoint = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+    metrics.request_duration.observe(
+        time.perf_counter() - g.request_started,
+        endpoint=endpoint, method=request.method, status=response.status_code,
+    )
+    if metrics.SERVER_TIMING and timings:
+        response.headers['Server-Timing'] = metrics.server_timing_header(timings)
+    return response
+
+@register_collector
+def collect_cache_stats():
+    """Hit/miss counts the caches keep themselves, read at scrape time"""
+    samples = []
+    for name, cache in (('travel_time', travel_cache), ('nhs_results', nhs_results_cache),
+                        ('search_results', result_store)):
+        stats = cache.stats()
+        for result in ('hits', 'stale_hits', 'misses', 'fallbacks'):
+            if result in stats:
+                samples.append(({'cache': name, 'result': result}, stats[result]))
+    return [('cache_requests_total', 'counter', 'Cache lookups by cache and result', samples)]
+
+@app.route('/metrics')
+def metrics_endpoint():
+    """Prometheus scrape endpoint"""
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
 
 @app.route('/')
 def home():
@@ -117,10 +203,16 @@ def get_location():
         })
     return jsonify({'status': 'error', 'message': 'Location not provided'}), 400
 
-def get_all_hospitals(latitude, longitude):
-    html = get(
-        f"https://www.nhs.uk/service-search/find-an-accident-and-emergency-service/results/your%20location?latitude={latitude}&longitude={longitude}&SelectedFilter=AAndEOpenNow").text
+NHS_SEARCH_URL = "https://www.nhs.uk/service-search/find-an-accident-and-emergency-service/results/your%20location?latitude={latitude}&longitude={longitude}&SelectedFilter=AAndEOpenNow"
+DIRECTIONS_URL = "https://maps.googleapis.com/maps/api/directions/json"
+DISTANCE_MATRIX_URL = "https://maps.googleapis.com/maps/api/distancematrix/json"
+
+def fetch_nhs_results_page(latitude, longitude):
+    r = get(NHS_SEARCH_URL.format(latitude=latitude, longitude=longitude), timeout=NHS_TIMEOUT)
+    r.raise_for_status()
+    return r.text
 
+def parse_nhs_results(html):
     soup = BeautifulSoup(html, "html.parser")
 
     results = []
@@ -146,52 +238,95 @@ def get_all_hospitals(latitude, longitude):
 
     return results
 
+def fetch_all_hospitals(latitude, longitude):
+    """Scrape and parse the NHS A&E search for a location (uncached)"""
+    with span('nhs_fetch'):
+        html = fetch_nhs_results_page(latitude, longitude)
+    with span('nhs_parse'):
+        return parse_nhs_results(html)
+
+def get_all_hospitals(latitude, longitude):
+    """NHS A&E search results, cached per location cell"""
+    cell = quantize_origin(latitude, longitude, NHS_CACHE_CELL)
+    # Callers annotate the dicts, so hand out copies of the cached list
+    return [dict(h) for h in nhs_results_cache.get(cell, latitude, longitude)]
+
+def use_ae_catalogue():
+    if AE_CANDIDATE_SOURCE == 'nhs':
+        return False
+    if AE_CANDIDATE_SOURCE == 'catalogue':
+        return True
+    return ae_catalogue_store.available()
+
+def annotate_open_status(latitude, longitude, candidates):
+    """
+    Set 'open_now' on catalogue candidates from whatever NHS "open now" result
+    is already cached for this area. The NHS scrape itself only runs in the
+    background, so it never delays the request.
+
+    The NHS page only lists the nearest few open A&Es and names are matched
+    fuzzily, so a site missing from it is not necessarily closed: it is only
+    marked closed (False) when it is nearer than a candidate the page does
+    list. Otherwise it stays unknown (None) and is ranked normally.
+    """
+    cell = quantize_origin(latitude, longitude, NHS_CACHE_CELL)
+    nhs_results_cache.prefetch(cell, latitude, longitude)
+    nhs_hospitals = nhs_results_cache.peek(cell, max_age=nhs_results_cache.stale_ttl)
+    if nhs_hospitals is None:
+        return candidates
+
+    # Compare canonical dataset names, since the dataset has aliases for some sites
+    matcher = hospital_store.matcher()
+    open_names = {matcher.match(h['hospital']) for h in nhs_hospitals}
+    open_names.discard(None)
+    listed = [c for c in candidates if matcher.match(c['dataset_name']) in open_names]
+
+    # How far out the NHS list demonstrably reaches
+    reach = max((c['straight_line_distance'] for c in listed), default=None)
+    for candidate in candidates:
+        if any(candidate is c for c in listed):
+            candidate['open_now'] = True
+        elif reach is not None and candidate['straight_line_distance'] < reach:
+            candidate['open_now'] = False
+        else:
+            candidate['open_now'] = None
+    return candidates
+
+def get_candidate_hospitals(latitude, longitude, count=None):
+    """Nearest A&Es to rank: from the local catalogue, or the NHS search"""
+    if count is None:
+        count = AE_CANDIDATES
+
+    if use_ae_catalogue():
+        try:
+            with span('ae_catalogue'):
+                candidates = ae_catalogue_store.get().nearest(latitude, longitude, count)
+            if NHS_OPEN_CHECK:
+                annotate_open_status(latitude, longitude, candidates)
+            return candidates
+        except Exception as e:
+            print(f"Error using A&E catalogue, falling back to NHS search: {e}")
+
+    with span('nhs_search'):
+        return get_all_hospitals(latitude, longitude)[:count]
+
 def get_all_vets():
-    """Load all vets from the geocoded CSV file"""
-    vets = []
-    # Try geocoded file first, fall back to regular file
-    geocoded_path = os.path.join(os.path.dirname(__file__), 'data', 'vets_data_geocoded.csv')
-    csv_path = os.path.join(os.path.dirname(__file__), 'data', 'vets_data.csv')
-    
-    # Use geocoded file if it exists
-    file_to_use = geocoded_path if os.path.exists(geocoded_path) else csv_path
-    has_coords = os.path.exists(geocoded_path)
-    
+    """All vets from the resident vet store (with pre-computed coordinates if available)"""
     try:
-        with open(file_to_use, 'r', encoding='utf-8') as f:
-            reader = csv.DictReader(f)
-            for row in reader:
-                vet_data = {
-                    'hospital': row['Hospital Name'],
-                    'address': row['Address']
-                }
-                # Add coordinates if available
-                if has_coords and row.get('Latitude') and row.get('Longitude'):
-                    try:
-                        vet_data['lat'] = float(row['Latitude'])
-                        vet_data['lng'] = float(row['Longitude'])
-                    except (ValueError, KeyError):
-                        pass
-                vets.append(vet_data)
+        return [dict(vet) for vet in vet_store.get().vets]
     except Exception as e:
         print(f"Error loading vets data: {e}")
-    
-    return vets
-
-def travel_time(latitude, longitude, hospital):
-    url = "https://maps.googleapis.com/maps/api/directions/json"
+        return []
 
-    params = {
+def directions_params(latitude, longitude, destination):
+    return {
         "origin": f"{latitude},{longitude}",
-        "destination": hospital,
+        "destination": destination,
         "mode": "driving",
         "key": GOOGLE_API_KEY
     }
 
-    r = get(url, params=params)
-    r.raise_for_status()
-    data = r.json()
-
+def parse_directions(data):
     if data["status"] != "OK":
         raise RuntimeError(data["status"])
 
@@ -202,6 +337,222 @@ def travel_time(latitude, longitude, hospital):
         "distance": leg["distance"]["value"]  # in metres
     }
 
+def get_json(url, params):
+    r = get(url, params=params)
+    r.raise_for_status()
+    return r.json()
+
+def travel_flight_key(kind, latitude, longitude, destinations):
+    """Single-flight key for a routing request: origin cell plus destinations"""
+    origin_cell = quantize_origin(latitude, longitude, TRAVEL_CACHE_CELL)
+    return f"{kind}:{origin_cell}:" + "|".join(' '.join(d.lower().split()) for d in destinations)
+
+def travel_time(latitude, longitude, hospital):
+    data = travel_flight.do(
+        travel_flight_key('directions', latitude, longitude, [hospital]),
+        get_json, DIRECTIONS_URL, directions_params(latitude, longitude, hospital),
+    )
+    return parse_directions(data)
+
+def destination_chunks(destinations):
+    """Split destinations to fit the Distance Matrix per-request limits (one origin)"""
+    chunk_size = min(DISTANCE_MATRIX_MAX_DESTINATIONS, DISTANCE_MATRIX_MAX_ELEMENTS)
+    return [destinations[i:i + chunk_size] for i in range(0, len(destinations), chunk_size)]
+
+def distance_matrix_params(latitude, longitude, destinations):
+    return {
+        "origins": f"{latitude},{longitude}",
+        # "|" separates destinations, so it can't appear inside one
+        "destinations": "|".join(d.replace("|", " ") for d in destinations),
+        "mode": "driving",
+        "key": GOOGLE_API_KEY
+    }
+
+def parse_distance_matrix(data):
+    """One dict per destination, or a RuntimeError for destinations that could not be routed"""
+    if data["status"] != "OK":
+        raise RuntimeError(data["status"])
+
+    results = []
+    for element in data["rows"][0]["elements"]:
+        if element["status"] != "OK":
+            results.append(RuntimeError(element["status"]))
+            continue
+        results.append({
+            "duration": element["duration"]["value"], # in seconds
+            "distance": element["distance"]["value"]  # in metres
+        })
+    return results
+
+def travel_times_matrix(latitude, longitude, destinations):
+    """
+    Travel times from one origin to many destinations using the Distance
+    Matrix API, split into as few requests as the API limits allow.
+    Returns a list aligned with `destinations`; entries that could not be
+    routed are RuntimeError instances instead of dicts.
+    """
+    results = []
+
+    for chunk in destination_chunks(destinations):
+        data = travel_flight.do(
+            travel_flight_key('matrix', latitude, longitude, chunk),
+            get_json, DISTANCE_MATRIX_URL, distance_matrix_params(latitude, longitude, chunk),
+        )
+        results.extend(parse_distance_matrix(data))
+
+    return results
+
+def _travel_time_jobs(latitude, longitude, places):
+    """Split places into (places, callable) jobs for the configured backend"""
+    if TRAVEL_TIME_BACKEND == "directions":
+        return [
+            ([place], lambda address=place['address']: [travel_time(latitude, longitude, address)])
+            for place in places
+        ]
+
+    # Chunks run as separate jobs so large candidate lists still finish in one round trip
+    return [
+        (chunk, lambda chunk=chunk: travel_times_matrix(latitude, longitude, [p['address'] for p in chunk]))
+        for chunk in destination_chunks(places)
+    ]
+
+def _travel_cache_key(latitude, longitude, address):
+    origin_cell = quantize_origin(latitude, longitude, TRAVEL_CACHE_CELL)
+    return f"travel:{origin_cell}:{' '.join(address.lower().split())}"
+
+def use_travel_grid(latitude, longitude, places):
+    """
+    Fill catalogue A&Es from the precomputed travel-time grid; returns the
+    places it has no fresh entry for
+    """
+    if not TRAVEL_GRID or not any(place.get('dataset_name') for place in places):
+        return places
+    if not travel_grid_store.available():
+        return places
+
+    try:
+        times = travel_grid_store.get().lookup(latitude, longitude, max_age=TRAVEL_GRID_MAX_AGE)
+    except Exception as e:
+        print(f"Error reading travel grid: {e}")
+        return places
+
+    missing = []
+    for place in places:
+        time_info = (times or {}).get(place.get('dataset_name'))
+        if time_info is None:
+            missing.append(place)
+            continue
+        place.pop('duration_estimated', None)
+        place['duration'] = time_info['duration']
+        place['distance'] = time_info['distance']
+    travel_grid_lookups.inc(len(places) - len(missing), outcome='hit')
+    travel_grid_lookups.inc(len(missing), outcome='miss')
+    return missing
+
+def use_cached_travel_times(latitude, longitude, places):
+    """Fill places from the travel-time grid and cache; returns the places still missing"""
+    uncached = []
+    for place in use_travel_grid(latitude, longitude, places):
+        cached = travel_cache.get(_travel_cache_key(latitude, longitude, place['address']))
+        if cached is not None:
+            place.pop('duration_estimated', None)
+            place['duration'] = cached['duration']
+            place['distance'] = cached['distance']
+        else:
+            uncached.append(place)
+    return uncached
+
+def apply_travel_times(latitude, longitude, places, results):
+    """
+    Copy travel-time results (dicts or exceptions, aligned with places) onto
+    the places and cache the successful ones. Failures get duration = inf.
+    """
+    for place, time_info in zip(places, results):
+        place.pop('duration_estimated', None)
+        if isinstance(time_info, Exception):
+            print(f"Error calculating travel time for {place['hospital']}: {time_info}")
+            place['duration'] = float('inf')
+            place['distance'] = 0
+        else:
+            place['duration'] = time_info['duration']
+            place['distance'] = time_info['distance']
+            travel_cache.set(
+                _travel_cache_key(latitude, longitude, place['address']),
+                {'duration': time_info['duration'], 'distance': time_info['distance']},
+                travel_time_ttl(),
+            )
+
+def iter_travel_times(latitude, longitude, places, deadline=None):
+    """
+    Fill in 'duration' and 'distance' for each place like add_travel_times,
+    yielding after each batch of results lands so callers can re-rank as
+    they arrive (and after the cache lookups, if the cache had any).
+    """
+    if deadline is None:
+        deadline = TRAVEL_TIME_DEADLINE
+
+    uncached = use_cached_travel_times(latitude, longitude, places)
+    if len(uncached) < len(places):
+        yield places
+
+    futures = {
+        travel_time_pool.submit(job): job_places
+        for job_places, job in _travel_time_jobs(latitude, longitude, uncached)
+    }
+    pending = set(futures)
+
+    try:
+        for future in as_completed(futures, timeout=deadline):
+            pending.discard(future)
+            try:
+                results = future.result()
+            except Exception as e:
+                results = [e] * len(futures[future])
+            apply_travel_times(latitude, longitude, futures[future], results)
+            yield places
+    except TimeoutError:
+        for future in pending:
+            future.cancel()
+            job_places = futures[future]
+            apply_travel_times(latitude, longitude, job_places,
+                               [TimeoutError(f"no response within {deadline}s")] * len(job_places))
+        yield places
+
+def add_travel_times(latitude, longitude, places, deadline=None):
+    """
+    Fill in 'duration' and 'distance' for each place, serving what it can
+    from the travel cache and issuing the remaining outbound calls
+    concurrently. Places whose lookup fails or misses the deadline get
+    duration = inf so they sort last.
+    """
+    for _ in iter_travel_times(latitude, longitude, places, deadline):
+        pass
+    return places
+
+def estimate_travel_times(latitude, longitude, places):
+    """
+    Provisional 'duration' from straight-line distance (flagged with
+    'duration_estimated') until the real travel time arrives. Places without coordinates (and none stored in the
+    geocode store) get duration = inf.
+    """
+    for place in places:
+        if place.get('lat') is None or place.get('lng') is None:
+            stored = geocode_store.lookup(place['address'])
+            if stored is not None and stored[0] is not None:
+                place['lat'], place['lng'] = stored
+        if place.get('lat') is None or place.get('lng') is None:
+            place['duration'] = float('inf')
+            place['distance'] = 0
+            continue
+
+        km = place.get('straight_line_distance')
+        if km is None:
+            km = haversine_distance(latitude, longitude, place['lat'], place['lng'])
+        place['duration'] = km * ESTIMATE_ROAD_FACTOR / ESTIMATE_SPEED_KMH * 3600
+        place['distance'] = km * ESTIMATE_ROAD_FACTOR * 1000
+        place['duration_estimated'] = True
+    return places
+
 def waiting_time(hospital):
     pass
 
@@ -211,14 +562,8 @@ def get_predicted_wait_time(hospital_name):
     Returns wait time in minutes or None if prediction fails.
     """
     try:
-        import pandas as pd
-        
-        # Load hospital data
-        csv_path = os.path.join(os.path.dirname(__file__), 'data', 'hospital_data.csv')
-        hospital_df = pd.read_csv(csv_path)
-        
-        # Find the hospital using fuzzy matching
-        matched_name = find_hospital_in_data(hospital_name, hospital_df)
+        # Find the hospital using the precomputed fuzzy matcher
+        matched_name = hospital_store.matcher().match(hospital_name)
         
         if not matched_name:
             print(f"Could not find hospital '{hospital_name}' in data")
@@ -226,15 +571,14 @@ def get_predicted_wait_time(hospital_name):
         
         # Get current time in hours since start of week
         # This is a simplified time counter - adjust as needed
-        now = datetime.now()
-        current_time = now.hour + (now.weekday() * 24)
+        current_time = week_hour(datetime.now())
         
-        # Call run_all with matched hospital name
-        wait_multiplier = run_all(matched_name, current_time)
+        # run_all's multiplier, looked up in the precomputed hospital x hour-of-week table
+        forecast = hospital_store.weekly_forecast()
+        wait_multiplier = forecast.predict(forecast.index[matched_name], current_time)
         
-        # Get base wait time from dataframe
-        hospital_row = hospital_df[hospital_df['hospital_name'] == matched_name].iloc[0]
-        base_wait = float(hospital_row['avg_wait_time'])
+        # Get base wait time from the store
+        base_wait = hospital_store.avg_wait(matched_name)
         
         # Calculate predicted wait time in minutes
         predicted_wait = base_wait * wait_multiplier * 60  # Convert hours to minutes
@@ -250,6 +594,107 @@ def get_predicted_wait_time(hospital_name):
 def filter_for_specialty(hospitals, specialty):
     pass
 
+def hospital_sort_key(h):
+    """
+    Sort by combined score: travel time + wait time.
+    For hospitals without wait time data, use only travel time.
+    Hospitals the NHS search reports as not open go last.
+    """
+    travel = h['duration']
+    wait = h.get('wait_time')
+    closed = h.get('open_now') is False
+    
+    # If wait time is available, combine it with travel time
+    # Convert wait time from minutes to seconds and add to travel time
+    if wait is not None:
+        return (closed, travel + (wait * 60))
+    else:
+        # If no wait time available, just use travel time
+        # Add a small penalty to prioritize hospitals with wait time data
+        return (closed, travel * 1.1)
+
+def add_wait_times(hospitals):
+    """Add predicted wait time (minutes, or None) to each hospital"""
+    for hospital in hospitals:
+        # Get predicted wait time for hospitals (catalogue sites carry their dataset name)
+        try:
+            wait_time_minutes = get_predicted_wait_time(hospital.get('dataset_name') or hospital['hospital'])
+            hospital['wait_time'] = wait_time_minutes  # in minutes, or None if prediction failed
+        except Exception as e:
+            print(f"Error getting wait time for {hospital['hospital']}: {e}")
+            hospital['wait_time'] = None
+    return hospitals
+
+def rank_hospitals(hospitals):
+    hospitals.sort(key=hospital_sort_key)
+    return hospitals
+
+def search_hospitals(latitude, longitude):
+    """Nearby A&Es ranked by travel time plus predicted wait"""
+    # Get the nearest candidate hospitals
+    hospitals = get_candidate_hospitals(latitude, longitude)
+
+    # Add travel time info to all hospitals at once
+    with span('travel_times'):
+        add_travel_times(latitude, longitude, hospitals)
+
+    # Add wait time info to each hospital
+    with span('wait_prediction'):
+        add_wait_times(hospitals)
+
+    return rank_hospitals(hospitals)
+
+def nearest_vets(latitude, longitude, count=8):
+    """The `count` vets closest in a straight line, with 'straight_line_distance'"""
+    vets = vet_store.get()
+
+    # Nearest by straight-line distance from the index
+    with span('vet_index'):
+        geocoded_vets = vets.nearest(latitude, longitude, count)
+
+    # Vets without stored coordinates are geocoded (the store only calls the API once per address)
+    with span('geocode'):
+        geocoded_vets.extend(geocode_unlocated_vets(latitude, longitude, vets.unlocated))
+    
+    # Sort by straight-line distance and take top `count`
+    geocoded_vets.sort(key=lambda v: v['straight_line_distance'])
+    return geocoded_vets[:count]
+
+def geocode_unlocated_vets(latitude, longitude, unlocated):
+    """Copies of the vets that could be geocoded, with 'straight_line_distance'"""
+    located = []
+    for vet in unlocated:
+        try:
+            lat, lng = geocode_store.geocode(vet['address'], GOOGLE_API_KEY)
+            
+            if lat is not None and lng is not None:
+                vet = dict(vet, lat=lat, lng=lng)
+                vet['straight_line_distance'] = haversine_distance(
+                    latitude, longitude, lat, lng
+                )
+                located.append(vet)
+        except Exception as e:
+            print(f"Error geocoding {vet['hospital']}: {e}")
+    return located
+
+def rank_vets(top_vets):
+    """Sort by actual travel time and take only the closest 5"""
+    top_vets.sort(key=lambda v: v['duration'])
+    return top_vets[:5]
+
+def search_vets(latitude, longitude):
+    """The 5 vets with the shortest travel time, or None if there are no vets"""
+    if not vet_store.get().vets:
+        return None
+
+    top_vets = nearest_vets(latitude, longitude)
+
+    # Now calculate accurate travel time for only the top 8, concurrently
+    with span('travel_times'):
+        add_travel_times(latitude, longitude, top_vets)
+
+    return rank_vets(top_vets)
+
 @app.route('/api/find-hospital', methods=['POST'])
 def find_hospital():
     data = request.get_json()
@@ -260,49 +705,10 @@ def find_hospital():
         return jsonify({'status': 'error', 'message': 'Location not provided'}), 400
 
     try:
-        # Get all hospitals and take first 5
-        hospitals = get_all_hospitals(latitude, longitude)[:5]
+        hospitals = search_hospitals(latitude, longitude)
 
-        # Add travel time and wait time info to each hospital
-        for hospital in hospitals:
-            try:
-                time_info = travel_time(latitude, longitude, hospital['address'])
-                hospital['duration'] = time_info['duration']
-                hospital['distance'] = time_info['distance']
-            except Exception as e:
-                print(f"Error calculating travel time for {hospital['hospital']}: {e}")
-                hospital['duration'] = float('inf')
-                hospital['distance'] = 0
-            
-            # Get predicted wait time for hospitals
-            try:
-                wait_time_minutes = get_predicted_wait_time(hospital['hospital'])
-                hospital['wait_time'] = wait_time_minutes  # in minutes, or None if prediction failed
-            except Exception as e:
-                print(f"Error getting wait time for {hospital['hospital']}: {e}")
-                hospital['wait_time'] = None
-
-        # Sort by combined score: travel time + wait time
-        # For hospitals without wait time data, use only travel time
-        def get_sort_key(h):
-            travel = h['duration']
-            wait = h.get('wait_time')
-            
-            # If wait time is available, combine it with travel time
-            # Convert wait time from minutes to seconds and add to travel time
-            if wait is not None:
-                return travel + (wait * 60)
-            else:
-                # If no wait time available, just use travel time
-                # Add a small penalty to prioritize hospitals with wait time data
-                return travel * 1.1
-        
-        hospitals.sort(key=get_sort_key)
-
-        # Store all 5 hospitals in session
-        session['hospitals'] = hospitals
-        session['user_location'] = {'latitude': latitude, 'longitude': longitude}
-        session['service_type'] = 'hospital'
+        # Store all 5 hospitals server-side
+        save_search_result(hospitals, latitude, longitude, 'hospital')
 
         return jsonify({'status': 'success', 'hospitals': hospitals})
     except Exception as e:
@@ -318,91 +724,95 @@ def find_vet():
         return jsonify({'status': 'error', 'message': 'Location not provided'}), 400
 
     try:
-        import math
-        
-        def haversine_distance(lat1, lon1, lat2, lon2):
-            """Calculate straight-line distance in km using haversine formula"""
-            R = 6371  # Earth's radius in km
-            lat1_rad, lon1_rad = math.radians(lat1), math.radians(lon1)
-            lat2_rad, lon2_rad = math.radians(lat2), math.radians(lon2)
-            
-            dlat = lat2_rad - lat1_rad
-            dlon = lon2_rad - lon1_rad
-            
-            a = math.sin(dlat/2)**2 + math.cos(lat1_rad) * math.cos(lat2_rad) * math.sin(dlon/2)**2
-            c = 2 * math.asin(math.sqrt(a))
-            
-            return R * c
-        
-        # Get all vets from CSV (with pre-computed coordinates if available)
-        vets = get_all_vets()
+        closest_vets = search_vets(latitude, longitude)
         
-        if not vets:
+        if closest_vets is None:
             return jsonify({'status': 'error', 'message': 'No vets found'}), 404
 
-        # Filter vets that have coordinates, or geocode the ones that don't
-        geocoded_vets = []
-        for vet in vets:
-            # If coordinates are already available, just calculate distance
-            if 'lat' in vet and 'lng' in vet:
-                vet['straight_line_distance'] = haversine_distance(
-                    latitude, longitude, vet['lat'], vet['lng']
-                )
-                geocoded_vets.append(vet)
-            else:
-                # Need to geocode this vet
-                try:
-                    url = "https://maps.googleapis.com/maps/api/geocode/json"
-                    params = {"address": vet['address'], "key": GOOGLE_API_KEY}
-                    r = get(url, params=params)
-                    r.raise_for_status()
-                    geocode_data = r.json()
-                    
-                    if geocode_data["status"] == "OK" and geocode_data["results"]:
-                        location = geocode_data["results"][0]["geometry"]["location"]
-                        vet['lat'] = location['lat']
-                        vet['lng'] = location['lng']
-                        vet['straight_line_distance'] = haversine_distance(
-                            latitude, longitude, location['lat'], location['lng']
-                        )
-                        geocoded_vets.append(vet)
-                except Exception as e:
-                    print(f"Error geocoding {vet['hospital']}: {e}")
-        
-        # Sort by straight-line distance and take top 8
-        geocoded_vets.sort(key=lambda v: v['straight_line_distance'])
-        top_vets = geocoded_vets[:8]
-        
-        # Now calculate accurate travel time for only the top 8
-        for vet in top_vets:
-            try:
-                time_info = travel_time(latitude, longitude, vet['address'])
-                vet['duration'] = time_info['duration']
-                vet['distance'] = time_info['distance']
-            except Exception as e:
-                print(f"Error calculating travel time for {vet['hospital']}: {e}")
-                vet['duration'] = float('inf')
-                vet['distance'] = 0
+        # Store all 5 vets server-side
+        save_search_result(closest_vets, latitude, longitude, 'vet')
 
-        # Sort by actual travel time
-        top_vets.sort(key=lambda v: v['duration'])
-        
-        # Take only the closest 5
-        closest_vets = top_vets[:5]
+        return jsonify({'status': 'success', 'vets': closest_vets})
+    except Exception as e:
+        return jsonify({'status': 'error', 'message': str(e)}), 500
 
-        # Store all 5 vets in session
-        session['hospitals'] = closest_vets  # Reuse 'hospitals' key for consistency
-        session['user_location'] = {'latitude': latitude, 'longitude': longitude}
-        session['service_type'] = 'vet'
+def _json_safe(places):
+    """Copies with unknown (inf) durations as null, which JSON can represent"""
+    return [
+        dict(p, duration=None) if isinstance(p.get('duration'), float) and math.isinf(p['duration']) else p
+        for p in places
+    ]
 
-        return jsonify({'status': 'success', 'vets': closest_vets})
+def stream_event(event_type, key, places):
+    return json.dumps({'type': event_type, key: _json_safe(places)}) + "\n"
+
+def stream_search(latitude, longitude, places, rank, service_type, key):
+    """
+    NDJSON stream of rankings: one 'candidates' line ranked on estimated
+    travel times, an 'update' line each time real travel times arrive, then
+    'done' with the final ranking. The session points at the stored result
+    from the start and the stored result is kept up to date.
+    """
+    estimate_travel_times(latitude, longitude, places)
+    save_search_result(rank(list(places)), latitude, longitude, service_type)
+    result_id = session['result_id']
+
+    def generate():
+        yield stream_event('candidates', key, rank(list(places)))
+        try:
+            for _ in iter_travel_times(latitude, longitude, places):
+                yield stream_event('update', key, rank(list(places)))
+        except Exception as e:
+            yield json.dumps({'type': 'error', 'message': str(e)}) + "\n"
+            return
+
+        ranked = rank(list(places))
+        result_store.update(result_id, {
+            'hospitals': ranked,
+            'user_location': {'latitude': latitude, 'longitude': longitude},
+        })
+        yield stream_event('done', key, ranked)
+
+    return Response(generate(), mimetype='application/x-ndjson',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+@app.route('/api/find-hospital/stream', methods=['POST'])
+def find_hospital_stream():
+    data = request.get_json()
+    latitude = data.get('latitude')
+    longitude = data.get('longitude')
+
+    if not latitude or not longitude:
+        return jsonify({'status': 'error', 'message': 'Location not provided'}), 400
+
+    try:
+        hospitals = add_wait_times(get_candidate_hospitals(latitude, longitude))
+        return stream_search(latitude, longitude, hospitals, rank_hospitals, 'hospital', 'hospitals')
+    except Exception as e:
+        return jsonify({'status': 'error', 'message': str(e)}), 500
+
+@app.route('/api/find-vet/stream', methods=['POST'])
+def find_vet_stream():
+    data = request.get_json()
+    latitude = data.get('latitude')
+    longitude = data.get('longitude')
+
+    if not latitude or not longitude:
+        return jsonify({'status': 'error', 'message': 'Location not provided'}), 400
+
+    try:
+        if not vet_store.get().vets:
+            return jsonify({'status': 'error', 'message': 'No vets found'}), 404
+
+        vets = nearest_vets(latitude, longitude)
+        return stream_search(latitude, longitude, vets, rank_vets, 'vet', 'vets')
     except Exception as e:
         return jsonify({'status': 'error', 'message': str(e)}), 500
 
 @app.route('/api/alternative-hospitals')
 def get_alternative_hospitals():
     """Return the next 4 hospitals (alternatives to the best one)"""
-    hospitals = session.get('hospitals', [])
+    hospitals = current_search_result().get('hospitals', [])
     
     # Return hospitals 2-5 (index 1-4)
     alternatives = hospitals[1:5] if len(hospitals) > 1 else []
@@ -414,11 +824,13 @@ def get_alternative_hospitals():
 
 @app.route('/api/select-hospital', methods=['POST'])
 def select_hospital():
-    """Switch to a different hospital by reordering the session list"""
+    """Switch to a different hospital by reordering the stored list"""
     data = request.get_json()
     hospital_index = data.get('hospital_index')  # 0-based index
     
-    hospitals = session.get('hospitals', [])
+    result_id = session.get('result_id')
+    result = result_store.get(result_id) or {}
+    hospitals = result.get('hospitals', [])
     
     if not hospitals or hospital_index is None or hospital_index >= len(hospitals):
         return jsonify({'status': 'error', 'message': 'Invalid hospital index'}), 400
@@ -427,11 +839,55 @@ def select_hospital():
     selected_hospital = hospitals.pop(hospital_index)
     hospitals.insert(0, selected_hospital)
     
-    session['hospitals'] = hospitals
-    session.modified = True
+    # Only the stored result changes; the cookie still points at the same id
+    result['hospitals'] = hospitals
+    result_store.update(result_id, result)
     
     return jsonify({'status': 'success', 'hospital': selected_hospital})
 
+# Limits for the bulk prediction endpoint
+PREDICT_MAX_HOSPITALS = int(os.getenv("PREDICT_MAX_HOSPITALS", "2000"))
+PREDICT_MAX_HOURS = int(os.getenv("PREDICT_MAX_HOURS", "168"))
+
+@app.route('/api/predict-waits', methods=['POST'])
+def predict_waits_endpoint():
+    """
+    Predicted waits for many hospitals over the next hours.
+    Body: {"hospitals": [names or row ids], "hours": 24, "format": "rows" | "columnar"}
+    """
+    data = request.get_json(silent=True) or {}
+    hospitals = data.get('hospitals')
+    hours = data.get('hours', 24)
+    output_format = data.get('format', 'rows')
+
+    if not isinstance(hospitals, list) or not hospitals:
+        return jsonify({'status': 'error', 'message': 'hospitals must be a non-empty list of names or ids'}), 400
+    if len(hospitals) > PREDICT_MAX_HOSPITALS:
+        return jsonify({'status': 'error', 'message': f'At most {PREDICT_MAX_HOSPITALS} hospitals per request'}), 400
+    if not isinstance(hours, int) or isinstance(hours, bool) or not 1 <= hours <= PREDICT_MAX_HOURS:
+        return jsonify({'status': 'error', 'message': f'hours must be between 1 and {PREDICT_MAX_HOURS}'}), 400
+    if output_format not in ('rows', 'columnar'):
+        return jsonify({'status': 'error', 'message': 'format must be "rows" or "columnar"'}), 400
+
+    try:
+        with span('wait_prediction'):
+            result = predict_waits(hospitals, hours)
+        if output_format == 'columnar':
+            result = to_columnar(result)
+        return jsonify({'status': 'success', **result})
+    except Exception as e:
+        return jsonify({'status': 'error', 'message': str(e)}), 500
+
+@app.route('/api/cache-stats')
+def cache_stats():
+    """Hit/miss counters for the outbound-call caches"""
+    return jsonify({
+        'status': 'success',
+        'travel_time': travel_cache.stats(),
+        'nhs_results': nhs_results_cache.stats(),
+        'search_results': result_store.stats()
+    })
+
 @app.route('/api/call-taxi', methods=['POST'])
 def call_taxi():
     # To be implemented
@@ -439,8 +895,8 @@ def call_taxi():
 
 @app.route('/api/get-origin')
 def get_origin():
-    """Return the user's origin location from session"""
-    user_location = session.get('user_location', {})
+    """Return the user's origin location from the stored search"""
+    user_location = current_search_result().get('user_location', {})
     
     if user_location and 'latitude' in user_location and 'longitude' in user_location:
         return jsonify({
@@ -452,30 +908,25 @@ def get_origin():
 
 @app.route('/api/get-destination')
 def get_destination():
-    # Check if we have hospitals in session
-    hospitals = session.get('hospitals')
+    # Check if we have hospitals from the last search
+    hospitals = current_search_result().get('hospitals')
     
     if hospitals and len(hospitals) > 0:
         # Use the best hospital (first one after sorting)
         best_hospital = hospitals[0]
         
-        # Geocode the hospital address
+        # Use known coordinates, otherwise geocode the address through the store
         try:
-            url = "https://maps.googleapis.com/maps/api/geocode/json"
-            params = {
-                "address": best_hospital['address'],
-                "key": GOOGLE_API_KEY
-            }
-            
-            r = get(url, params=params)
-            r.raise_for_status()
-            geocode_data = r.json()
+            if 'lat' in best_hospital and 'lng' in best_hospital:
+                lat, lng = best_hospital['lat'], best_hospital['lng']
+            else:
+                with span('geocode'):
+                    lat, lng = geocode_store.geocode(best_hospital['address'], GOOGLE_API_KEY)
             
-            if geocode_data["status"] == "OK" and geocode_data["results"]:
-                location = geocode_data["results"][0]["geometry"]["location"]
+            if lat is not None and lng is not None:
                 return jsonify({
-                    'latitude': location['lat'],
-                    'longitude': location['lng'],
+                    'latitude': lat,
+                    'longitude': lng,
                     'name': best_hospital['hospital'],
                     'address': best_hospital['address'],
                     'duration': best_hospital.get('duration'),
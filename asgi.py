@@ -0,0 +1,391 @@
+import asyncio
+import json
+import time
+
+from asgiref.wsgi import WsgiToAsgi
+from flask import session
+
+import app as flask_app
+from app import (
+    DIRECTIONS_URL, DISTANCE_MATRIX_URL, NHS_CACHE_CELL, NHS_SEARCH_URL, NHS_TIMEOUT,
+    TRAVEL_TIME_BACKEND, TRAVEL_TIME_DEADLINE, add_wait_times, apply_travel_times, app,
+    destination_chunks, directions_params, distance_matrix_params, estimate_travel_times,
+    nearest_vets, nhs_results_cache, parse_directions, parse_distance_matrix,
+    parse_nhs_results, rank_hospitals, rank_vets, result_store, save_search_result, stream_event,
+    travel_flight, travel_flight_key, use_ae_catalogue, use_cached_travel_times, vet_store,
+)
+import metrics
+from cache import quantize_origin
+from http_client import async_client
+from metrics import span
+
+
+
+'''
+ASGI entry point
+
+    uvicorn asgi:application --workers 2
+
+The search endpoints (/api/find-hospital and /api/find-vet, and their
+/stream variants the home page uses) are served natively on the event loop:
+their NHS and Google calls are awaited
+concurrently with httpx, so a worker isn't tied up while they are in flight,
+and the wait-time predictions run on a thread alongside them. Anything that
+blocks (SQLite caches and stores, geocoding, file reloads) runs on a thread
+too, never on the event loop. Every other
+route is the unchanged Flask app, run through asgiref's WSGI adapter.
+
+Ranking, caching and the session cookie are shared with the Flask code, so
+both serving modes return the same results.
+'''
+
+
+async def fetch_all_hospitals_async(latitude, longitude):
+    with span('nhs_fetch'):
+        r = await async_client.get(NHS_SEARCH_URL.format(latitude=latitude, longitude=longitude), timeout=NHS_TIMEOUT)
+        r.raise_for_status()
+    with span('nhs_parse'):
+        return parse_nhs_results(r.text)
+
+
+async def get_all_hospitals_async(latitude, longitude):
+    """NHS A&E search results, cached per location cell"""
+    cell = quantize_origin(latitude, longitude, NHS_CACHE_CELL)
+    hospitals = await nhs_results_cache.get_async(cell, fetch_all_hospitals_async, latitude, longitude)
+    return [dict(h) for h in hospitals]
+
+
+async def get_candidate_hospitals_async(latitude, longitude):
+    if use_ae_catalogue():
+        # No network call, but it may reload the catalogue file
+        return await asyncio.to_thread(flask_app.get_candidate_hospitals, latitude, longitude)
+    with span('nhs_search'):
+        return (await get_all_hospitals_async(latitude, longitude))[:flask_app.AE_CANDIDATES]
+
+
+async def get_json_async(url, params):
+    r = await async_client.get(url, params=params)
+    r.raise_for_status()
+    return r.json()
+
+
+async def travel_time_async(latitude, longitude, destination):
+    data = await travel_flight.do_async(
+        travel_flight_key('directions', latitude, longitude, [destination]),
+        get_json_async, DIRECTIONS_URL, directions_params(latitude, longitude, destination),
+    )
+    return parse_directions(data)
+
+
+async def travel_times_matrix_async(latitude, longitude, destinations):
+    data = await travel_flight.do_async(
+        travel_flight_key('matrix', latitude, longitude, destinations),
+        get_json_async, DISTANCE_MATRIX_URL, distance_matrix_params(latitude, longitude, destinations),
+    )
+    return parse_distance_matrix(data)
+
+
+async def _directions_job(latitude, longitude, destination):
+    return [await travel_time_async(latitude, longitude, destination)]
+
+
+async def _run_travel_job(job_places, job, deadline):
+    """Results aligned with job_places; errors and timeouts become exceptions in the list"""
+    try:
+        return await asyncio.wait_for(job, deadline)
+    except asyncio.TimeoutError:
+        return [TimeoutError(f"no response within {deadline}s")] * len(job_places)
+    except Exception as e:
+        return [e] * len(job_places)
+
+
+def _travel_time_jobs_async(latitude, longitude, places):
+    """(places, coroutine) pairs covering `places`, one per outbound call"""
+    if TRAVEL_TIME_BACKEND == 'directions':
+        return [([place], _directions_job(latitude, longitude, place['address'])) for place in places]
+    return [(chunk, travel_times_matrix_async(latitude, longitude, [p['address'] for p in chunk]))
+            for chunk in destination_chunks(places)]
+
+
+async def add_travel_times_async(latitude, longitude, places, deadline=None):
+    """add_travel_times with the outbound calls awaited concurrently"""
+    if deadline is None:
+        deadline = TRAVEL_TIME_DEADLINE
+
+    # The grid and travel cache reads (SQLite with the shared backend) run on a thread
+    uncached = await asyncio.to_thread(use_cached_travel_times, latitude, longitude, places)
+    jobs = _travel_time_jobs_async(latitude, longitude, uncached)
+
+    results = await asyncio.gather(*(_run_travel_job(job_places, job, deadline) for job_places, job in jobs))
+    await asyncio.to_thread(_apply_travel_jobs, latitude, longitude, jobs, results)
+
+    return places
+
+
+def _apply_travel_jobs(latitude, longitude, jobs, results):
+    # Writes the travel cache, so it runs off the event loop
+    for (job_places, _), job_results in zip(jobs, results):
+        apply_travel_times(latitude, longitude, job_places, job_results)
+
+
+async def _finished_travel_job(job_places, job, deadline):
+    return job_places, await _run_travel_job(job_places, job, deadline)
+
+
+async def iter_travel_times_async(latitude, longitude, places, deadline=None):
+    """
+    iter_travel_times for the event loop: yields `places` after the cache
+    lookups (if the cache had any) and after each batch of results lands
+    """
+    if deadline is None:
+        deadline = TRAVEL_TIME_DEADLINE
+
+    uncached = await asyncio.to_thread(use_cached_travel_times, latitude, longitude, places)
+    if len(uncached) < len(places):
+        yield places
+
+    tasks = [asyncio.ensure_future(_finished_travel_job(job_places, job, deadline))
+             for job_places, job in _travel_time_jobs_async(latitude, longitude, uncached)]
+    try:
+        for finished in asyncio.as_completed(tasks):
+            job_places, results = await finished
+            await asyncio.to_thread(apply_travel_times, latitude, longitude, job_places, results)
+            yield places
+    finally:
+        # The client went away; don't leave the calls running for nobody
+        for task in tasks:
+            task.cancel()
+
+
+async def timed(stage, awaitable):
+    with span(stage):
+        return await awaitable
+
+
+async def search_hospitals_async(latitude, longitude):
+    hospitals = await get_candidate_hospitals_async(latitude, longitude)
+
+    # Travel times and wait-time predictions don't depend on each other
+    await asyncio.gather(
+        timed('travel_times', add_travel_times_async(latitude, longitude, hospitals)),
+        timed('wait_prediction', asyncio.to_thread(add_wait_times, hospitals)),
+    )
+
+    return rank_hospitals(hospitals)
+
+
+async def search_vets_async(latitude, longitude):
+    # get() may reload the vet file (and query the geocode store), so off the loop
+    if not (await asyncio.to_thread(vet_store.get)).vets:
+        return None
+
+    # Runs on a thread since vets without coordinates may need geocoding
+    top_vets = await asyncio.to_thread(nearest_vets, latitude, longitude)
+    with span('travel_times'):
+        await add_travel_times_async(latitude, longitude, top_vets)
+    return rank_vets(top_vets)
+
+
+def session_cookies(cookie_header, hospitals, latitude, longitude, service_type):
+    """
+    Save the result like the Flask routes do; returns the Set-Cookie values
+    and the stored result's id. Blocking (the result store may be SQLite):
+    call it on a thread.
+    """
+    headers = {'Cookie': cookie_header} if cookie_header else {}
+    with app.test_request_context(headers=headers):
+        save_search_result(hospitals, latitude, longitude, service_type)
+        response = app.response_class()
+        app.session_interface.save_session(app, session._get_current_object(), response)
+        return response.headers.getlist('Set-Cookie'), session['result_id']
+
+
+async def find_hospital(body, cookie_header):
+    latitude = body.get('latitude')
+    longitude = body.get('longitude')
+
+    if not latitude or not longitude:
+        return 400, {'status': 'error', 'message': 'Location not provided'}, []
+
+    try:
+        hospitals = await search_hospitals_async(latitude, longitude)
+        cookies, _ = await asyncio.to_thread(
+            session_cookies, cookie_header, hospitals, latitude, longitude, 'hospital')
+        return 200, {'status': 'success', 'hospitals': hospitals}, cookies
+    except Exception as e:
+        return 500, {'status': 'error', 'message': str(e)}, []
+
+
+async def find_vet(body, cookie_header):
+    latitude = body.get('latitude')
+    longitude = body.get('longitude')
+
+    if not latitude or not longitude:
+        return 400, {'status': 'error', 'message': 'Location not provided'}, []
+
+    try:
+        closest_vets = await search_vets_async(latitude, longitude)
+
+        if closest_vets is None:
+            return 404, {'status': 'error', 'message': 'No vets found'}, []
+
+        cookies, _ = await asyncio.to_thread(
+            session_cookies, cookie_header, closest_vets, latitude, longitude, 'vet')
+        return 200, {'status': 'success', 'vets': closest_vets}, cookies
+    except Exception as e:
+        return 500, {'status': 'error', 'message': str(e)}, []
+
+
+async def stream_search_async(send, cookie_header, latitude, longitude, places, rank, service_type, key):
+    """
+    The NDJSON stream of stream_search in app.py ('candidates', an 'update'
+    per batch of travel times, then 'done'), with the travel-time calls
+    awaited on the event loop. Returns the response status.
+    """
+    await asyncio.to_thread(estimate_travel_times, latitude, longitude, places)
+    cookies, result_id = await asyncio.to_thread(
+        session_cookies, cookie_header, rank(list(places)), latitude, longitude, service_type)
+
+    headers = [(b'content-type', b'application/x-ndjson'), (b'cache-control', b'no-cache'),
+               (b'x-accel-buffering', b'no')]
+    headers += [(b'set-cookie', cookie.encode('latin-1')) for cookie in cookies]
+    await send({'type': 'http.response.start', 'status': 200, 'headers': headers})
+
+    async def send_line(line):
+        await send({'type': 'http.response.body', 'body': line.encode('utf-8'), 'more_body': True})
+
+    await send_line(stream_event('candidates', key, rank(list(places))))
+    try:
+        async for _ in iter_travel_times_async(latitude, longitude, places):
+            await send_line(stream_event('update', key, rank(list(places))))
+
+        ranked = rank(list(places))
+        await asyncio.to_thread(result_store.update, result_id, {
+            'hospitals': ranked,
+            'user_location': {'latitude': latitude, 'longitude': longitude},
+        })
+        await send_line(stream_event('done', key, ranked))
+    except Exception as e:
+        await send_line(json.dumps({'type': 'error', 'message': str(e)}) + "\n")
+    await send({'type': 'http.response.body', 'body': b''})
+    return 200
+
+
+async def find_hospital_stream(body, cookie_header, send):
+    latitude = body.get('latitude')
+    longitude = body.get('longitude')
+
+    if not latitude or not longitude:
+        return await send_error(send, 400, 'Location not provided')
+
+    try:
+        hospitals = await get_candidate_hospitals_async(latitude, longitude)
+        await asyncio.to_thread(add_wait_times, hospitals)
+    except Exception as e:
+        return await send_error(send, 500, str(e))
+    return await stream_search_async(send, cookie_header, latitude, longitude, hospitals,
+                                     rank_hospitals, 'hospital', 'hospitals')
+
+
+async def find_vet_stream(body, cookie_header, send):
+    latitude = body.get('latitude')
+    longitude = body.get('longitude')
+
+    if not latitude or not longitude:
+        return await send_error(send, 400, 'Location not provided')
+
+    try:
+        if not (await asyncio.to_thread(vet_store.get)).vets:
+            return await send_error(send, 404, 'No vets found')
+        vets = await asyncio.to_thread(nearest_vets, latitude, longitude)
+    except Exception as e:
+        return await send_error(send, 500, str(e))
+    return await stream_search_async(send, cookie_header, latitude, longitude, vets, rank_vets, 'vet', 'vets')
+
+
+ASYNC_ROUTES = {
+    ('POST', '/api/find-hospital'): find_hospital,
+    ('POST', '/api/find-vet'): find_vet,
+}
+
+# Handlers that write the response themselves; they return its status
+STREAM_ROUTES = {
+    ('POST', '/api/find-hospital/stream'): find_hospital_stream,
+    ('POST', '/api/find-vet/stream'): find_vet_stream,
+}
+
+wsgi_application = WsgiToAsgi(app)
+
+
+async def read_body(receive):
+    body = b''
+    while True:
+        message = await receive()
+        body += message.get('body', b'')
+        if not message.get('more_body'):
+            return body
+
+
+async def send_json(send, status, payload, cookies, timings=None):
+    body = app.json.dumps(payload).encode('utf-8')
+    headers = [(b'content-type', b'application/json'), (b'content-length', str(len(body)).encode())]
+    headers += [(b'set-cookie', cookie.encode('latin-1')) for cookie in cookies]
+    if metrics.SERVER_TIMING and timings:
+        headers.append((b'server-timing', metrics.server_timing_header(timings).encode('latin-1')))
+    await send({'type': 'http.response.start', 'status': status, 'headers': headers})
+    await send({'type': 'http.response.body', 'body': body})
+
+
+async def send_error(send, status, message):
+    await send_json(send, status, {'status': 'error', 'message': message}, [])
+    return status
+
+
+async def lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            await async_client.aclose()
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+
+async def application(scope, receive, send):
+    if scope['type'] == 'lifespan':
+        return await lifespan(receive, send)
+
+    route = (scope.get('method'), scope.get('path')) if scope['type'] == 'http' else None
+    handler = ASYNC_ROUTES.get(route)
+    stream_handler = STREAM_ROUTES.get(route)
+    if handler is None and stream_handler is None:
+        return await wsgi_application(scope, receive, send)
+
+    try:
+        body = json.loads(await read_body(receive) or b'null')
+    except ValueError:
+        body = None
+    if not isinstance(body, dict):
+        return await send_json(send, 400, {'status': 'error', 'message': 'Location not provided'}, [])
+
+    cookie_header = b'; '.join(value for name, value in scope['headers'] if name == b'cookie').decode('latin-1')
+    started = time.perf_counter()
+    token = metrics.start_request()
+    try:
+        if stream_handler is not None:
+            status = await stream_handler(body, cookie_header, send)
+        else:
+            status, payload, cookies = await handler(body, cookie_header)
+    finally:
+        timings = metrics.end_request(token)
+    metrics.request_duration.observe(
+        time.perf_counter() - started, endpoint=scope['path'], method=scope['method'], status=status)
+    if stream_handler is None:
+        await send_json(send, status, payload, cookies, timings)
+
+
+if __name__ == '__main__':
+    import uvicorn
+
+    uvicorn.run("asgi:application", host="127.0.0.1", port=5000)
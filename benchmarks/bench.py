@@ -0,0 +1,301 @@
+import argparse
+import gc
+import itertools
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime, timezone
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT_DIR)
+
+
+
+'''
+Offline micro-benchmarks for the request hot paths
+
+Covers hospital-name normalization and matching, the wait-time predictor, the
+vet list and parsing of a recorded NHS results page (fixtures/). Nothing here
+touches the network; the geocode store is pointed at a throwaway file.
+
+Each benchmark reports per-call latency percentiles and, from a separate
+tracemalloc pass, the peak memory each call allocates and what it retains.
+Results are saved as JSON so two runs can be compared:
+
+    python -m benchmarks.bench --output before.json
+    python -m benchmarks.bench --output after.json --compare before.json
+    python -m benchmarks.bench -k predictor
+'''
+
+
+FIXTURES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+NHS_RESULTS_FIXTURE = os.path.join(FIXTURES_DIR, 'nhs_results.html')
+
+# Spellings as they come back from the NHS search, including ones that only
+# match fuzzily and one that matches nothing
+SAMPLE_HOSPITAL_NAMES = [
+    "The Royal London Hospital",
+    "St Thomas' Hospital",
+    "King's College Hospital",
+    "University College Hospital",
+    "Homerton University Hospital",
+    "Whittington Hospital",
+    "Chelsea and Westminster Hospital",
+    "Northwick Park Hospital A&E",
+    "Fairfield General Hospital",
+    "Nowhere Community Clinic",
+]
+
+BENCHMARKS = {}
+
+
+def benchmark(name):
+    """Register a setup function that returns the callable to time"""
+    def register(setup):
+        BENCHMARKS[name] = setup
+        return setup
+    return register
+
+
+def cycle_args(fn, values):
+    """A zero-argument callable calling fn on the next value each time"""
+    values = itertools.cycle(values)
+    return lambda: fn(next(values))
+
+
+@benchmark('normalize_hospital_name')
+def bench_normalize_hospital_name():
+    from data.hospital_matcher import normalize_hospital_name
+    return cycle_args(normalize_hospital_name, SAMPLE_HOSPITAL_NAMES)
+
+
+@benchmark('find_hospital_in_data')
+def bench_find_hospital_in_data():
+    from data.hospital_matcher import find_hospital_in_data
+    from data.stores import hospital_store
+    df = hospital_store.get()
+    return cycle_args(lambda name: find_hospital_in_data(name, df), SAMPLE_HOSPITAL_NAMES)
+
+
+@benchmark('matcher.match_index (unmemoized)')
+def bench_matcher_match_index():
+    from data.hospital_matcher import HospitalNameMatcher
+    from data.stores import hospital_store
+    matcher = HospitalNameMatcher(hospital_store.get()['hospital_name'], memo_size=0)
+    return cycle_args(matcher.match_index, SAMPLE_HOSPITAL_NAMES)
+
+
+@benchmark('predictor.estimate_business')
+def bench_estimate_business():
+    from data.ae_wait_predictor import estimate_business
+    from data.stores import hospital_store
+    df = hospital_store.get()
+    name = df['hospital_name'][len(df) // 2]
+    return cycle_args(lambda hour: estimate_business(df, name, hour), range(168))
+
+
+@benchmark('predictor.run_all')
+def bench_run_all():
+    from data.ae_wait_predictor import run_all
+    from data.stores import hospital_store
+    df = hospital_store.get()
+    names = df['hospital_name'][::max(1, len(df) // 20)]
+    hours = itertools.count()
+    return cycle_args(lambda name: run_all(name, next(hours) % 168), names)
+
+
+@benchmark('predictor.forecast_business (all hospitals, 1 week)')
+def bench_forecast_business():
+    from data.ae_wait_predictor import forecast_business
+    from data.stores import hospital_store
+    df = hospital_store.get()
+    rows = list(range(len(df)))
+    return lambda: forecast_business(df, rows, 0, 168)
+
+
+@benchmark('predictor.calculate_normalization_factor')
+def bench_calculate_normalization_factor():
+    from data.ae_wait_predictor import calculate_normalization_factor
+    from data.stores import hospital_store
+    df = hospital_store.get()
+    names = df['hospital_name'][::max(1, len(df) // 20)]
+    return cycle_args(lambda name: calculate_normalization_factor(df, name), names)
+
+
+@benchmark('app.get_all_vets')
+def bench_get_all_vets():
+    app = load_app()
+    return app.get_all_vets
+
+
+@benchmark('app.parse_nhs_results')
+def bench_parse_nhs_results():
+    app = load_app()
+    with open(NHS_RESULTS_FIXTURE, 'r', encoding='utf-8') as f:
+        html = f.read()
+    return lambda: app.parse_nhs_results(html)
+
+
+def load_app():
+    # Keep the app's SQLite stores away from the real ones
+    os.environ.setdefault("GEOCODE_DB_PATH", os.path.join(tempfile.mkdtemp(), 'geocodes.db'))
+    import app
+    return app
+
+
+def time_calls(fn, min_time, min_calls):
+    """Per-call latencies in seconds, for at least min_time seconds and min_calls calls"""
+    fn()  # warm up (imports, lazy indexes, memo tables)
+    latencies = []
+    clock = time.perf_counter
+    deadline = clock() + min_time
+    gc_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        while len(latencies) < min_calls or clock() < deadline:
+            start = clock()
+            fn()
+            latencies.append(clock() - start)
+    finally:
+        if gc_enabled:
+            gc.enable()
+    return latencies
+
+
+def measure_allocations(fn, calls):
+    """
+    Memory per call: the peak of traced memory above where the call started
+    (the transient working set) and what is still held after the calls
+    (caches and leaks), in bytes and blocks.
+    """
+    peaks = []
+    tracemalloc.start()
+    try:
+        before = tracemalloc.take_snapshot()
+        for _ in range(calls):
+            tracemalloc.reset_peak()
+            start, _ = tracemalloc.get_traced_memory()
+            fn()
+            _, peak = tracemalloc.get_traced_memory()
+            peaks.append(peak - start)
+        after = tracemalloc.take_snapshot()
+    finally:
+        tracemalloc.stop()
+
+    # Sum only the growth of each allocation site, so memory freed elsewhere doesn't cancel it out
+    diff = [stat for stat in after.compare_to(before, 'lineno') if stat.size_diff > 0]
+    return {
+        'peak_bytes_per_call': statistics.fmean(peaks),
+        'retained_bytes_per_call': sum(stat.size_diff for stat in diff) / calls,
+        'retained_blocks_per_call': sum(stat.count_diff for stat in diff if stat.count_diff > 0) / calls,
+    }
+
+
+def percentile(sorted_values, p):
+    index = min(len(sorted_values) - 1, int(round(p / 100 * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+def summarize(latencies):
+    values = sorted(latencies)
+    us = 1e6
+    return {
+        'calls': len(values),
+        'mean_us': statistics.fmean(values) * us,
+        'stdev_us': (statistics.stdev(values) if len(values) > 1 else 0.0) * us,
+        'min_us': values[0] * us,
+        'p50_us': percentile(values, 50) * us,
+        'p90_us': percentile(values, 90) * us,
+        'p99_us': percentile(values, 99) * us,
+        'max_us': values[-1] * us,
+    }
+
+
+def run_benchmarks(names, min_time=1.0, min_calls=20, alloc_calls=50):
+    results = {}
+    for name in names:
+        fn = BENCHMARKS[name]()
+        stats = summarize(time_calls(fn, min_time, min_calls))
+        stats.update(measure_allocations(fn, alloc_calls))
+        results[name] = stats
+        print(f"{name:45} p50 {stats['p50_us']:10.1f} us  p99 {stats['p99_us']:10.1f} us  "
+              f"peak {stats['peak_bytes_per_call']:9.0f} B/call  ({stats['calls']} calls)")
+    return results
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT_DIR,
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except Exception:
+        return None
+
+
+def compare(results, baseline, threshold):
+    """Print the change in median latency and allocations; returns names that regressed"""
+    regressions = []
+    print(f"\n{'benchmark':45} {'p50 before':>12} {'p50 after':>12} {'change':>8} {'peak B/call':>12}")
+    for name, stats in results.items():
+        before = baseline['benchmarks'].get(name)
+        if before is None:
+            print(f"{name:45} {'-':>12} {stats['p50_us']:12.1f} {'new':>8}")
+            continue
+        change = stats['p50_us'] / before['p50_us'] - 1 if before['p50_us'] else 0.0
+        alloc_change = stats['peak_bytes_per_call'] - before['peak_bytes_per_call']
+        flag = '  REGRESSED' if change > threshold else ''
+        print(f"{name:45} {before['p50_us']:12.1f} {stats['p50_us']:12.1f} {change:+8.1%} {alloc_change:+12.0f}{flag}")
+        if flag:
+            regressions.append(name)
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline micro-benchmarks for the request hot paths")
+    parser.add_argument('-k', dest='pattern', help="only run benchmarks whose name contains this")
+    parser.add_argument('--min-time', type=float, default=1.0, help="seconds to time each benchmark for [1.0]")
+    parser.add_argument('--min-calls', type=int, default=20, help="minimum timed calls per benchmark [20]")
+    parser.add_argument('--alloc-calls', type=int, default=50, help="calls traced for allocations [50]")
+    parser.add_argument('--output', help="save results to this JSON file")
+    parser.add_argument('--compare', help="compare against a previously saved JSON file")
+    parser.add_argument('--threshold', type=float, default=0.10,
+                        help="median slowdown counted as a regression when comparing [0.10]")
+    parser.add_argument('--list', action='store_true', help="list benchmarks and exit")
+    args = parser.parse_args()
+
+    names = [name for name in BENCHMARKS if not args.pattern or args.pattern in name]
+    if args.list:
+        print('\n'.join(names))
+        return
+    if not names:
+        print(f"No benchmarks match {args.pattern!r}")
+        sys.exit(1)
+
+    results = run_benchmarks(names, args.min_time, args.min_calls, args.alloc_calls)
+    report = {
+        'created_at': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+        'commit': git_commit(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'benchmarks': results,
+    }
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=2)
+        print(f"\nSaved results to {args.output}")
+
+    if args.compare:
+        with open(args.compare, 'r', encoding='utf-8') as f:
+            baseline = json.load(f)
+        if compare(results, baseline, args.threshold):
+            sys.exit(2)
+
+
+if __name__ == '__main__':
+    main()
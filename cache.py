@@ -0,0 +1,355 @@
+import json
+import math
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+
+
+'''
+Small TTL + LRU caches for results of outbound calls
+
+MemoryCache lives inside one process. SQLiteCache keeps entries in a local
+SQLite file so several worker processes on the same machine share hits.
+Both store JSON-serializable values and count hits and misses.
+ThreadLocalConnection is the per-thread SQLite connection that SQLiteCache,
+the geocode store and the cross-process single-flight share.
+'''
+
+
+class ThreadLocalConnection:
+    """
+    Call for this thread's connection to a SQLite file in WAL mode, opened
+    on first use; `synchronous` sets PRAGMA synchronous if given
+    """
+
+    def __init__(self, path, synchronous=None):
+        self.path = path
+        self.synchronous = synchronous
+        self._local = threading.local()
+
+    def __call__(self):
+        # sqlite3 connections can't be shared between threads
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            if self.synchronous is not None:
+                conn.execute(f"PRAGMA synchronous={self.synchronous}")
+            self._local.conn = conn
+        return conn
+
+
+class MemoryCache:
+    def __init__(self, maxsize=10000):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()   # key -> (expires_at, value)
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] <= now:
+                if entry is not None:
+                    del self._entries[key]
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def set(self, key, value, ttl):
+        with self._lock:
+            self._entries[key] = (time.time() + ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def stats(self):
+        return {'backend': 'memory', 'hits': self.hits, 'misses': self.misses,
+                'size': len(self._entries), 'maxsize': self.maxsize}
+
+
+class SQLiteCache:
+    PRUNE_EVERY = 100
+
+    def __init__(self, path, maxsize=100000):
+        self.path = path
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._connection = ThreadLocalConnection(path, synchronous='NORMAL')
+        self._counter_lock = threading.Lock()
+        self._sets_since_prune = 0
+        self._connection().execute(
+            "CREATE TABLE IF NOT EXISTS cache ("
+            " key TEXT PRIMARY KEY, value TEXT NOT NULL,"
+            " expires_at REAL NOT NULL, used_at REAL NOT NULL)"
+        )
+        self._connection().execute("CREATE INDEX IF NOT EXISTS cache_used_at ON cache (used_at)")
+
+    def _count(self, hit):
+        with self._counter_lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+    def get(self, key):
+        now = time.time()
+        conn = self._connection()
+        row = conn.execute(
+            "SELECT value, expires_at FROM cache WHERE key = ?", (key,)
+        ).fetchone()
+        if row is None or row[1] <= now:
+            self._count(False)
+            return None
+        conn.execute("UPDATE cache SET used_at = ? WHERE key = ?", (now, key))
+        self._count(True)
+        return json.loads(row[0])
+
+    def set(self, key, value, ttl):
+        now = time.time()
+        conn = self._connection()
+        conn.execute(
+            "INSERT OR REPLACE INTO cache (key, value, expires_at, used_at) VALUES (?, ?, ?, ?)",
+            (key, json.dumps(value), now + ttl, now)
+        )
+
+        # Pruning scans the table, so only do it every PRUNE_EVERY writes
+        with self._counter_lock:
+            self._sets_since_prune += 1
+            prune = self._sets_since_prune >= self.PRUNE_EVERY
+            if prune:
+                self._sets_since_prune = 0
+        if prune:
+            # Drop expired rows, then the least recently used ones beyond maxsize
+            conn.execute("DELETE FROM cache WHERE expires_at <= ?", (now,))
+            conn.execute(
+                "DELETE FROM cache WHERE key IN ("
+                " SELECT key FROM cache ORDER BY used_at DESC LIMIT -1 OFFSET ?)",
+                (self.maxsize,)
+            )
+
+    def delete(self, key):
+        self._connection().execute("DELETE FROM cache WHERE key = ?", (key,))
+
+    def stats(self):
+        size = self._connection().execute("SELECT COUNT(*) FROM cache").fetchone()[0]
+        return {'backend': 'sqlite', 'path': self.path, 'hits': self.hits,
+                'misses': self.misses, 'size': size, 'maxsize': self.maxsize}
+
+
+class StaleWhileRevalidate:
+    """
+    In-process cache around a slow `fetch(*args)` call.
+
+    Entries younger than `fresh_ttl` are served as they are. Entries younger
+    than `stale_ttl` are served immediately while `executor` refreshes them
+    in the background. Older entries are refetched inline, and if that fetch
+    fails the last good value is served whatever its age. With a
+    `singleflight` group, concurrent fetches of one key are made only once.
+    """
+
+    def __init__(self, fetch, fresh_ttl, stale_ttl, executor, maxsize=1000, singleflight=None):
+        self.fetch = fetch
+        self.singleflight = singleflight
+        self.fresh_ttl = fresh_ttl
+        self.stale_ttl = stale_ttl
+        self.executor = executor
+        self.maxsize = maxsize
+        self.hits = 0
+        self.stale_hits = 0
+        self.misses = 0
+        self.fallbacks = 0
+        self._entries = OrderedDict()   # key -> (fetched_at, value)
+        self._refreshing = set()
+        self._lock = threading.Lock()
+
+    def _store(self, key, value):
+        with self._lock:
+            self._entries[key] = (time.time(), value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def _fetch(self, key, args):
+        if self.singleflight is None:
+            return self.fetch(*args)
+        return self.singleflight.do(key, self.fetch, *args)
+
+    def _refresh(self, key, args):
+        try:
+            self._store(key, self._fetch(key, args))
+        except Exception as e:
+            print(f"Background refresh of {key} failed, keeping last good result: {e}")
+        finally:
+            with self._lock:
+                self._refreshing.discard(key)
+
+    def get(self, key, *args):
+        with self._lock:
+            entry = self._entries.get(key)
+        age = time.time() - entry[0] if entry is not None else None
+
+        if entry is not None and age < self.fresh_ttl:
+            self.hits += 1
+            return entry[1]
+
+        if entry is not None and age < self.stale_ttl:
+            self.stale_hits += 1
+            with self._lock:
+                start = key not in self._refreshing
+                self._refreshing.add(key)
+            if start:
+                self.executor.submit(self._refresh, key, args)
+            return entry[1]
+
+        self.misses += 1
+        try:
+            value = self._fetch(key, args)
+        except Exception as e:
+            if entry is None:
+                raise
+            self.fallbacks += 1
+            print(f"Fetch for {key} failed, serving last good result: {e}")
+            return entry[1]
+        self._store(key, value)
+        return value
+
+    async def get_async(self, key, fetch_async, *args):
+        """
+        `get` for asyncio callers: a miss awaits `fetch_async(*args)` instead
+        of blocking the event loop. Stale entries are still refreshed in the
+        background with the synchronous `fetch`.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+        if entry is not None and time.time() - entry[0] < self.stale_ttl:
+            return self.get(key, *args)
+
+        self.misses += 1
+        try:
+            if self.singleflight is None:
+                value = await fetch_async(*args)
+            else:
+                value = await self.singleflight.do_async(key, fetch_async, *args)
+        except Exception as e:
+            if entry is None:
+                raise
+            self.fallbacks += 1
+            print(f"Fetch for {key} failed, serving last good result: {e}")
+            return entry[1]
+        self._store(key, value)
+        return value
+
+    def peek(self, key, max_age=None):
+        """Cached value (any age up to `max_age`) without fetching, or None"""
+        with self._lock:
+            entry = self._entries.get(key)
+        if entry is None or (max_age is not None and time.time() - entry[0] > max_age):
+            return None
+        return entry[1]
+
+    def prefetch(self, key, *args):
+        """Refresh `key` in the background unless it is fresh or already refreshing"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and time.time() - entry[0] < self.fresh_ttl:
+                return
+            if key in self._refreshing:
+                return
+            self._refreshing.add(key)
+        self.executor.submit(self._refresh, key, args)
+
+    def stats(self):
+        return {'backend': 'stale-while-revalidate', 'hits': self.hits,
+                'stale_hits': self.stale_hits, 'misses': self.misses,
+                'fallbacks': self.fallbacks, 'size': len(self._entries), 'maxsize': self.maxsize}
+
+
+def make_cache(backend='memory', maxsize=10000, path=None):
+    """Build a cache from config values, e.g. make_cache('sqlite', path='cache.db')"""
+    if backend == 'sqlite':
+        return SQLiteCache(path or os.path.join(os.path.dirname(os.path.abspath(__file__)), 'cache.db'),
+                           maxsize=maxsize)
+    if backend == 'memory':
+        return MemoryCache(maxsize=maxsize)
+    raise ValueError(f"Unknown cache backend: {backend}")
+
+
+'''
+Origin quantization
+'''
+
+_GEOHASH_ALPHABET = '0123456789bcdefghjkmnpqrstuvwxyz'
+METRES_PER_DEGREE_LAT = 111320.0
+
+
+def geohash(latitude, longitude, precision=7):
+    """Standard base32 geohash; precision 7 is a ~150m x 150m cell"""
+    lat_range = [-90.0, 90.0]
+    lng_range = [-180.0, 180.0]
+    bits = []
+    even = True
+    while len(bits) < precision * 5:
+        rng, value = (lng_range, longitude) if even else (lat_range, latitude)
+        mid = (rng[0] + rng[1]) / 2
+        if value >= mid:
+            bits.append(1)
+            rng[0] = mid
+        else:
+            bits.append(0)
+            rng[1] = mid
+        even = not even
+
+    chars = []
+    for i in range(0, len(bits), 5):
+        index = 0
+        for bit in bits[i:i + 5]:
+            index = (index << 1) | bit
+        chars.append(_GEOHASH_ALPHABET[index])
+    return ''.join(chars)
+
+
+def quantize_origin(latitude, longitude, cell='200'):
+    """
+    Snap a location to a grid cell id. `cell` is either a size in metres
+    (e.g. '200') or 'geohash:<precision>' (e.g. 'geohash:7').
+    """
+    latitude = float(latitude)
+    longitude = float(longitude)
+
+    if str(cell).startswith('geohash:'):
+        return 'g' + geohash(latitude, longitude, int(str(cell).split(':', 1)[1]))
+
+    cell_metres = float(cell)
+    lat_step = cell_metres / METRES_PER_DEGREE_LAT
+    row = math.floor(latitude / lat_step)
+    # Longitude cells shrink towards the poles; size them for the row's latitude
+    row_latitude = (row + 0.5) * lat_step
+    lng_step = cell_metres / (METRES_PER_DEGREE_LAT * max(math.cos(math.radians(row_latitude)), 1e-6))
+    col = math.floor(longitude / lng_step)
+    return f'm{int(cell_metres)}:{row}:{col}'
+
+
+def travel_time_ttl(when=None):
+    """Seconds a travel time stays valid; traffic changes fastest at rush hour"""
+    when = when or time.localtime()
+    hour = when.tm_hour
+    weekday = when.tm_wday < 5
+
+    if weekday and (7 <= hour < 10 or 16 <= hour < 19):
+        return 10 * 60
+    if 6 <= hour < 22:
+        return 30 * 60
+    return 2 * 60 * 60
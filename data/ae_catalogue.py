@@ -0,0 +1,248 @@
+import argparse
+import csv
+import os
+import re
+import sys
+
+from data.spatial_scan import SpatialScan
+
+
+
+'''
+Local, pre-geocoded catalogue of A&E sites
+
+Built once from a list of A&E sites, geocoded and written to
+ae_catalogue.csv. At request time the candidate hospitals are a
+nearest-neighbour query against it, so finding nearby A&Es needs no network
+call.
+
+Only emergency departments belong in it. The best source is a list of
+type-1 A&E sites with postcodes (e.g. from the NHS A&E attendances
+returns), passed with --sites: a CSV with `name` and `postcode` (or
+`address`) columns, and optionally `type`, in which case only type-1 rows
+are kept. Without --sites, the hospitals and infirmaries in
+hospital_data.csv are used, minus everything that is clearly not an ED
+(dental, eye, skin and community hospitals, clinics, services, units, ...).
+
+Every geocode is checked before a site is written: Google must return a
+single, exact hospital result inside --bounds (the UK by default) and, when
+the source has a postcode, in the same postcode district. Anything else is
+reported and left out, so review the rejects before switching the app to
+the catalogue (AE_CANDIDATE_SOURCE):
+
+    python -m data.ae_catalogue --sites ae_sites.csv
+    python -m data.ae_catalogue --bounds 51.28,-0.51,51.69,0.33
+'''
+
+
+DATA_DIR = os.path.dirname(os.path.abspath(__file__))
+AE_CATALOGUE_PATH = os.path.join(DATA_DIR, 'ae_catalogue.csv')
+FIELDNAMES = ['hospital_name', 'display_name', 'address', 'latitude', 'longitude']
+GEOCODE_URL = "https://maps.googleapis.com/maps/api/geocode/json"
+
+# south, west, north, east
+UK_BOUNDS = (49.8, -8.7, 60.9, 1.8)
+
+# Names in hospital_data.csv that are not emergency departments
+NON_ED_PATTERN = re.compile(
+    r'\b(DENTAL|EYE|SKIN|THROAT|CHILD HEALTH|COMMUNITY|CDC|CLINIC|SERVICE|UNIT|CENTRE|SUITE|WING|'
+    r'DAY|REHABILITATION|HOSPICE|CANCER|ORTHOPAEDIC|MATERNITY|PSYCHIATRIC|MENTAL|VACCINATION|'
+    r'URGENT|UTC|MINOR|WALK)\b'
+)
+HOSPITAL_PATTERN = re.compile(r'\b(HOSPITAL|INFIRMARY)\b')
+
+
+def display_name(hospital_name):
+    """'FAIRFIELD GEN HOSPITAL' -> 'Fairfield Gen Hospital'"""
+    return ' '.join(word.capitalize() for word in hospital_name.split())
+
+
+class AECatalogue:
+    def __init__(self, sites):
+        self.sites = sites
+        self.index = SpatialScan([s['lat'] for s in sites], [s['lng'] for s in sites])
+
+    def nearest(self, latitude, longitude, k):
+        """
+        The k nearest sites as candidate dicts ('hospital', 'address', 'lat',
+        'lng', 'dataset_name', 'straight_line_distance' in km)
+        """
+        positions, distances = self.index.nearest(float(latitude), float(longitude), k)
+        candidates = []
+        for position, distance in zip(positions, distances):
+            site = self.sites[position]
+            candidates.append({
+                'hospital': site['display_name'],
+                'address': site['address'],
+                'lat': site['lat'],
+                'lng': site['lng'],
+                'dataset_name': site['hospital_name'],
+                'straight_line_distance': float(distance),
+            })
+        return candidates
+
+
+def load_ae_catalogue(path=AE_CATALOGUE_PATH):
+    sites = []
+    with open(path, 'r', encoding='utf-8') as f:
+        for row in csv.DictReader(f):
+            try:
+                lat, lng = float(row['latitude']), float(row['longitude'])
+            except (TypeError, ValueError):
+                continue
+            sites.append({
+                'hospital_name': row['hospital_name'],
+                'display_name': row['display_name'] or display_name(row['hospital_name']),
+                'address': row['address'],
+                'lat': lat,
+                'lng': lng,
+            })
+    return AECatalogue(sites)
+
+
+def is_ed_name(hospital_name):
+    """False for names in hospital_data.csv that are clearly not an A&E (clinics, dental, eye, ...)"""
+    hospital_name = hospital_name.upper()
+    return HOSPITAL_PATTERN.search(hospital_name) is not None and NON_ED_PATTERN.search(hospital_name) is None
+
+
+def postcode_district(postcode):
+    """'SE1 7EH' -> 'SE1'"""
+    postcode = (postcode or '').upper().replace(' ', '')
+    return postcode[:-3] if len(postcode) > 3 else postcode
+
+
+def check_geocode(data, bounds=UK_BOUNDS, postcode=None):
+    """(lat, lng) of an acceptable Geocoding API response, else the reason it was rejected"""
+    if data.get("status") != "OK" or not data.get("results"):
+        return data.get("status") or "no result"
+    if len(data["results"]) > 1:
+        return f"ambiguous ({len(data['results'])} results)"
+
+    result = data["results"][0]
+    if result.get("partial_match"):
+        return "partial match"
+    if 'hospital' not in result.get("types", []):
+        return f"not a hospital ({', '.join(result.get('types', []))})"
+
+    location = result["geometry"]["location"]
+    lat, lng = location['lat'], location['lng']
+    south, west, north, east = bounds
+    if not (south <= lat <= north and west <= lng <= east):
+        return f"outside the expected region ({lat:.4f}, {lng:.4f})"
+
+    if postcode:
+        found = [c['long_name'] for c in result.get("address_components", []) if 'postal_code' in c['types']]
+        if not found or postcode_district(found[0]) != postcode_district(postcode):
+            return f"postcode {found[0] if found else 'missing'} does not match {postcode}"
+    return lat, lng
+
+
+def geocode_site(address, api_key, bounds=UK_BOUNDS, postcode=None):
+    """Validated (lat, lng) for an A&E site, or the reason it was rejected"""
+    from http_client import get
+
+    south, west, north, east = bounds
+    params = {
+        "address": address,
+        "components": "country:GB",
+        "bounds": f"{south},{west}|{north},{east}",
+        "key": api_key,
+    }
+    r = get(GEOCODE_URL, params=params)
+    r.raise_for_status()
+    data = r.json()
+    if data.get("status") not in ("OK", "ZERO_RESULTS"):
+        raise RuntimeError(data.get("status"))
+    return check_geocode(data, bounds, postcode)
+
+
+def read_sites(path):
+    """(name, address, postcode) for the type-1 sites in an A&E site list"""
+    sites = []
+    with open(path, 'r', encoding='utf-8-sig') as f:
+        for row in csv.DictReader(f):
+            row = {k.strip().lower(): (v or '').strip() for k, v in row.items() if k}
+            if 'type' in row and row['type'].lower().replace('type', '').strip() not in ('1', 'ed'):
+                continue
+            postcode = row.get('postcode', '')
+            address = row.get('address') or postcode
+            sites.append((row['name'], f"{display_name(row['name'])}, {address}, UK", postcode))
+    return sites
+
+
+def hospital_data_sites():
+    """(name, address, None) for the hospital_data.csv names that could be an A&E"""
+    from data.hospital_matcher import normalize_hospital_name
+    from data.stores import hospital_store
+
+    # One site per normalized name; the dataset spells some hospitals several ways
+    names = {}
+    for hospital_name in hospital_store.get()['hospital_name']:
+        if is_ed_name(hospital_name):
+            names.setdefault(normalize_hospital_name(hospital_name), hospital_name)
+    return [(name, f"{display_name(name)}, UK", None) for name in names.values()]
+
+
+def build_ae_catalogue(sites, api_key, output=AE_CATALOGUE_PATH, bounds=UK_BOUNDS):
+    """
+    Geocode (name, address, postcode) sites and write the ones that pass
+    check_geocode; returns (written, rejected) with the rejects' reasons.
+    """
+    written, rejected = 0, []
+    tmp_output = f"{output}.tmp"
+    with open(tmp_output, 'w', encoding='utf-8', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=FIELDNAMES)
+        writer.writeheader()
+
+        for i, (hospital_name, address, postcode) in enumerate(sites, 1):
+            try:
+                result = geocode_site(address, api_key, bounds, postcode)
+            except Exception as e:
+                result = f"error: {e}"
+            if isinstance(result, str):
+                print(f"[{i}/{len(sites)}] Rejected {hospital_name}: {result}")
+                rejected.append((hospital_name, result))
+                continue
+
+            lat, lng = result
+            writer.writerow({
+                'hospital_name': hospital_name,
+                'display_name': display_name(hospital_name),
+                'address': address,
+                'latitude': lat,
+                'longitude': lng,
+            })
+            written += 1
+
+    os.replace(tmp_output, output)
+    return written, rejected
+
+
+def main():
+    from dotenv import load_dotenv
+
+    parser = argparse.ArgumentParser(description="Build the local A&E catalogue")
+    parser.add_argument('output', nargs='?', default=AE_CATALOGUE_PATH)
+    parser.add_argument('--sites', help="CSV of A&E sites (name, postcode or address, optional type); "
+                                        "default: ED-looking names from hospital_data.csv")
+    parser.add_argument('--bounds', default=','.join(map(str, UK_BOUNDS)),
+                        help="south,west,north,east that every site must fall in [the UK]")
+    args = parser.parse_args()
+
+    load_dotenv(os.path.join(DATA_DIR, '..', '.env'))
+    api_key = os.getenv("GOOGLE_API_KEY")
+    if not api_key:
+        print("Error: GOOGLE_API_KEY not found in environment variables")
+        sys.exit(1)
+
+    sites = read_sites(args.sites) if args.sites else hospital_data_sites()
+    bounds = tuple(float(v) for v in args.bounds.split(','))
+    written, rejected = build_ae_catalogue(sites, api_key, args.output, bounds)
+    print(f"Wrote {written}/{len(sites)} A&E sites to {args.output}; {len(rejected)} rejected")
+    if rejected:
+        print("Check the rejected sites above before setting AE_CANDIDATE_SOURCE=catalogue")
+
+
+if __name__ == '__main__':
+    main()
@@ -1,5 +1,6 @@
 import numpy as np
-import pandas as pd
+
+from data.stores import hospital_store
 
 
 
@@ -15,9 +16,19 @@ def base_pat(count):
     return 1.0 + 0.1 * np.sin(2 * np.pi * count / 24)
 
 
+def hospital_position(hospital_df, hospital_name):
+    """Row of the first hospital with this exact name; IndexError if there is none"""
+    position = getattr(hospital_df, 'position', None)
+    if position is not None:
+        try:
+            return position(hospital_name)
+        except KeyError:
+            raise IndexError(f"no hospital named {hospital_name!r}") from None
+    return int(np.flatnonzero(np.asarray(hospital_df['hospital_name'], dtype=object) == hospital_name)[0])
+
+
 def get_avg_wait(hospital_df, hospital_name):
-    hospital_index = hospital_df[hospital_df['hospital_name'] == hospital_name].index[0]
-    avg_wait_time = hospital_df.loc[hospital_index, 'avg_wait_time']
+    avg_wait_time = float(hospital_df['avg_wait_time'][hospital_position(hospital_df, hospital_name)])
     
     return avg_wait_time
     
@@ -40,7 +51,7 @@ def get_seasonal_disease_factor(current_time, year_start_time):
 
 
 def interpolate_hourly_wait_times(wait_times):
-    """Smooth hourly wait times using cubic interpolation"""
+    """Smooth hourly wait times using cubic interpolation (offline use; needs scipy)"""
     from scipy.interpolate import CubicSpline
     
     # Create periodic interpolation by extending array
@@ -54,65 +65,72 @@ def interpolate_hourly_wait_times(wait_times):
     return cs
 
 
+def _as_result(values):
+    # Scalars in, scalars out; arrays in, arrays out
+    values = np.asarray(values)
+    return values[()] if values.ndim == 0 else values
+
+
 def get_location_factors(hour, dotw, is_city_center=True, near_transport_hub=False, near_nightlife=False):
-    multiplier = 1.0
+    """Location multiplier; accepts scalars or broadcastable arrays"""
+    hour = np.asarray(hour)
+    dotw = np.asarray(dotw)
+    night = (20 <= hour) | (hour < 4)
     
-    if is_city_center:
-        if 9 <= hour <= 18 and dotw < 5:
-            multiplier *= 1.15
-        elif (20 <= hour or hour < 4):
-            multiplier *= 0.95
-    
-    if near_transport_hub:
-        multiplier *= 1.1
+    city_factor = np.where(
+        (9 <= hour) & (hour <= 18) & (dotw < 5), 1.15,
+        np.where(night, 0.95, 1.0)
+    )
+    nightlife_factor = np.where(
+        night & np.isin(dotw, [4, 5, 6]), 1.3,
+        np.where((6 <= hour) & (hour < 18), 0.9135, 1.0)
+    )
     
-    if near_nightlife:
-        if (20 <= hour or hour < 4) and dotw in [4, 5, 6]:
-            multiplier *= 1.3
-        elif 6 <= hour < 18:
-            multiplier *= 0.9135
+    multiplier = 1.0
+    multiplier = multiplier * np.where(is_city_center, city_factor, 1.0)
+    multiplier = multiplier * np.where(near_transport_hub, 1.1, 1.0)
+    multiplier = multiplier * np.where(near_nightlife, nightlife_factor, 1.0)
     
-    return multiplier
+    return _as_result(multiplier)
 
 
 def smooth_time_factors(hour, dotw):
     """Apply smoothing to time-of-day factors using gradual transitions"""
+    hour = np.asarray(hour)
+    
+    # Smooth alcohol factor with gradual ramp-up/down; weekends peak higher
+    weekend = np.isin(dotw, [4, 5, 6])
+    step = np.where(weekend, 0.25, 0.1)
+    peak = np.where(weekend, 1.25, 1.1)
     
-    # Smooth alcohol factor with gradual ramp-up/down
-    if dotw in [4, 5, 6]:  # Weekend
-        if 18 <= hour < 20:  # Ramp up 6pm-8pm
-            alcohol_factor = 1.0 + 0.25 * (hour - 18) / 2
-        elif 20 <= hour or hour < 4:  # Peak
-            alcohol_factor = 1.25
-        elif 4 <= hour < 6:  # Ramp down 4am-6am
-            alcohol_factor = 1.25 - 0.25 * (hour - 4) / 2
-        else:
-            alcohol_factor = 1.0
-    else:  # Weekday
-        if 18 <= hour < 20:
-            alcohol_factor = 1.0 + 0.1 * (hour - 18) / 2
-        elif 20 <= hour or hour < 4:
-            alcohol_factor = 1.1
-        elif 4 <= hour < 6:
-            alcohol_factor = 1.1 - 0.1 * (hour - 4) / 2
-        else:
-            alcohol_factor = 1.0
-    
-    return alcohol_factor
+    alcohol_factor = np.select(
+        [
+            (18 <= hour) & (hour < 20),   # Ramp up 6pm-8pm
+            (20 <= hour) | (hour < 4),    # Peak
+            (4 <= hour) & (hour < 6),     # Ramp down 4am-6am
+        ],
+        [
+            1.0 + step * (hour - 18) / 2,
+            peak,
+            peak - step * (hour - 4) / 2,
+        ],
+        default=1.0,
+    )
+    
+    return _as_result(alcohol_factor)
 
 def calculate_normalization_factor(hospital_df, hospital_name, sample_hours=168,
-                                   is_city_center=True, near_transport_hub=False, near_nightlife=False):
+                                   is_city_center=True, near_transport_hub=False, near_nightlife=False,
+                                   wait_profiles=None):
     """Calculate factor to normalize average business to 100%"""
-    samples = []
+    hospital_index = hospital_position(hospital_df, hospital_name)
+    time_idx = np.arange(sample_hours)
     
-    for time_idx in range(sample_hours):
-        dotw = (time_idx // 24) % 7
-        biz = estimate_business(
-            hospital_df, hospital_name, time_idx, dotw=dotw,
-            is_city_center=is_city_center, near_transport_hub=near_transport_hub,
-            near_nightlife=near_nightlife, normalization_factor=None
-        )
-        samples.append(biz)
+    samples = estimate_business_batch(
+        hospital_df, [hospital_index], time_idx, dotw=(time_idx // 24) % 7,
+        is_city_center=is_city_center, near_transport_hub=near_transport_hub,
+        near_nightlife=near_nightlife, normalization_factor=None, wait_profiles=wait_profiles
+    )[0]
     
     return 100.0 / np.mean(samples)
 
@@ -176,6 +194,116 @@ def estimate_business(hospital_df, hospital_name, current_time, year_start_time=
 
 
 
+def autocorrelate(base_wait, previous_business=None):
+    """
+    Run the `previous_business` smoothing along the time axis of a
+    (hospitals, times) array of base waits: each step is
+    0.5 * base wait + 0.5 * the previous step's result, the first step
+    mixing with `previous_business` (scalar or one per hospital) if given.
+    """
+    # One vector operation per time step across all hospitals, with the same
+    # arithmetic as a scalar loop so results match it exactly
+    steps = np.array(np.asarray(base_wait, dtype=float).T, order='C')
+    previous = None
+    if previous_business is not None:
+        previous = np.broadcast_to(np.asarray(previous_business, dtype=float), steps.shape[1:])
+    for step in steps:
+        if previous is not None:
+            step *= 0.5
+            step += 0.5 * previous
+        previous = step
+    return steps.T
+
+
+def estimate_business_batch(hospital_df, hospital_indices, current_times, year_start_time=0,
+                           dotw=0, holiday=0, weather_severity=0, major_event=False,
+                           is_city_center=True, near_transport_hub=False, near_nightlife=False,
+                           normalization_factor=None, wait_profiles=None,
+                           previous_business=None, autocorrelated=False):
+    """
+    Vectorized `estimate_business` for many hospitals and times at once.
+
+    `hospital_indices` are row positions in `hospital_df` and `current_times`
+    are hours as passed to `estimate_business`. Returns a
+    (len(hospital_indices), len(current_times)) array of business
+    percentages, equal element for element to the scalar function.
+    `dotw` may be a scalar or one value per time; the location flags,
+    `normalization_factor` and `previous_business` may be scalars or one
+    value per hospital.
+    `wait_profiles` (a WaitProfiles) plays the part of `wait_time_interpolator`
+    for the hospitals that have an hourly profile.
+
+    With `autocorrelated`, the times are consecutive steps of one series:
+    each step's `previous_business` is the smoothed base wait of the step
+    before it, and `previous_business` only seeds the first step.
+    """
+    avg_waits = np.asarray(hospital_df['avg_wait_time'], dtype=float)[np.asarray(hospital_indices)]
+    avg_wait_time = avg_waits[:, None]
+    
+    current_times = np.asarray(current_times, dtype=float)
+    hour = current_times % 24
+    
+    def per_hospital(value):
+        value = np.asarray(value)
+        return value[:, None] if value.ndim == 1 else value
+    
+    # Interpolated hourly waits where a hospital has a profile
+    base_wait_value = avg_wait_time
+    if wait_profiles is not None:
+        hourly = wait_profiles.evaluate(hospital_indices, hour)
+        base_wait_value = np.where(np.isnan(hourly), avg_wait_time, hourly)
+    
+    # Base calculation
+    base = base_pat(current_times)
+    base_wait = base * base_wait_value
+
+    # Temporal autocorrelation, as in estimate_business
+    if autocorrelated:
+        base_wait = autocorrelate(base_wait, previous_business)
+    elif previous_business is not None:
+        base_wait = 0.5 * base_wait + 0.5 * per_hospital(previous_business)
+
+    # Factors
+    seasonal_factor = get_seasonal_disease_factor(current_times, year_start_time)
+    alcohol_factor = smooth_time_factors(hour, dotw)
+    location_factor = get_location_factors(
+        hour, dotw, per_hospital(is_city_center), per_hospital(near_transport_hub),
+        per_hospital(near_nightlife)
+    )
+    
+    weather_multipliers = {0: 1.0, 1: 1.15, 2: 1.35, 3: 1.6}
+    weather_factor = weather_multipliers.get(weather_severity, 1.0)
+    event_factor = 1.4 if major_event else 1.0
+    
+    # Combine factors
+    raw_demand = (base_wait * seasonal_factor * alcohol_factor * location_factor * weather_factor * 
+                  event_factor)
+    
+    # Normalize to percentage
+    max_capacity = avg_wait_time * 1.5
+    percentage_business = (raw_demand / max_capacity) * 100
+    
+    if normalization_factor is not None:
+        percentage_business = percentage_business * per_hospital(normalization_factor)
+    
+    return np.maximum(percentage_business, 0)
+
+
+def forecast_business(hospital_df, hospital_indices, start_time, hours, previous_business=None, **factors):
+    """
+    Autocorrelated business percentages for `hours` consecutive hours from
+    `start_time`, as a (len(hospital_indices), hours) array.
+
+    Equal to calling `estimate_business` hour by hour with each call's
+    `previous_business` set to the previous hour's smoothed base wait
+    (`previous_business` for the first hour). Other keyword arguments are
+    passed to `estimate_business_batch`.
+    """
+    current_times = start_time + np.arange(hours)
+    return estimate_business_batch(hospital_df, hospital_indices, current_times,
+                                   previous_business=previous_business, autocorrelated=True, **factors)
+
+
 
 
 
@@ -183,15 +311,20 @@ def estimate_business(hospital_df, hospital_name, current_time, year_start_time=
 RUN ME!!!! :))))))))))
 '''
 
-def run_all(hospital_name, current_time):
-    import os
-    import pandas as pd
-    
-    # Get the correct path to hospital_data.csv
-    csv_path = os.path.join(os.path.dirname(__file__), 'hospital_data.csv')
-    hospital_df = pd.read_csv(csv_path)
+def run_all(hospital_name, current_time, store=None):
+    # Use the resident store so no call re-parses hospital_data.csv
+    if store is None:
+        store = hospital_store
+    hospital_df = store.get()
+
+    # Hospitals with an hourly profile use its precomputed spline
+    wait_time_interpolator = None
+    wait_profiles = store.wait_profiles()
+    if wait_profiles is not None:
+        wait_time_interpolator = wait_profiles.interpolator(hospital_position(hospital_df, hospital_name))
 
-    business = estimate_business(hospital_df, hospital_name, current_time)
+    business = estimate_business(hospital_df, hospital_name, current_time,
+                                 wait_time_interpolator=wait_time_interpolator)
 
     business = business / 100
 
@@ -0,0 +1,187 @@
+import csv
+import json
+import os
+import re
+import sys
+import time
+
+from cache import ThreadLocalConnection
+from http_client import get
+from singleflight import make_singleflight
+
+
+
+'''
+Persistent address -> (lat, lng) store
+
+One SQLite file shared by the app and the offline scripts, so an address is
+only ever sent to the Geocoding API once. Addresses the API could not resolve
+are remembered too. Keys are normalized addresses, so case, spacing and stray
+commas don't cause repeat lookups.
+
+Warm it up from CSVs that already have coordinates, or from address lists:
+
+    python -m data.geocode_store warm-csv data/vets_data_geocoded.csv
+    python -m data.geocode_store geocode addresses.txt
+'''
+
+
+DATA_DIR = os.path.dirname(os.path.abspath(__file__))
+GEOCODE_DB_PATH = os.getenv("GEOCODE_DB_PATH", os.path.join(DATA_DIR, 'geocodes.db'))
+GEOCODE_URL = "https://maps.googleapis.com/maps/api/geocode/json"
+
+
+def normalize_address(address):
+    """Key used for an address: lowercase, single spaces, tidy commas"""
+    address = (address or '').lower()
+    address = re.sub(r'\s*,\s*', ', ', address)
+    address = re.sub(r'\s+', ' ', address)
+    return address.strip(' ,')
+
+
+def google_geocode(address, api_key):
+    """
+    Geocode an address with the Google Geocoding API.
+    Returns (lat, lng), or (None, None) if the API has no result for it.
+    Raises on transport errors and quota/permission failures so they are
+    not stored as misses.
+    """
+    params = {"address": address, "key": api_key}
+    r = get(GEOCODE_URL, params=params)
+    r.raise_for_status()
+    data = r.json()
+
+    if data["status"] == "OK" and data["results"]:
+        location = data["results"][0]["geometry"]["location"]
+        return location['lat'], location['lng']
+    if data["status"] == "ZERO_RESULTS":
+        return None, None
+    raise RuntimeError(data["status"])
+
+
+class GeocodeStore:
+    def __init__(self, path=GEOCODE_DB_PATH, flight=None):
+        self.path = path
+        # Concurrent misses for one address make a single API call
+        self.flight = flight or make_singleflight('geocode')
+        self._connection = ThreadLocalConnection(path)
+        self._connection().execute(
+            "CREATE TABLE IF NOT EXISTS geocodes ("
+            " address_key TEXT PRIMARY KEY, address TEXT NOT NULL,"
+            " lat REAL, lng REAL, updated_at REAL NOT NULL)"
+        )
+
+    def lookup(self, address):
+        """
+        Stored result for an address: (lat, lng), (None, None) for an address
+        the API could not resolve, or None if it was never geocoded.
+        """
+        row = self._connection().execute(
+            "SELECT lat, lng FROM geocodes WHERE address_key = ?", (normalize_address(address),)
+        ).fetchone()
+        return None if row is None else (row[0], row[1])
+
+    def lookup_many(self, addresses):
+        """lookup() for many addresses in one query: {address: (lat, lng)} for the stored ones"""
+        keys = {address: normalize_address(address) for address in addresses}
+        if not keys:
+            return {}
+        rows = self._connection().execute(
+            "SELECT address_key, lat, lng FROM geocodes WHERE address_key IN (SELECT value FROM json_each(?))",
+            (json.dumps(list(set(keys.values()))),)
+        ).fetchall()
+        stored = {key: (lat, lng) for key, lat, lng in rows}
+        return {address: stored[key] for address, key in keys.items() if key in stored}
+
+    def put(self, address, lat, lng, replace=True):
+        verb = "INSERT OR REPLACE" if replace else "INSERT OR IGNORE"
+        self._connection().execute(
+            f"{verb} INTO geocodes (address_key, address, lat, lng, updated_at) VALUES (?, ?, ?, ?, ?)",
+            (normalize_address(address), address, lat, lng, time.time())
+        )
+
+    def geocode(self, address, api_key):
+        """Read-through geocode; returns (lat, lng) or (None, None)"""
+        stored = self.lookup(address)
+        if stored is not None:
+            return stored
+
+        lat, lng = self.flight.do(normalize_address(address), self._geocode_and_store, address, api_key)
+        return lat, lng
+
+    def _geocode_and_store(self, address, api_key):
+        # Another process may have stored it while this one waited
+        stored = self.lookup(address)
+        if stored is not None:
+            return stored
+        lat, lng = google_geocode(address, api_key)
+        self.put(address, lat, lng)
+        return lat, lng
+
+    def warm_from_csv(self, path, address_col='Address', lat_col='Latitude', lng_col='Longitude'):
+        """Load rows that already have coordinates; existing entries are kept"""
+        loaded = 0
+
+        def rows(f):
+            # Streamed into executemany, so large files aren't held in memory
+            nonlocal loaded
+            for row in csv.DictReader(f):
+                try:
+                    lat, lng = float(row[lat_col]), float(row[lng_col])
+                except (KeyError, TypeError, ValueError):
+                    continue
+                loaded += 1
+                yield normalize_address(row[address_col]), row[address_col], lat, lng, time.time()
+
+        conn = self._connection()
+        with open(path, 'r', encoding='utf-8-sig') as f:
+            conn.execute("BEGIN")
+            try:
+                conn.executemany(
+                    "INSERT OR IGNORE INTO geocodes (address_key, address, lat, lng, updated_at)"
+                    " VALUES (?, ?, ?, ?, ?)", rows(f)
+                )
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+        return loaded
+
+    def warm_addresses(self, addresses, api_key):
+        """Geocode any addresses (e.g. a hospital list) not stored yet"""
+        geocoded = 0
+        for address in addresses:
+            if self.lookup(address) is None:
+                try:
+                    self.geocode(address, api_key)
+                    geocoded += 1
+                except Exception as e:
+                    print(f"Error geocoding {address}: {e}")
+        return geocoded
+
+
+geocode_store = GeocodeStore()
+
+
+def main():
+    usage = "usage: python -m data.geocode_store warm-csv <csv> | geocode <file of addresses>"
+    if len(sys.argv) != 3 or sys.argv[1] not in ('warm-csv', 'geocode'):
+        print(usage)
+        sys.exit(1)
+
+    command, path = sys.argv[1], sys.argv[2]
+    if command == 'warm-csv':
+        count = geocode_store.warm_from_csv(path)
+        print(f"Loaded {count} geocoded addresses from {path}")
+        return
+
+    from dotenv import load_dotenv
+    load_dotenv(os.path.join(DATA_DIR, '..', '.env'))
+    with open(path, 'r', encoding='utf-8') as f:
+        addresses = [line.strip() for line in f if line.strip()]
+    count = geocode_store.warm_addresses(addresses, os.getenv("GOOGLE_API_KEY"))
+    print(f"Geocoded {count} new addresses out of {len(addresses)}")
+
+
+if __name__ == '__main__':
+    main()
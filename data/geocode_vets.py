@@ -2,96 +2,245 @@
 """
 Script to pre-compute geocoding for all vet addresses in vets_data.csv
 This creates a new file vets_data_geocoded.csv with latitude and longitude columns
+
+Works as a bulk pipeline, so it also handles nationwide vet or hospital lists:
+
+- rows are streamed from the input and written to the output in chunks, so
+  memory stays flat whatever the file size
+- addresses are normalized and de-duplicated, and looked up in the shared
+  geocode store first; only addresses it has never seen go to the API
+- API calls run on a pool of workers behind a token-bucket rate limit
+- after every chunk the output is flushed and a checkpoint is written, so an
+  interrupted run resumes where it stopped (--restart starts over)
+- --incremental reuses the coordinates in the existing output, so only new
+  or changed rows are geocoded
+- rows whose input already has coordinates are kept as they are
+
+    python -m data.geocode_vets --incremental
+    python -m data.geocode_vets --input hospitals.csv --output hospitals_geocoded.csv --address-col address
 """
 
+import argparse
+import contextlib
 import csv
+import itertools
+import json
 import os
-import time
-from requests import get
+import sys
+from concurrent.futures import ThreadPoolExecutor
 from dotenv import load_dotenv
 
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from data.geocode_store import geocode_store, google_geocode, normalize_address
+from http_client import TokenBucket
+
 # Load environment variables
 load_dotenv(os.path.join(os.path.dirname(__file__), '..', '.env'))
 GOOGLE_API_KEY = os.getenv("GOOGLE_API_KEY")
 
-if not GOOGLE_API_KEY:
-    print("Error: GOOGLE_API_KEY not found in environment variables")
-    exit(1)
+# Concurrent API calls, and the rate they are held to (requests per second; 0 = unlimited)
+GEOCODE_WORKERS = int(os.getenv("GEOCODE_WORKERS", "8"))
+GEOCODE_RATE = float(os.getenv("GEOCODE_RATE", "10"))
+# Rows read, geocoded and written between checkpoints
+CHUNK_ROWS = 500
+
+LAT_COL = 'Latitude'
+LNG_COL = 'Longitude'
+
+
+class BulkGeocoder:
+    """Resolves chunks of addresses through the geocode store, rate-limiting the API calls"""
+
+    def __init__(self, api_key, workers=GEOCODE_WORKERS, rate=GEOCODE_RATE, store=geocode_store):
+        self.api_key = api_key
+        self.store = store
+        self.bucket = TokenBucket(rate)
+        self.pool = ThreadPoolExecutor(max_workers=max(1, workers))
+        self.counts = {'input': 0, 'stored': 0, 'geocoded': 0, 'not_found': 0, 'failed': 0, 'duplicates': 0}
+
+    def resolve(self, address):
+        """(lat, lng) or (None, None), and where it came from ('stored' or 'geocoded')"""
+        stored = self.store.lookup(address)
+        if stored is not None:
+            return stored, 'stored'
+        if not self.api_key:
+            raise RuntimeError("GOOGLE_API_KEY not set")
+        self.bucket.acquire()
+        lat, lng = google_geocode(address, self.api_key)
+        self.store.put(address, lat, lng)
+        return (lat, lng), 'geocoded'
+
+    def geocode_rows(self, rows, address_col):
+        """Fill in LAT_COL/LNG_COL for a chunk of rows, in place"""
+        pending = {}
+        for row in rows:
+            if existing_coordinates(row) is not None:
+                continue
+            key = normalize_address(row[address_col])
+            if key in pending:
+                self.counts['duplicates'] += 1
+            else:
+                pending[key] = self.pool.submit(self.resolve, row[address_col])
 
-def geocode_address(address):
-    """Geocode an address using Google Maps API"""
+        results = {}
+        for key, future in pending.items():
+            try:
+                (lat, lng), source = future.result()
+                self.counts[source] += 1
+                if lat is None:
+                    self.counts['not_found'] += 1
+            except Exception as e:
+                print(f"  Error geocoding {key!r}: {e}")
+                self.counts['failed'] += 1
+                lat, lng = None, None
+            results[key] = (lat, lng)
+
+        for row in rows:
+            coordinates = existing_coordinates(row)
+            if coordinates is not None:
+                self.counts['input'] += 1
+            else:
+                coordinates = results[normalize_address(row[address_col])]
+            lat, lng = coordinates
+            row[LAT_COL] = lat if lat is not None else ''
+            row[LNG_COL] = lng if lng is not None else ''
+
+    def close(self):
+        self.pool.shutdown()
+
+
+def existing_coordinates(row):
+    """(lat, lng) if the input row already has coordinates, else None"""
+    try:
+        return float(row[LAT_COL]), float(row[LNG_COL])
+    except (KeyError, TypeError, ValueError):
+        return None
+
+
+def input_signature(input_file):
+    st = os.stat(input_file)
+    return {'input': os.path.abspath(input_file), 'input_size': st.st_size, 'input_mtime_ns': st.st_mtime_ns}
+
+
+def load_checkpoint(checkpoint_file, input_file, partial_file):
+    """The saved checkpoint if it belongs to this input and its partial output, else None"""
     try:
-        url = "https://maps.googleapis.com/maps/api/geocode/json"
-        params = {"address": address, "key": GOOGLE_API_KEY}
-        r = get(url, params=params)
-        r.raise_for_status()
-        data = r.json()
-        
-        if data["status"] == "OK" and data["results"]:
-            location = data["results"][0]["geometry"]["location"]
-            return location['lat'], location['lng']
+        with open(checkpoint_file, 'r', encoding='utf-8') as f:
+            checkpoint = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if any(checkpoint.get(k) != v for k, v in input_signature(input_file).items()):
+        print(f"{input_file} changed since the last run; starting over")
+        return None
+    if not os.path.exists(partial_file) or os.path.getsize(partial_file) < checkpoint['output_bytes']:
+        return None
+    return checkpoint
+
+
+def save_checkpoint(checkpoint_file, input_file, rows_done, output_bytes):
+    checkpoint = dict(input_signature(input_file), rows_done=rows_done, output_bytes=output_bytes)
+    tmp_file = f"{checkpoint_file}.tmp"
+    with open(tmp_file, 'w', encoding='utf-8') as f:
+        json.dump(checkpoint, f)
+    os.replace(tmp_file, checkpoint_file)
+
+
+def geocode_csv(input_file, output_file, api_key, address_col='Address', incremental=False,
+                restart=False, workers=GEOCODE_WORKERS, rate=GEOCODE_RATE, chunk_rows=CHUNK_ROWS):
+    """
+    Geocode every row of input_file into output_file (input columns plus
+    LAT_COL/LNG_COL). Returns the BulkGeocoder's counts and the rows written.
+    """
+    partial_file = f"{output_file}.partial"
+    checkpoint_file = f"{output_file}.checkpoint"
+
+    if incremental and os.path.exists(output_file):
+        # Unchanged addresses become store hits; new or changed ones go to the API
+        reused = geocode_store.warm_from_csv(output_file, address_col, LAT_COL, LNG_COL)
+        print(f"Reusing {reused} geocoded rows from {output_file}")
+
+    checkpoint = None if restart else load_checkpoint(checkpoint_file, input_file, partial_file)
+    geocoder = BulkGeocoder(api_key, workers, rate)
+    rows_done = 0
+
+    with open(input_file, 'r', encoding='utf-8-sig', newline='') as f_in:
+        reader = csv.DictReader(f_in)
+        fieldnames = list(reader.fieldnames or [])
+        fieldnames += [col for col in (LAT_COL, LNG_COL) if col not in fieldnames]
+        if address_col not in fieldnames:
+            raise KeyError(f"{input_file} has no {address_col!r} column")
+
+        if checkpoint is not None:
+            rows_done = checkpoint['rows_done']
+            print(f"Resuming after row {rows_done}")
+            f_out = open(partial_file, 'r+', encoding='utf-8', newline='')
+            f_out.seek(checkpoint['output_bytes'])
+            f_out.truncate()
+            rows = itertools.islice(reader, rows_done, None)
         else:
-            print(f"  Warning: Could not geocode address (status: {data.get('status', 'unknown')})")
-            return None, None
-    except Exception as e:
-        print(f"  Error: {e}")
-        return None, None
+            f_out = open(partial_file, 'w', encoding='utf-8', newline='')
+            rows = reader
+
+        with f_out:
+            writer = csv.DictWriter(f_out, fieldnames=fieldnames)
+            if checkpoint is None:
+                writer.writeheader()
+            try:
+                while True:
+                    chunk = list(itertools.islice(rows, chunk_rows))
+                    if not chunk:
+                        break
+                    geocoder.geocode_rows(chunk, address_col)
+                    writer.writerows(chunk)
+
+                    f_out.flush()
+                    os.fsync(f_out.fileno())
+                    rows_done += len(chunk)
+                    save_checkpoint(checkpoint_file, input_file, rows_done, f_out.tell())
+                    print(f"[{rows_done}] {geocoder.counts['geocoded']} geocoded, "
+                          f"{geocoder.counts['stored']} from the store, {geocoder.counts['failed']} failed")
+            finally:
+                geocoder.close()
+
+    os.replace(partial_file, output_file)
+    # Not written if the input had no rows
+    with contextlib.suppress(FileNotFoundError):
+        os.remove(checkpoint_file)
+    return geocoder.counts, rows_done
+
 
 def main():
     script_dir = os.path.dirname(os.path.abspath(__file__))
-    input_file = os.path.join(script_dir, 'vets_data.csv')
-    output_file = os.path.join(script_dir, 'vets_data_geocoded.csv')
-    
-    print(f"Reading vets from: {input_file}")
-    print(f"Output will be saved to: {output_file}")
-    print()
-    
-    vets_geocoded = []
-    
-    with open(input_file, 'r', encoding='utf-8') as f:
-        reader = csv.DictReader(f)
-        vets = list(reader)
-    
-    print(f"Found {len(vets)} vets to geocode")
-    print("Starting geocoding...")
+
+    parser = argparse.ArgumentParser(description="Geocode the addresses in a CSV (vets_data.csv by default)")
+    parser.add_argument('--input', default=os.path.join(script_dir, 'vets_data.csv'))
+    parser.add_argument('--output', default=os.path.join(script_dir, 'vets_data_geocoded.csv'))
+    parser.add_argument('--address-col', default='Address', help="column holding the address [Address]")
+    parser.add_argument('--incremental', action='store_true',
+                        help="reuse coordinates from the existing output; only geocode new or changed rows")
+    parser.add_argument('--restart', action='store_true', help="ignore the checkpoint of an interrupted run")
+    parser.add_argument('--workers', type=int, default=GEOCODE_WORKERS,
+                        help=f"concurrent API calls [{GEOCODE_WORKERS}]")
+    parser.add_argument('--rate', type=float, default=GEOCODE_RATE,
+                        help=f"API requests per second, 0 for no limit [{GEOCODE_RATE:g}]")
+    args = parser.parse_args()
+
+    if not GOOGLE_API_KEY:
+        print("Warning: GOOGLE_API_KEY not found in environment variables; only stored addresses will resolve")
+
+    print(f"Reading rows from: {args.input}")
+    print(f"Output will be saved to: {args.output}")
     print()
-    
-    for i, vet in enumerate(vets, 1):
-        name = vet['Hospital Name']
-        address = vet['Address']
-        
-        print(f"[{i}/{len(vets)}] Geocoding: {name}")
-        
-        lat, lng = geocode_address(address)
-        
-        vets_geocoded.append({
-            'Hospital Name': name,
-            'Address': address,
-            'Latitude': lat if lat is not None else '',
-            'Longitude': lng if lng is not None else ''
-        })
-        
-        if lat and lng:
-            print(f"  ✓ Success: {lat:.6f}, {lng:.6f}")
-        else:
-            print(f"  ✗ Failed to geocode")
-        
-        # Small delay to avoid rate limiting
-        time.sleep(0.1)
-    
-    # Write to output file
+
+    counts, rows = geocode_csv(args.input, args.output, GOOGLE_API_KEY, args.address_col,
+                               args.incremental, args.restart, args.workers, args.rate)
+
     print()
-    print(f"Writing results to: {output_file}")
-    
-    with open(output_file, 'w', encoding='utf-8', newline='') as f:
-        fieldnames = ['Hospital Name', 'Address', 'Latitude', 'Longitude']
-        writer = csv.DictWriter(f, fieldnames=fieldnames)
-        writer.writeheader()
-        writer.writerows(vets_geocoded)
-    
-    success_count = sum(1 for v in vets_geocoded if v['Latitude'] and v['Longitude'])
-    print(f"✓ Done! Successfully geocoded {success_count}/{len(vets)} vets")
-    print(f"Results saved to: {output_file}")
+    print(f"✓ Done! {rows} rows: {counts['geocoded']} addresses geocoded, {counts['stored']} from the store, "
+          f"{counts['input']} already had coordinates, {counts['duplicates']} duplicate addresses")
+    print(f"  {counts['not_found']} not found, {counts['failed']} failed (re-run to retry them)")
+    print(f"Results saved to: {args.output}")
+
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,128 @@
+import re
+import unicodedata
+from collections import defaultdict
+from functools import lru_cache
+
+
+
+'''
+Fuzzy hospital name matching
+
+Maps hospital names as the NHS site spells them onto the names used in
+hospital_data.csv. Dataset names are normalized once when the matcher is built;
+lookups only touch rows that share at least one word with the query.
+'''
+
+
+COMMON_WORDS = {'the', 'a', 'an', 'and', 'or', 'of', 'at', 'in', 'for', 'to'}
+
+
+def normalize_hospital_name(name):
+    """
+    Normalize hospital name for fuzzy matching:
+    - Convert to lowercase
+    - Remove non-ASCII characters
+    - Sort words alphabetically
+    - Remove common words that don't help matching
+    """
+    if not name:
+        return ""
+
+    # Convert to lowercase
+    name = name.lower()
+
+    # Remove non-ASCII characters
+    name = unicodedata.normalize('NFKD', name)
+    name = name.encode('ascii', 'ignore').decode('ascii')
+
+    # Remove punctuation and extra whitespace
+    name = re.sub(r'[^\w\s]', ' ', name)
+    name = re.sub(r'\s+', ' ', name).strip()
+
+    # Split into words and sort
+    words = name.split()
+
+    # Remove common words that don't help with matching
+    words = [w for w in words if w not in COMMON_WORDS]
+
+    # Sort words to ignore order
+    words.sort()
+
+    return ' '.join(words)
+
+
+class HospitalNameMatcher:
+    """
+    Precomputed matcher over a list of dataset hospital names.
+
+    `match` returns the same result as scanning every row: an exact normalized
+    match first, otherwise the earliest row with the highest share of query
+    words, provided at least 50% of the query words matched.
+    """
+
+    def __init__(self, hospital_names, memo_size=1024):
+        self.names = list(hospital_names)
+        self.exact = {}
+        self.token_rows = defaultdict(list)
+
+        for row, name in enumerate(self.names):
+            normalized = normalize_hospital_name(name)
+            self.exact.setdefault(normalized, row)
+            for token in set(normalized.split()):
+                self.token_rows[token].append(row)
+
+        self.match = lru_cache(maxsize=memo_size)(self._match)
+
+    def _match(self, hospital_name):
+        row = self.match_index(hospital_name)
+        return None if row is None else self.names[row]
+
+    def _exact_row(self, normalized):
+        """First row whose normalized name is exactly `normalized`, or None"""
+        return self.exact.get(normalized)
+
+    def _rows_with_token(self, token):
+        """Rows whose normalized name contains `token`"""
+        return self.token_rows.get(token, ())
+
+    def match_index(self, hospital_name):
+        """Row position of the best match, or None"""
+        normalized_input = normalize_hospital_name(hospital_name)
+
+        row = self._exact_row(normalized_input)
+        if row is not None:
+            return row
+
+        input_words = set(normalized_input.split())
+        if not input_words:
+            return None
+
+        # Number of query words each candidate row shares
+        shared = defaultdict(int)
+        for token in input_words:
+            for row in self._rows_with_token(token):
+                shared[int(row)] += 1
+
+        if not shared:
+            return None
+
+        # Highest overlap wins; ties go to the earliest row, as in a linear scan
+        best_row = min(shared, key=lambda r: (-shared[r], r))
+        best_score = shared[best_row] / len(input_words)
+
+        # Only return match if at least 50% of words matched
+        if best_score >= 0.5:
+            return best_row
+
+        return None
+
+
+def find_hospital_in_data(hospital_name, hospital_df):
+    """
+    Find a hospital in the dataframe using fuzzy name matching.
+    Returns the matched hospital name from the dataframe or None.
+
+    Builds a throwaway matcher; prefer `hospital_store.matcher()` for the
+    resident dataset.
+    """
+    return HospitalNameMatcher(hospital_df['hospital_name'], memo_size=0).match(hospital_name)
@@ -0,0 +1,275 @@
+import os
+import struct
+import sys
+from collections import defaultdict
+from functools import lru_cache
+
+import numpy as np
+
+from data.hospital_matcher import HospitalNameMatcher, normalize_hospital_name
+from data.packed_file import PackedFile, write_packed_file
+
+
+
+'''
+Compact, memory-mapped copy of hospital_data.csv
+
+`python -m data.hospital_pack` compiles the CSV into hospital_data.bin:
+
+- the average waits as a float32 array
+- the hourly wait profiles, if the CSV has them, as a float32 array
+- the hospital names as a string table
+- the name matcher's index: normalized names -> first row, and word -> rows
+
+Workers mmap the file read-only instead of parsing the CSV, so every process
+shares one page-cache copy and startup is an mmap. Lookups read straight from
+the mapping. The file records the size and mtime of the CSV it was built
+from; the hospital store ignores it once the CSV changes, until it is rebuilt.
+The file is replaced atomically, so running workers keep their old mapping
+until they reload.
+'''
+
+
+DATA_DIR = os.path.dirname(os.path.abspath(__file__))
+HOSPITAL_PACK_PATH = os.getenv("HOSPITAL_PACK_PATH", os.path.join(DATA_DIR, 'hospital_data.bin'))
+
+MAGIC = b'HOSPPACK'
+VERSION = 2
+
+# magic, version, rows, csv mtime_ns, csv size, then (offset, count) of each section
+SECTIONS = [
+    'waits',            # float32[rows]
+    'name_offsets',     # uint32[rows + 1] into name_blob
+    'name_blob',        # utf-8 names
+    'name_order',       # uint32[rows] rows sorted by (name bytes, row)
+    'exact_offsets',    # uint32[keys + 1] into exact_blob
+    'exact_blob',       # sorted unique normalized names
+    'exact_rows',       # uint32[keys] first row for each normalized name
+    'token_offsets',    # uint32[tokens + 1] into token_blob
+    'token_blob',       # sorted unique words of the normalized names
+    'posting_offsets',  # uint32[tokens + 1] into postings
+    'postings',         # uint32 rows, ascending per token
+    'profiles',         # float32[rows * 24] hourly waits (NaN = no profile), or empty
+]
+HEADER = struct.Struct('<8sIIqQ' + 'QQ' * len(SECTIONS))
+
+
+def _string_table(strings):
+    encoded = [s.encode('utf-8') for s in strings]
+    offsets = np.zeros(len(encoded) + 1, dtype='<u4')
+    offsets[1:] = np.cumsum([len(b) for b in encoded])
+    return offsets, b''.join(encoded)
+
+
+def build_hospital_pack(hospital_table, csv_path, output=HOSPITAL_PACK_PATH):
+    """Write the pack for a HospitalTable parsed from `csv_path`"""
+    names = hospital_table['hospital_name']
+    waits = np.asarray(hospital_table['avg_wait_time'], dtype='<f4')
+
+    exact = {}
+    token_rows = defaultdict(list)
+    for row, name in enumerate(names):
+        normalized = normalize_hospital_name(name)
+        exact.setdefault(normalized, row)
+        for token in set(normalized.split()):
+            token_rows[token].append(row)
+
+    exact_keys = sorted(exact, key=lambda k: k.encode('utf-8'))
+    tokens = sorted(token_rows, key=lambda t: t.encode('utf-8'))
+
+    name_offsets, name_blob = _string_table(names)
+    name_order = np.array(sorted(range(len(names)), key=lambda r: (names[r].encode('utf-8'), r)), dtype='<u4')
+    exact_offsets, exact_blob = _string_table(exact_keys)
+    token_offsets, token_blob = _string_table(tokens)
+    posting_offsets = np.zeros(len(tokens) + 1, dtype='<u4')
+    posting_offsets[1:] = np.cumsum([len(token_rows[t]) for t in tokens])
+
+    sections = {
+        'waits': waits,
+        'name_offsets': name_offsets,
+        'name_blob': name_blob,
+        'name_order': name_order,
+        'exact_offsets': exact_offsets,
+        'exact_blob': exact_blob,
+        'exact_rows': np.array([exact[k] for k in exact_keys], dtype='<u4'),
+        'token_offsets': token_offsets,
+        'token_blob': token_blob,
+        'posting_offsets': posting_offsets,
+        'postings': np.array([row for t in tokens for row in token_rows[t]], dtype='<u4'),
+        'profiles': np.asarray(
+            hospital_table.profiles if hospital_table.profiles is not None else np.empty(0), dtype='<f4'
+        ).ravel(),
+    }
+
+    st = os.stat(csv_path)
+    write_packed_file(output, HEADER, (MAGIC, VERSION, len(names), st.st_mtime_ns, st.st_size),
+                      SECTIONS, sections)
+    return len(names)
+
+
+class PackedStrings:
+    """Read-only sequence of the strings in one string table of the pack"""
+
+    def __init__(self, buf, offsets, blob_start):
+        self._buf = buf
+        self._offsets = offsets
+        self._blob_start = blob_start
+
+    def __len__(self):
+        return len(self._offsets) - 1
+
+    def raw(self, i):
+        return self._buf[self._blob_start + int(self._offsets[i]):self._blob_start + int(self._offsets[i + 1])]
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError(i)
+        return self.raw(i).decode('utf-8')
+
+    def __iter__(self):
+        return (self[i] for i in range(len(self)))
+
+    def find(self, key, order=None):
+        """
+        Index of the first string equal to `key` (a str), searching in `order`
+        (a sorted permutation) if given; None if absent
+        """
+        key = key.encode('utf-8')
+        lo, hi = 0, len(self)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.raw(mid if order is None else int(order[mid])) < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < len(self):
+            i = lo if order is None else int(order[lo])
+            if self.raw(i) == key:
+                return i
+        return None
+
+
+class HospitalPack:
+    """
+    A mapped hospital_data.bin. Answers the same lookups as HospitalTable
+    (`pack['hospital_name']`, `pack['avg_wait_time']`, `profiles`, `position`,
+    `avg_wait`)
+    """
+
+    def __init__(self, path=HOSPITAL_PACK_PATH):
+        self.path = path
+        packed = PackedFile(path, HEADER, SECTIONS, MAGIC, VERSION, 'hospital pack')
+        self._buf = packed.buf
+        _, _, self.rows, self.csv_mtime_ns, self.csv_size = packed.fields
+        array = packed.array
+        layout = packed.layout
+
+        self.avg_waits = array('waits', '<f4')
+        self.names = PackedStrings(self._buf, array('name_offsets', '<u4'), layout['name_blob'][0])
+        self.name_order = array('name_order', '<u4')
+        self.exact_keys = PackedStrings(self._buf, array('exact_offsets', '<u4'), layout['exact_blob'][0])
+        self.exact_rows = array('exact_rows', '<u4')
+        self.tokens = PackedStrings(self._buf, array('token_offsets', '<u4'), layout['token_blob'][0])
+        self.posting_offsets = array('posting_offsets', '<u4')
+        self.postings = array('postings', '<u4')
+        profiles = array('profiles', '<f4')
+        self.profiles = profiles.reshape(self.rows, -1) if len(profiles) else None
+
+    def built_from(self, csv_path):
+        """True if the pack was built from the current version of `csv_path`"""
+        st = os.stat(csv_path)
+        return (st.st_mtime_ns, st.st_size) == (self.csv_mtime_ns, self.csv_size)
+
+    def __getitem__(self, column):
+        if column == 'hospital_name':
+            return self.names
+        if column == 'avg_wait_time':
+            return self.avg_waits
+        raise KeyError(column)
+
+    def __len__(self):
+        return self.rows
+
+    def position(self, hospital_name):
+        """Row of the first hospital with this exact name; KeyError if none"""
+        row = self.names.find(hospital_name, self.name_order)
+        if row is None:
+            raise KeyError(hospital_name)
+        return row
+
+    def avg_wait(self, hospital_name):
+        """Base average wait (hours) for an exact dataset hospital name"""
+        return float(self.avg_waits[self.position(hospital_name)])
+
+
+class PackedNameMatcher(HospitalNameMatcher):
+    """HospitalNameMatcher answering from the pack's precomputed index"""
+
+    def __init__(self, pack, memo_size=1024):
+        self.pack = pack
+        self.names = pack.names
+        self.match = lru_cache(maxsize=memo_size)(self._match)
+
+    def _exact_row(self, normalized):
+        key = self.pack.exact_keys.find(normalized)
+        return None if key is None else int(self.pack.exact_rows[key])
+
+    def _rows_with_token(self, token):
+        t = self.pack.tokens.find(token)
+        if t is None:
+            return ()
+        return self.pack.postings[self.pack.posting_offsets[t]:self.pack.posting_offsets[t + 1]]
+
+    def match_index(self, hospital_name):
+        """Same result as HospitalNameMatcher.match_index, counting overlaps with numpy"""
+        normalized_input = normalize_hospital_name(hospital_name)
+
+        row = self._exact_row(normalized_input)
+        if row is not None:
+            return row
+
+        input_words = set(normalized_input.split())
+        postings = [self._rows_with_token(token) for token in input_words]
+        postings = [rows for rows in postings if len(rows)]
+        if not postings:
+            return None
+
+        rows, shared = np.unique(np.concatenate(postings), return_counts=True)
+        # argmax takes the first maximum, i.e. the earliest row among the best
+        best = int(np.argmax(shared))
+        if shared[best] / len(input_words) >= 0.5:
+            return int(rows[best])
+        return None
+
+
+def load_hospital_pack(csv_path, path=HOSPITAL_PACK_PATH):
+    """The pack if it exists and matches the CSV, otherwise None"""
+    if not os.path.exists(path):
+        return None
+    try:
+        pack = HospitalPack(path)
+    except (OSError, ValueError, struct.error) as e:
+        print(f"Could not open {path}: {e}")
+        return None
+    if not pack.built_from(csv_path):
+        print(f"{path} is older than {csv_path}; rebuild it with python -m data.hospital_pack")
+        return None
+    return pack
+
+
+def main():
+    from data.stores import HOSPITAL_DATA_PATH, load_hospital_table
+
+    csv_path = sys.argv[1] if len(sys.argv) > 1 else HOSPITAL_DATA_PATH
+    output = sys.argv[2] if len(sys.argv) > 2 else HOSPITAL_PACK_PATH
+
+    rows = build_hospital_pack(load_hospital_table(csv_path), csv_path, output)
+    print(f"Wrote {rows} hospitals from {csv_path} to {output} ({os.path.getsize(output)} bytes)")
+
+
+if __name__ == '__main__':
+    main()
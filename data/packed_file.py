@@ -0,0 +1,70 @@
+import mmap
+import os
+
+import numpy as np
+
+
+
+'''
+Memory-mapped files of named sections, shared by hospital_data.bin
+(data/hospital_pack.py) and travel_grid.bin (data/travel_grid.py)
+
+A file is a fixed struct header (magic, version, the format's own fields,
+then an (offset, count) pair per section) followed by the sections, each
+8-byte aligned so numpy can view them in place. Counts are in elements for
+arrays and in bytes for raw sections. Files are written to a temporary name
+and renamed into place, so processes that have the old file mapped are
+unaffected.
+'''
+
+
+def write_packed_file(output, header, fields, section_names, sections):
+    """
+    Write `sections` (numpy arrays or bytes, by name) in `section_names` order
+    after `header`, packed from `fields` followed by the section layout
+    """
+    # Lay sections out after the header, each 8-byte aligned
+    layout = []
+    body = bytearray()
+    for name in section_names:
+        data = sections[name]
+        raw = data if isinstance(data, bytes) else data.tobytes()
+        body.extend(b'\0' * (-(header.size + len(body)) % 8))
+        layout.extend([header.size + len(body), len(data)])
+        body.extend(raw)
+
+    # Write then rename, so processes that have the old file mapped are unaffected
+    tmp_path = f"{output}.tmp{os.getpid()}"
+    with open(tmp_path, 'wb') as f:
+        f.write(header.pack(*fields, *layout))
+        f.write(body)
+    os.replace(tmp_path, output)
+
+
+class PackedFile:
+    """
+    A file written by write_packed_file, mapped read-only. `fields` are the
+    header fields before the layout (magic and version first); raises
+    ValueError if the magic or version don't match.
+    """
+
+    def __init__(self, path, header, section_names, magic, version, kind):
+        with open(path, 'rb') as f:
+            self.buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        fields = header.unpack_from(self.buf, 0)
+        layout_start = len(fields) - 2 * len(section_names)
+        self.fields = fields[:layout_start]
+        if self.fields[0] != magic or self.fields[1] != version:
+            raise ValueError(f"{path} is not a version {version} {kind}")
+        self.layout = dict(zip(section_names, zip(fields[layout_start::2], fields[layout_start + 1::2])))
+
+    def array(self, name, dtype):
+        """A section as a numpy view of the mapping"""
+        offset, count = self.layout[name]
+        return np.frombuffer(self.buf, dtype=dtype, count=count, offset=offset)
+
+    def raw(self, name):
+        """A bytes section"""
+        offset, count = self.layout[name]
+        return self.buf[offset:offset + count]
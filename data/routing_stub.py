@@ -0,0 +1,123 @@
+import argparse
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+from data.spatial_scan import haversine_distance
+
+
+
+'''
+Local stand-in for the Distance Matrix API
+
+Answers Distance Matrix requests whose origins and destinations are
+"lat,lng" pairs with made-up but plausible driving times: straight-line
+distance times a road factor, at a speed that drops in the rush hours of
+`departure_time`. Anything else (addresses) comes back NOT_FOUND. Used to run
+and test the travel-grid job without a Google key or quota:
+
+    python -m data.routing_stub --port 8900
+    python -m data.travel_grid build --origins searches.csv \\
+        --routing-url http://127.0.0.1:8900/maps/api/distancematrix/json
+'''
+
+
+ROAD_FACTOR = 1.3
+SPEED_KMH = 40
+RUSH_HOUR_SPEED_KMH = 25
+RUSH_HOURS = ((7, 10), (16, 19))
+
+
+def parse_point(value):
+    try:
+        lat, lng = (float(part) for part in value.split(','))
+        return lat, lng
+    except ValueError:
+        return None
+
+
+def element(origin, destination, departure_time):
+    if origin is None or destination is None:
+        return {"status": "NOT_FOUND"}
+
+    km = haversine_distance(*origin, *destination) * ROAD_FACTOR
+    speed = SPEED_KMH
+    if departure_time is not None:
+        hour = time.localtime(departure_time).tm_hour
+        if any(start <= hour < end for start, end in RUSH_HOURS):
+            speed = RUSH_HOUR_SPEED_KMH
+    free_flow = round(km / SPEED_KMH * 3600)
+    result = {
+        "status": "OK",
+        "distance": {"value": round(km * 1000), "text": f"{km:.1f} km"},
+        "duration": {"value": free_flow, "text": f"{free_flow // 60} mins"},
+    }
+    if departure_time is not None:
+        in_traffic = round(km / speed * 3600)
+        result["duration_in_traffic"] = {"value": in_traffic, "text": f"{in_traffic // 60} mins"}
+    return result
+
+
+def distance_matrix(params):
+    origins = params.get('origins', [''])[0].split('|')
+    destinations = params.get('destinations', [''])[0].split('|')
+    departure_time = params.get('departure_time', [None])[0]
+    departure_time = int(departure_time) if departure_time not in (None, 'now') else None
+
+    if not origins[0] or not destinations[0]:
+        return {"status": "INVALID_REQUEST", "rows": []}
+    return {
+        "status": "OK",
+        "origin_addresses": origins,
+        "destination_addresses": destinations,
+        "rows": [
+            {"elements": [element(parse_point(o), parse_point(d), departure_time) for d in destinations]}
+            for o in origins
+        ],
+    }
+
+
+class RoutingStubHandler(BaseHTTPRequestHandler):
+    requests_served = 0
+    _lock = threading.Lock()
+
+    def do_GET(self):
+        with self._lock:
+            RoutingStubHandler.requests_served += 1
+        url = urlparse(self.path)
+        body = json.dumps(distance_matrix(parse_qs(url.query))).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve(host='127.0.0.1', port=8900):
+    """Start the stub on a background thread; returns the server (call shutdown() to stop)"""
+    server = ThreadingHTTPServer((host, port), RoutingStubHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Local stand-in for the Distance Matrix API")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8900)
+    args = parser.parse_args()
+
+    server = ThreadingHTTPServer((args.host, args.port), RoutingStubHandler)
+    print(f"Routing stub on http://{args.host}:{args.port}/maps/api/distancematrix/json")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
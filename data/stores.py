@@ -0,0 +1,290 @@
+import csv
+import os
+import threading
+import time
+
+import numpy as np
+
+from data.ae_catalogue import load_ae_catalogue
+from data.hospital_matcher import HospitalNameMatcher
+from data.hospital_pack import HOSPITAL_PACK_PATH, PackedNameMatcher, load_hospital_pack
+from data.spatial_scan import SpatialScan
+from data.travel_grid import TravelGrid
+from data.wait_profiles import PROFILE_COLUMNS, build_wait_profiles
+from metrics import span
+
+
+
+'''
+Resident in-memory stores for the data files
+
+Parsing uses the csv module and plain lists/arrays, so a worker never imports
+pandas or scipy just to serve requests.
+
+Each store parses its file once and keeps the result for the lifetime of the
+process. Accesses check (at most every `check_interval` seconds) whether the
+file changed on disk and, if so, swap in a freshly parsed copy. A failed reload
+keeps serving the previous copy.
+'''
+
+
+DATA_DIR = os.path.dirname(os.path.abspath(__file__))
+HOSPITAL_DATA_PATH = os.path.join(DATA_DIR, 'hospital_data.csv')
+VETS_GEOCODED_PATH = os.path.join(DATA_DIR, 'vets_data_geocoded.csv')
+VETS_PATH = os.path.join(DATA_DIR, 'vets_data.csv')
+
+
+class FileBackedStore:
+    def __init__(self, path, check_interval=1.0):
+        self.path = path
+        self.check_interval = check_interval
+        self.version = 0
+        self._data = None
+        self._signature = None
+        self._last_check = 0.0
+        self._derived = {}
+        self._lock = threading.RLock()
+
+    def load(self, path):
+        """Parse the file at `path`. Subclasses override this."""
+        raise NotImplementedError
+
+    def _file_signature(self):
+        st = os.stat(self.path)
+        return (st.st_mtime_ns, st.st_size)
+
+    def get(self):
+        """Return the current parsed data, reloading it if the file changed"""
+        now = time.monotonic()
+        if self._data is not None and now - self._last_check < self.check_interval:
+            return self._data
+
+        with self._lock:
+            if self._data is not None and now - self._last_check < self.check_interval:
+                return self._data
+            self._last_check = now
+
+            try:
+                signature = self._file_signature()
+            except OSError as e:
+                if self._data is None:
+                    raise
+                print(f"Could not stat {self.path}, keeping loaded copy: {e}")
+                return self._data
+
+            if signature != self._signature:
+                try:
+                    with span(f"load:{os.path.basename(self.path)}"):
+                        data = self.load(self.path)
+                except Exception as e:
+                    if self._data is None:
+                        raise
+                    print(f"Could not reload {self.path}, keeping loaded copy: {e}")
+                    return self._data
+                # Swap in one assignment so readers see either the old or the new copy
+                self._data = data
+                self._signature = signature
+                self._derived = {}
+                self.version += 1
+
+            return self._data
+
+    def derived(self, key, builder):
+        """
+        Return `builder(data)` for the current data, building it at most once
+        per loaded version of the file.
+        """
+        data = self.get()
+        entry = self._derived.get(key)
+        if entry is not None and entry[0] is data:
+            return entry[1]
+
+        with self._lock:
+            entry = self._derived.get(key)
+            if entry is not None and entry[0] is data:
+                return entry[1]
+            value = builder(data)
+            self._derived[key] = (data, value)
+            return value
+
+
+class HospitalTable:
+    """
+    hospital_data.csv as two columns: `table['hospital_name']` is a list of
+    names and `table['avg_wait_time']` a float array, in file order.
+    `profiles` is a (hospitals, 24) array of hourly waits (NaN rows for
+    hospitals without one), or None if the file has no profile columns.
+    """
+
+    def __init__(self, names, avg_waits, profiles=None):
+        self.names = list(names)
+        self.avg_waits = np.asarray(avg_waits, dtype=float)
+        self.profiles = None if profiles is None else np.asarray(profiles, dtype=float)
+        # First row wins, like the `.iloc[0]` lookups this replaces
+        self.positions = {}
+        for position, name in enumerate(self.names):
+            self.positions.setdefault(name, position)
+
+    def __getitem__(self, column):
+        if column == 'hospital_name':
+            return self.names
+        if column == 'avg_wait_time':
+            return self.avg_waits
+        raise KeyError(column)
+
+    def __len__(self):
+        return len(self.names)
+
+    def position(self, hospital_name):
+        """Row of the first hospital with this exact name; KeyError if none"""
+        return self.positions[hospital_name]
+
+    def avg_wait(self, hospital_name):
+        """Base average wait (hours) for an exact dataset hospital name"""
+        return float(self.avg_waits[self.position(hospital_name)])
+
+
+def _float_or_nan(value):
+    return float(value) if value else float('nan')
+
+
+def load_hospital_table(path=HOSPITAL_DATA_PATH):
+    names, waits, profiles = [], [], []
+    with open(path, 'r', encoding='utf-8-sig') as f:
+        reader = csv.DictReader(f)
+        has_profiles = set(PROFILE_COLUMNS) <= set(reader.fieldnames or ())
+        for row in reader:
+            names.append(row['hospital_name'])
+            waits.append(_float_or_nan(row['avg_wait_time']))
+            if has_profiles:
+                profiles.append([_float_or_nan(row[column]) for column in PROFILE_COLUMNS])
+    return HospitalTable(names, waits, np.array(profiles, dtype=float).reshape(-1, 24) if has_profiles else None)
+
+
+class HospitalStore(FileBackedStore):
+    """
+    hospital_data.csv, served from the memory-mapped hospital_data.bin when
+    that was built from the current CSV (HOSPITAL_PACK=0 always parses the CSV)
+    """
+
+    def __init__(self, path, pack_path=None, use_pack=True, check_interval=1.0):
+        super().__init__(path, check_interval)
+        self.pack_path = pack_path
+        self.use_pack = use_pack
+
+    def _file_signature(self):
+        # Rebuilding the pack also counts as a change
+        signature = super()._file_signature()
+        if self.use_pack and self.pack_path and os.path.exists(self.pack_path):
+            st = os.stat(self.pack_path)
+            signature += (st.st_mtime_ns, st.st_size)
+        return signature
+
+    def load(self, path):
+        if self.use_pack and self.pack_path:
+            pack = load_hospital_pack(path, self.pack_path)
+            if pack is not None:
+                return pack
+        return load_hospital_table(path)
+
+    def avg_wait(self, hospital_name):
+        """Base average wait (hours) for an exact dataset hospital name"""
+        return self.get().avg_wait(hospital_name)
+
+    def matcher(self):
+        """Name matcher over the current dataset, rebuilt when the file changes"""
+        return self.derived('matcher', _build_matcher)
+
+    def wait_profiles(self):
+        """Spline coefficients of the hourly profiles (None without any), rebuilt when the file changes"""
+        return self.derived('wait_profiles', build_wait_profiles)
+
+    def weekly_forecast(self):
+        """Hospital x hour-of-week table, loaded from disk or built on first use"""
+        from data.weekly_forecast import load_or_build_weekly_forecast
+        return self.derived('weekly_forecast', load_or_build_weekly_forecast)
+
+
+def _build_matcher(hospital_data):
+    if isinstance(hospital_data, HospitalTable):
+        return HospitalNameMatcher(hospital_data['hospital_name'])
+    # A HospitalPack carries the matcher index already
+    return PackedNameMatcher(hospital_data)
+
+
+class VetDirectory:
+    """Parsed vet list plus a nearest-neighbour scan over the vets that have coordinates"""
+
+    def __init__(self, vets):
+        self.vets = vets
+        self.located = [vet for vet in vets if 'lat' in vet and 'lng' in vet]
+        self.unlocated = [vet for vet in vets if 'lat' not in vet or 'lng' not in vet]
+        self.index = SpatialScan([v['lat'] for v in self.located], [v['lng'] for v in self.located])
+
+    def nearest(self, latitude, longitude, k):
+        """Copies of the k nearest located vets with 'straight_line_distance' (km)"""
+        positions, distances = self.index.nearest(float(latitude), float(longitude), k)
+        nearest = []
+        for position, distance in zip(positions, distances):
+            vet = dict(self.located[position])
+            vet['straight_line_distance'] = float(distance)
+            nearest.append(vet)
+        return nearest
+
+
+class VetStore(FileBackedStore):
+    def __init__(self, path, geocodes=None, check_interval=1.0):
+        super().__init__(path, check_interval)
+        self.geocodes = geocodes
+
+    def load(self, path):
+        vets = []
+        with open(path, 'r', encoding='utf-8') as f:
+            reader = csv.DictReader(f)
+            for row in reader:
+                vet_data = {
+                    'hospital': row['Hospital Name'],
+                    'address': row['Address']
+                }
+                # Add coordinates if available
+                if row.get('Latitude') and row.get('Longitude'):
+                    try:
+                        vet_data['lat'] = float(row['Latitude'])
+                        vet_data['lng'] = float(row['Longitude'])
+                    except (ValueError, KeyError):
+                        pass
+                vets.append(vet_data)
+
+        # Otherwise use the geocode store, without calling the API (one query for all of them)
+        unlocated = [vet for vet in vets if 'lat' not in vet]
+        if unlocated and self.geocodes is not None:
+            stored = self.geocodes.lookup_many(vet['address'] for vet in unlocated)
+            for vet in unlocated:
+                lat, lng = stored.get(vet['address'], (None, None))
+                if lat is not None:
+                    vet['lat'], vet['lng'] = lat, lng
+
+        return VetDirectory(vets)
+
+
+class AECatalogueStore(FileBackedStore):
+    def load(self, path):
+        return load_ae_catalogue(path)
+
+    def available(self):
+        return os.path.exists(self.path)
+
+
+class TravelGridStore(FileBackedStore):
+    def load(self, path):
+        return TravelGrid(path)
+
+    def available(self):
+        return os.path.exists(self.path)
+
+
+hospital_store = HospitalStore(
+    HOSPITAL_DATA_PATH,
+    pack_path=HOSPITAL_PACK_PATH,
+    use_pack=os.getenv("HOSPITAL_PACK", "1") == "1",
+)
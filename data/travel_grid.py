@@ -0,0 +1,413 @@
+import argparse
+import csv
+import math
+import os
+import struct
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+import numpy as np
+
+from cache import METRES_PER_DEGREE_LAT
+from data.ae_catalogue import AE_CATALOGUE_PATH, load_ae_catalogue
+from data.packed_file import PackedFile, write_packed_file
+from data.spatial_scan import EARTH_RADIUS_KM, to_unit_sphere
+from http_client import TokenBucket, get
+
+
+
+'''
+Precomputed travel times from origin cells to their nearest A&E sites
+
+An offline job lays a grid of origin cells over a region, finds the K nearest
+sites of the A&E catalogue to each cell centre, and asks a routing service
+(the Distance Matrix API, or a stub: data/routing_stub.py) for the driving
+time from the centre to each of them at a few times of day. The result is
+written to travel_grid.bin (a data/packed_file.py file): sorted cell ids plus
+fixed-size uint16/uint32 arrays, memory-mapped read-only by every worker.
+
+    python -m data.travel_grid build --origins searches.csv
+    python -m data.travel_grid build --bounds 51.28,-0.51,51.69,0.33 --cell 500
+    python -m data.travel_grid lookup 51.5074 -0.1278
+
+Only cells that were routed are stored, so the file stays small when the
+job is pointed at the places searches actually come from (--origins, a CSV
+of latitude/longitude points). At request time the hospital search reads the
+cell first and only routes live for sites the cell doesn't cover, or when the
+cell is missing or older than the allowed age.
+
+Routing calls are billed, so a build needs --origins or an explicit --bounds,
+and stops before routing anything if it would make more than --max-requests
+calls.
+'''
+
+
+DATA_DIR = os.path.dirname(os.path.abspath(__file__))
+TRAVEL_GRID_PATH = os.getenv("TRAVEL_GRID_PATH", os.path.join(DATA_DIR, 'travel_grid.bin'))
+ROUTING_URL = os.getenv("ROUTING_URL", "https://maps.googleapis.com/maps/api/distancematrix/json")
+
+# Mainland UK, as (south, west, north, east)
+DEFAULT_BOUNDS = (49.8, -8.7, 60.9, 1.8)
+DEFAULT_CELL_METRES = 1000
+DEFAULT_K = 5
+# Start hours of the time-of-day buckets; rush hours get their own (as in travel_time_ttl)
+DEFAULT_BUCKETS = (0, 7, 10, 16, 19)
+# Cells whose nearest site is further away than this are skipped
+DEFAULT_MAX_KM = 40
+# Routing calls are billed, so a build asking for more than this stops before routing
+DEFAULT_MAX_REQUESTS = 10000
+
+NO_SITE = 0xFFFF
+NO_DURATION = 0xFFFF
+
+MAGIC = b'TRAVGRID'
+VERSION = 1
+
+# magic, version, rows, cols, k, cell size (m), south, west, lat step, lng step,
+# then (offset, count) of each section
+SECTIONS = [
+    'bucket_starts',  # uint8[buckets] start hour of each bucket, ascending from 0
+    'cell_ids',       # uint32[cells] row * cols + col, ascending
+    'computed_at',    # uint32[cells] unix time the cell was routed
+    'sites',          # uint16[cells * k] catalogue positions, nearest first
+    'durations',      # uint16[cells * buckets * k] seconds
+    'distances',      # uint32[cells * buckets * k] metres
+    'site_names',     # utf-8 catalogue hospital names, newline separated
+]
+HEADER = struct.Struct('<8sIIII5d' + 'QQ' * len(SECTIONS))
+
+
+class GridSpec:
+    """
+    Cells of `cell_metres` over a bounding box. Longitude steps are sized for
+    the box's middle latitude, so cells are square there and slightly
+    stretched towards its north and south edges.
+    """
+
+    def __init__(self, south, west, lat_step, lng_step, rows, cols):
+        self.south, self.west = south, west
+        self.lat_step, self.lng_step = lat_step, lng_step
+        self.rows, self.cols = rows, cols
+
+    @classmethod
+    def over(cls, bounds, cell_metres):
+        south, west, north, east = bounds
+        lat_step = cell_metres / METRES_PER_DEGREE_LAT
+        lng_step = cell_metres / (METRES_PER_DEGREE_LAT * math.cos(math.radians((south + north) / 2)))
+        rows = max(1, math.ceil((north - south) / lat_step))
+        cols = max(1, math.ceil((east - west) / lng_step))
+        return cls(south, west, lat_step, lng_step, rows, cols)
+
+    def cell_id(self, latitude, longitude):
+        """Id of the cell containing a point, or None outside the grid"""
+        row = math.floor((float(latitude) - self.south) / self.lat_step)
+        col = math.floor((float(longitude) - self.west) / self.lng_step)
+        if not (0 <= row < self.rows and 0 <= col < self.cols):
+            return None
+        return row * self.cols + col
+
+    def centres(self, cell_ids):
+        """(latitudes, longitudes) of the centres of cells"""
+        rows, cols = np.divmod(np.asarray(cell_ids, dtype=np.int64), self.cols)
+        return self.south + (rows + 0.5) * self.lat_step, self.west + (cols + 0.5) * self.lng_step
+
+
+def bucket_for_hour(bucket_starts, hour):
+    return int(np.searchsorted(bucket_starts, hour, side='right')) - 1
+
+
+def departure_times(bucket_starts, now=None):
+    """
+    Unix departure time for each bucket: the middle of the bucket on the next
+    Wednesday (a typical weekday, and in the future as the routing API needs)
+    """
+    now = now or datetime.now()
+    days_ahead = (2 - now.weekday()) % 7 or 7
+    wednesday = (now + timedelta(days=days_ahead)).replace(hour=0, minute=0, second=0, microsecond=0)
+    ends = list(bucket_starts[1:]) + [24]
+    return [int((wednesday + timedelta(hours=(start + end) / 2)).timestamp())
+            for start, end in zip(bucket_starts, ends)]
+
+
+def nearest_sites(index, latitudes, longitudes, k, chunk=4096):
+    """
+    (points, k) catalogue positions nearest first, and their distances in km,
+    for many points at once
+    """
+    k = min(k, index.size)
+    queries = to_unit_sphere(latitudes, longitudes)
+    positions = np.empty((len(queries), k), dtype=np.int64)
+    distances = np.empty((len(queries), k))
+    for start in range(0, len(queries), chunk):
+        chord_sq = np.maximum(2.0 - 2.0 * (queries[start:start + chunk] @ index.points.T), 0.0)
+        if k < index.size:
+            nearest = np.argpartition(chord_sq, k - 1, axis=1)[:, :k]
+        else:
+            nearest = np.broadcast_to(np.arange(index.size), chord_sq.shape)
+        order = np.argsort(np.take_along_axis(chord_sq, nearest, axis=1), axis=1, kind='stable')
+        nearest = np.take_along_axis(nearest, order, axis=1)
+        chord = np.sqrt(np.take_along_axis(chord_sq, nearest, axis=1))
+        positions[start:start + chunk] = nearest
+        distances[start:start + chunk] = 2 * EARTH_RADIUS_KM * np.arcsin(np.clip(chord / 2, 0, 1))
+    return positions, distances
+
+
+def select_cells(spec, catalogue, origins=None, max_km=DEFAULT_MAX_KM, chunk_rows=256):
+    """
+    Ids of the cells to route: the cells containing `origins` if given,
+    otherwise every cell in the grid within max_km of a site
+    """
+    if origins is not None:
+        ids = {spec.cell_id(lat, lng) for lat, lng in origins}
+        ids.discard(None)
+        return np.array(sorted(ids), dtype=np.int64)
+
+    selected = []
+    for row in range(0, spec.rows, chunk_rows):
+        ids = np.arange(row * spec.cols, min(spec.rows, row + chunk_rows) * spec.cols)
+        _, distances = nearest_sites(catalogue.index, *spec.centres(ids), 1)
+        selected.append(ids[distances[:, 0] <= max_km])
+    return np.concatenate(selected) if selected else np.empty(0, dtype=np.int64)
+
+
+def route(origin, destinations, departure_time, api_key, routing_url=ROUTING_URL):
+    """
+    Driving (duration s, distance m) from one origin to each destination
+    (all "lat,lng"), None where there is no route. Traffic-aware durations are
+    used when the service returns them.
+    """
+    params = {
+        "origins": origin,
+        "destinations": "|".join(destinations),
+        "mode": "driving",
+        "departure_time": departure_time,
+        "key": api_key,
+    }
+    r = get(routing_url, params=params)
+    r.raise_for_status()
+    data = r.json()
+    if data["status"] != "OK":
+        raise RuntimeError(data["status"])
+
+    results = []
+    for element in data["rows"][0]["elements"]:
+        if element["status"] != "OK":
+            results.append(None)
+            continue
+        duration = element.get("duration_in_traffic", element["duration"])["value"]
+        results.append((duration, element["distance"]["value"]))
+    return results
+
+
+def build_travel_grid(catalogue, spec, cell_ids, api_key, k=DEFAULT_K, bucket_starts=DEFAULT_BUCKETS,
+                      output=TRAVEL_GRID_PATH, routing_url=ROUTING_URL, workers=8, rate=10.0):
+    """Route every (cell, bucket) and write the grid; returns the number of cells stored"""
+    bucket_starts = np.asarray(sorted(bucket_starts), dtype='<u1')
+    if len(bucket_starts) == 0 or bucket_starts[0] != 0:
+        raise ValueError("time-of-day buckets must start at hour 0")
+    cell_ids = np.asarray(cell_ids, dtype=np.int64)
+    k = min(k, len(catalogue.sites))
+
+    latitudes, longitudes = spec.centres(cell_ids)
+    sites, _ = nearest_sites(catalogue.index, latitudes, longitudes, k)
+    durations = np.full((len(cell_ids), len(bucket_starts), k), NO_DURATION, dtype='<u2')
+    distances = np.zeros((len(cell_ids), len(bucket_starts), k), dtype='<u4')
+    departures = departure_times(bucket_starts)
+    bucket = TokenBucket(rate)
+
+    def route_cell(job):
+        """Fill one (cell, bucket) of the arrays; False if the request failed"""
+        cell, b = job
+        destinations = [f"{catalogue.sites[s]['lat']},{catalogue.sites[s]['lng']}" for s in sites[cell]]
+        bucket.acquire()
+        try:
+            results = route(f"{latitudes[cell]},{longitudes[cell]}", destinations, departures[b],
+                            api_key, routing_url)
+        except Exception as e:
+            print(f"Error routing cell {cell_ids[cell]} bucket {b}: {e}")
+            return False
+        for i, result in enumerate(results):
+            if result is not None:
+                durations[cell, b, i] = min(result[0], NO_DURATION - 1)
+                distances[cell, b, i] = result[1]
+        return True
+
+    jobs = [(cell, b) for cell in range(len(cell_ids)) for b in range(len(bucket_starts))]
+    print(f"Routing {len(cell_ids)} cells x {len(bucket_starts)} time buckets ({len(jobs)} requests)")
+    failed = 0
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+        for done, ok in enumerate(pool.map(route_cell, jobs), 1):
+            failed += not ok
+            if done % 1000 == 0:
+                print(f"  {done}/{len(jobs)} requests")
+    if failed:
+        print(f"{failed} requests failed; those cells fall back to live routing")
+
+    # Cells nothing could be routed for are left out, so they count as missing
+    keep = (durations != NO_DURATION).any(axis=(1, 2))
+    write_travel_grid(output, spec, k, bucket_starts, cell_ids[keep], sites[keep], durations[keep],
+                      distances[keep], [site['hospital_name'] for site in catalogue.sites])
+    return int(keep.sum())
+
+
+def write_travel_grid(output, spec, k, bucket_starts, cell_ids, sites, durations, distances, site_names,
+                      computed_at=None):
+    computed_at = int(time.time()) if computed_at is None else computed_at
+    sections = {
+        'bucket_starts': np.asarray(bucket_starts, dtype='<u1'),
+        'cell_ids': np.asarray(cell_ids, dtype='<u4'),
+        'computed_at': np.full(len(cell_ids), computed_at, dtype='<u4'),
+        'sites': np.asarray(sites, dtype='<u2').ravel(),
+        'durations': np.asarray(durations, dtype='<u2').ravel(),
+        'distances': np.asarray(distances, dtype='<u4').ravel(),
+        'site_names': '\n'.join(site_names).encode('utf-8'),
+    }
+
+    fields = (MAGIC, VERSION, spec.rows, spec.cols, k, spec.lat_step * METRES_PER_DEGREE_LAT,
+              spec.south, spec.west, spec.lat_step, spec.lng_step)
+    write_packed_file(output, HEADER, fields, SECTIONS, sections)
+
+
+class TravelGrid:
+    """A mapped travel_grid.bin"""
+
+    def __init__(self, path=TRAVEL_GRID_PATH):
+        self.path = path
+        packed = PackedFile(path, HEADER, SECTIONS, MAGIC, VERSION, 'travel grid')
+        _, _, rows, cols, self.k, self.cell_metres, south, west, lat_step, lng_step = packed.fields
+        self.spec = GridSpec(south, west, lat_step, lng_step, rows, cols)
+        array = packed.array
+
+        self.bucket_starts = array('bucket_starts', '<u1')
+        self.cell_ids = array('cell_ids', '<u4')
+        self.computed_at = array('computed_at', '<u4')
+        buckets = len(self.bucket_starts)
+        self.sites = array('sites', '<u2').reshape(-1, self.k)
+        self.durations = array('durations', '<u2').reshape(-1, buckets, self.k)
+        self.distances = array('distances', '<u4').reshape(-1, buckets, self.k)
+        self.site_names = packed.raw('site_names').decode('utf-8').split('\n')
+
+    def __len__(self):
+        return len(self.cell_ids)
+
+    def _position(self, latitude, longitude):
+        cell_id = self.spec.cell_id(latitude, longitude)
+        if cell_id is None:
+            return None
+        position = int(np.searchsorted(self.cell_ids, cell_id))
+        if position < len(self.cell_ids) and self.cell_ids[position] == cell_id:
+            return position
+        return None
+
+    def lookup(self, latitude, longitude, when=None, max_age=None):
+        """
+        {catalogue hospital name: {'duration': s, 'distance': m}} for the
+        cell containing the point at the time of day of `when` (default now),
+        or None if the cell is missing or older than max_age seconds
+        """
+        position = self._position(latitude, longitude)
+        if position is None:
+            return None
+        if max_age is not None and time.time() - int(self.computed_at[position]) > max_age:
+            return None
+
+        when = when or datetime.now()
+        b = bucket_for_hour(self.bucket_starts, when.hour)
+        times = {}
+        for site, duration, distance in zip(self.sites[position], self.durations[position, b],
+                                            self.distances[position, b]):
+            if site != NO_SITE and duration != NO_DURATION:
+                times[self.site_names[site]] = {'duration': int(duration), 'distance': int(distance)}
+        return times
+
+
+def read_origins(path):
+    """(lat, lng) points from a CSV with latitude/longitude (or lat/lng) columns"""
+    points = []
+    with open(path, 'r', encoding='utf-8-sig') as f:
+        for row in csv.DictReader(f):
+            try:
+                points.append((float(row.get('latitude', row.get('lat'))),
+                               float(row.get('longitude', row.get('lng')))))
+            except (TypeError, ValueError):
+                continue
+    return points
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Precomputed origin cell -> nearest A&E travel times")
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    build = commands.add_parser('build', help="route the grid and write travel_grid.bin")
+    build.add_argument('--bounds', help="south,west,north,east of the grid; required without --origins [mainland UK]")
+    build.add_argument('--cell', type=float, default=DEFAULT_CELL_METRES, help="cell size in metres [1000]")
+    build.add_argument('--origins', help="CSV of latitude/longitude points; only their cells are routed")
+    build.add_argument('--max-km', type=float, default=DEFAULT_MAX_KM,
+                       help="without --origins, skip cells with no site this close [40]")
+    build.add_argument('--k', type=int, default=DEFAULT_K, help="nearest sites per cell [5]")
+    build.add_argument('--buckets', default=','.join(map(str, DEFAULT_BUCKETS)),
+                       help="start hours of the time-of-day buckets [0,7,10,16,19]")
+    build.add_argument('--catalogue', default=AE_CATALOGUE_PATH)
+    build.add_argument('--output', default=TRAVEL_GRID_PATH)
+    build.add_argument('--routing-url', default=ROUTING_URL, help="Distance Matrix compatible endpoint")
+    build.add_argument('--workers', type=int, default=8, help="concurrent routing requests [8]")
+    build.add_argument('--rate', type=float, default=10.0, help="routing requests per second, 0 for no limit [10]")
+    build.add_argument('--max-requests', type=int, default=DEFAULT_MAX_REQUESTS,
+                       help=f"refuse to build if more routing requests than this are needed [{DEFAULT_MAX_REQUESTS}]")
+
+    lookup = commands.add_parser('lookup', help="print the stored travel times for a point")
+    lookup.add_argument('latitude', type=float)
+    lookup.add_argument('longitude', type=float)
+    lookup.add_argument('--hour', type=int, help="hour of day [now]")
+    lookup.add_argument('--grid', default=TRAVEL_GRID_PATH)
+
+    args = parser.parse_args()
+
+    if args.command == 'lookup':
+        grid = TravelGrid(args.grid)
+        when = None if args.hour is None else datetime.now().replace(hour=args.hour)
+        times = grid.lookup(args.latitude, args.longitude, when)
+        if times is None:
+            print("No cell stored for this point")
+            return
+        for name, info in times.items():
+            print(f"{name:50} {info['duration'] / 60:6.1f} min {info['distance'] / 1000:7.1f} km")
+        return
+
+    if args.bounds is None and args.origins is None:
+        print("Routing every cell of mainland UK is hundreds of thousands of requests; "
+              "pass --origins, or --bounds for a smaller region")
+        sys.exit(1)
+
+    from dotenv import load_dotenv
+    load_dotenv(os.path.join(DATA_DIR, '..', '.env'))
+
+    if not os.path.exists(args.catalogue):
+        print(f"No A&E catalogue at {args.catalogue}; build it with python -m data.ae_catalogue")
+        sys.exit(1)
+    catalogue = load_ae_catalogue(args.catalogue)
+    bounds = tuple(float(v) for v in args.bounds.split(',')) if args.bounds else DEFAULT_BOUNDS
+    spec = GridSpec.over(bounds, args.cell)
+    origins = read_origins(args.origins) if args.origins else None
+    cell_ids = select_cells(spec, catalogue, origins, args.max_km)
+
+    bucket_starts = [int(h) for h in args.buckets.split(',')]
+    requests = len(cell_ids) * len(bucket_starts)
+    if requests > args.max_requests:
+        print(f"{len(cell_ids)} cells x {len(bucket_starts)} time buckets is {requests} routing requests, "
+              f"over --max-requests {args.max_requests}; use a smaller region, larger cells or fewer buckets, "
+              f"or raise --max-requests")
+        sys.exit(1)
+
+    stored = build_travel_grid(
+        catalogue, spec, cell_ids, os.getenv("GOOGLE_API_KEY"), k=args.k,
+        bucket_starts=bucket_starts, output=args.output,
+        routing_url=args.routing_url, workers=args.workers, rate=args.rate,
+    )
+    print(f"Wrote {stored} cells to {args.output} ({os.path.getsize(args.output)} bytes)")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,127 @@
+import base64
+from datetime import datetime, timedelta
+
+import numpy as np
+
+from data.stores import hospital_store
+
+
+
+'''
+Bulk wait predictions: many hospitals over a forecast horizon
+
+    predict_waits(["Royal London Hospital", 12, "St Thomas' Hospital"], hours=24)
+
+Names are resolved once through the store's name matcher; integers are row
+ids in hospital_data.csv. The whole hospital x hour matrix is one lookup in
+the precomputed weekly forecast table, and every cell equals what the
+single-hospital prediction (`get_predicted_wait_time` in app.py) gives at
+that hour.
+'''
+
+
+def week_hour(when):
+    """Hours since the start of the week (Monday 00:00), the predictor's time counter"""
+    return when.hour + when.weekday() * 24
+
+
+def resolve_hospitals(hospitals, store=None):
+    """
+    Map names or row ids to dataset rows in one pass.
+    Returns (rows, unmatched): rows as (query, row, dataset name) in request
+    order without duplicates, unmatched as the queries that found nothing.
+    """
+    if store is None:
+        store = hospital_store
+    hospital_data = store.get()
+    matcher = store.matcher()
+
+    rows, unmatched, seen = [], [], set()
+    for query in hospitals:
+        if isinstance(query, int) and not isinstance(query, bool):
+            row = query if 0 <= query < len(hospital_data) else None
+        elif isinstance(query, str):
+            row = matcher.match_index(query)
+        else:
+            row = None
+
+        if row is None:
+            unmatched.append(query)
+        elif row not in seen:
+            seen.add(row)
+            rows.append((query, row, hospital_data['hospital_name'][row]))
+    return rows, unmatched
+
+
+def predict_wait_matrix(rows, start_hour, hours, store=None):
+    """
+    (len(rows), hours) predicted waits in minutes (float, NaN if unknown) for
+    dataset rows, starting at `start_hour` hours into the week
+    """
+    if store is None:
+        store = hospital_store
+    hospital_data = store.get()
+    rows = np.asarray(rows, dtype=np.int64)
+    if len(rows) == 0 or hours == 0:
+        return np.empty((len(rows), hours))
+
+    # The week wraps like the per-request time counter
+    times = start_hour + np.arange(hours)
+    multipliers = store.weekly_forecast().predict_many(rows, times)
+
+    avg_waits = np.asarray(hospital_data['avg_wait_time'], dtype=float)[rows]
+    return avg_waits[:, None] * multipliers * 60
+
+
+def predict_waits(hospitals, hours=24, start=None, store=None):
+    """
+    Predicted waits (whole minutes, None if unknown) for each hospital over
+    the next `hours` hours, starting at the current hour.
+    """
+    if start is None:
+        start = datetime.now()
+    start = start.replace(minute=0, second=0, microsecond=0)
+
+    rows, unmatched = resolve_hospitals(hospitals, store)
+    minutes = predict_wait_matrix([row for _, row, _ in rows], week_hour(start), hours, store)
+
+    return {
+        'start': start.isoformat(),
+        'hours': [(start + timedelta(hours=h)).isoformat() for h in range(hours)],
+        'hospitals': [
+            {
+                'query': query,
+                'id': row,
+                'hospital': name,
+                'wait_times': [None if np.isnan(m) else int(round(m)) for m in minutes[i]],
+            }
+            for i, (query, row, name) in enumerate(rows)
+        ],
+        'unmatched': unmatched,
+    }
+
+
+def to_columnar(result):
+    """
+    Compact form of a predict_waits result: one list per field, and the
+    matrix as base64 little-endian int16 minutes, row-major, -1 for unknown
+    """
+    hospitals = result['hospitals']
+    matrix = np.array(
+        [[-1 if m is None else min(m, np.iinfo(np.int16).max) for m in h['wait_times']] for h in hospitals],
+        dtype='<i2',
+    ).reshape(len(hospitals), len(result['hours']))
+    return {
+        'start': result['start'],
+        'hours': len(result['hours']),
+        'ids': [h['id'] for h in hospitals],
+        'hospitals': [h['hospital'] for h in hospitals],
+        'queries': [h['query'] for h in hospitals],
+        'wait_times': {
+            'encoding': 'int16-le-base64',
+            'shape': list(matrix.shape),
+            'missing': -1,
+            'data': base64.b64encode(matrix.tobytes()).decode('ascii'),
+        },
+        'unmatched': result['unmatched'],
+    }
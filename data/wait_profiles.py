@@ -0,0 +1,114 @@
+import numpy as np
+
+
+
+'''
+Per-hospital 24-hour wait profiles
+
+hospital_data.csv may carry an hourly average wait per hospital in the
+optional columns wait_h00 ... wait_h23 (hours, like avg_wait_time). Rows with
+any of them empty have no profile and keep using avg_wait_time.
+
+Each profile is interpolated with the same natural cubic spline as
+`interpolate_hourly_wait_times` (the day repeated three times, plus a closing
+knot), but the piecewise coefficients for all hospitals are solved once with
+numpy when the data is loaded. Evaluating is then an index and a cubic
+polynomial for any number of hospitals and hours, with no scipy import and no
+per-request spline construction.
+'''
+
+
+HOURS_PER_DAY = 24
+PROFILE_COLUMNS = [f'wait_h{hour:02d}' for hour in range(HOURS_PER_DAY)]
+
+
+def _natural_spline_inverse(knots):
+    """
+    Inverse of the natural-spline system for `knots` evenly spaced knots (spacing 1),
+    mapping knot values to second derivatives at the knots
+    """
+    # m[i-1] + 4 m[i] + m[i+1] = 6 (y[i+1] - 2 y[i] + y[i-1]) inside, m = 0 at both ends
+    system = np.zeros((knots, knots))
+    second_difference = np.zeros((knots, knots))
+    system[0, 0] = system[-1, -1] = 1.0
+    for i in range(1, knots - 1):
+        system[i, i - 1:i + 2] = (1.0, 4.0, 1.0)
+        second_difference[i, i - 1:i + 2] = (6.0, -12.0, 6.0)
+    return np.linalg.solve(system, second_difference)
+
+
+# Knots at hours -24 ... 48, as in interpolate_hourly_wait_times
+_EXTENDED_KNOTS = 3 * HOURS_PER_DAY + 1
+_SECOND_DERIVATIVES = _natural_spline_inverse(_EXTENDED_KNOTS)
+
+
+def spline_coefficients(profiles):
+    """
+    (hospitals, 24, 4) cubic coefficients, highest power first, of the spline
+    through each (hospitals, 24) profile on each hour [h, h + 1)
+    """
+    profiles = np.asarray(profiles, dtype=float)
+    extended = np.concatenate([profiles, profiles, profiles, profiles[:, :1]], axis=1)
+    second = extended @ _SECOND_DERIVATIVES.T
+
+    # Intervals [0, 1) ... [23, 24) are knots 24 ... 47 of the extended day
+    start = HOURS_PER_DAY
+    y0 = extended[:, start:start + HOURS_PER_DAY]
+    y1 = extended[:, start + 1:start + HOURS_PER_DAY + 1]
+    m0 = second[:, start:start + HOURS_PER_DAY]
+    m1 = second[:, start + 1:start + HOURS_PER_DAY + 1]
+
+    return np.stack([
+        (m1 - m0) / 6,
+        m0 / 2,
+        (y1 - y0) - (2 * m0 + m1) / 6,
+        y0,
+    ], axis=-1)
+
+
+class WaitProfiles:
+    """Spline coefficients for the hospitals that have a profile, by data row"""
+
+    def __init__(self, profiles):
+        profiles = np.asarray(profiles, dtype=float)
+        self.has_profile = ~np.isnan(profiles).any(axis=1)
+        self.coefficients = np.zeros((len(profiles), HOURS_PER_DAY, 4))
+        if self.has_profile.any():
+            self.coefficients[self.has_profile] = spline_coefficients(profiles[self.has_profile])
+
+    def evaluate(self, hospital_indices, hours):
+        """
+        (len(hospital_indices), len(hours)) interpolated waits; hours are taken
+        modulo 24. Rows without a profile come out as NaN.
+        """
+        hospital_indices = np.asarray(hospital_indices)
+        hours = np.asarray(hours, dtype=float) % HOURS_PER_DAY
+        interval = np.minimum(hours.astype(np.int64), HOURS_PER_DAY - 1)
+        dx = hours - interval
+
+        c = self.coefficients[hospital_indices[:, None], interval[None, :]]
+        values = ((c[..., 0] * dx + c[..., 1]) * dx + c[..., 2]) * dx + c[..., 3]
+        values[~self.has_profile[hospital_indices]] = np.nan
+        return values
+
+    def interpolator(self, hospital_index):
+        """
+        `wait_time_interpolator` for estimate_business, or None if the
+        hospital has no profile
+        """
+        if not self.has_profile[hospital_index]:
+            return None
+        rows = np.array([hospital_index])
+
+        def interpolate(hour):
+            return float(self.evaluate(rows, np.atleast_1d(hour))[0, 0])
+
+        return interpolate
+
+
+def build_wait_profiles(hospital_data):
+    """WaitProfiles for a HospitalTable/HospitalPack, or None if it has no profiles"""
+    profiles = getattr(hospital_data, 'profiles', None)
+    if profiles is None or not (~np.isnan(profiles).any(axis=1)).any():
+        return None
+    return WaitProfiles(profiles)
@@ -0,0 +1,103 @@
+import hashlib
+import os
+import sys
+
+import numpy as np
+
+from data.ae_wait_predictor import estimate_business_batch
+from data.wait_profiles import build_wait_profiles
+
+
+
+'''
+Precomputed hospital x hour-of-week forecast table
+
+The per-request prediction (`run_all` at the hour of the week) only depends
+on the hospital and the hour, so it is materialized once as a
+(hospitals, 168) array. `get_predicted_wait_time` and the bulk predictions
+are then an index lookup, and give exactly what `run_all` gives.
+
+Build the table offline with:
+
+    python -m data.weekly_forecast
+
+or let `hospital_store.weekly_forecast()` build it in memory on first use.
+'''
+
+
+HOURS_PER_WEEK = 168
+WEEKLY_FORECAST_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'weekly_forecast.npz')
+
+
+def source_digest(hospital_df):
+    """Fingerprint of the inputs the table depends on: names, waits and hourly profiles"""
+    digest = hashlib.sha1()
+    digest.update('\n'.join(hospital_df['hospital_name']).encode('utf-8'))
+    digest.update(np.asarray(hospital_df['avg_wait_time'], dtype='<f4').tobytes())
+    profiles = getattr(hospital_df, 'profiles', None)
+    if profiles is not None:
+        digest.update(np.asarray(profiles, dtype='<f4').tobytes())
+    return digest.hexdigest()
+
+
+class WeeklyForecast:
+    def __init__(self, names, multipliers, source=None):
+        self.names = list(names)
+        self.source = source              # source_digest of the data it was built from
+        self.multipliers = multipliers    # (hospitals, 168) float64 run_all results
+        self.index = {name: i for i, name in reversed(list(enumerate(self.names)))}
+
+    def predict(self, hospital_index, current_time):
+        """Wait multiplier (as `run_all`) for one hospital row at `current_time` hours into the week"""
+        return float(self.multipliers[hospital_index, int(current_time) % HOURS_PER_WEEK])
+
+    def predict_many(self, hospital_indices, current_times):
+        """(hospitals, times) matrix of wait multipliers"""
+        hours_of_week = np.asarray(current_times, dtype=np.int64) % HOURS_PER_WEEK
+        return self.multipliers[np.asarray(hospital_indices)][:, hours_of_week]
+
+    def save(self, path=WEEKLY_FORECAST_PATH):
+        np.savez(path, names=np.array(self.names), multipliers=self.multipliers,
+                 source=np.array(self.source or ''))
+
+    @classmethod
+    def load(cls, path=WEEKLY_FORECAST_PATH):
+        with np.load(path) as data:
+            source = str(data['source']) if 'source' in data.files else None
+            return cls(data['names'].tolist(), data['multipliers'], source or None)
+
+
+def build_weekly_forecast(hospital_df):
+    """Materialize the weekly table for every row of `hospital_df`, with run_all's inputs"""
+    business = estimate_business_batch(
+        hospital_df, np.arange(len(hospital_df)), np.arange(HOURS_PER_WEEK),
+        wait_profiles=build_wait_profiles(hospital_df)
+    )
+    return WeeklyForecast(hospital_df['hospital_name'], business / 100, source_digest(hospital_df))
+
+
+def load_or_build_weekly_forecast(hospital_df, path=WEEKLY_FORECAST_PATH):
+    """Use the offline table if it was built from the same hospital data"""
+    if os.path.exists(path):
+        try:
+            forecast = WeeklyForecast.load(path)
+            if forecast.source == source_digest(hospital_df):
+                return forecast
+            print(f"{path} is out of date, rebuilding in memory")
+        except Exception as e:
+            # Including tables saved in an older format
+            print(f"Could not load {path}: {e}")
+    return build_weekly_forecast(hospital_df)
+
+
+def main():
+    from data.stores import hospital_store
+
+    output = sys.argv[1] if len(sys.argv) > 1 else WEEKLY_FORECAST_PATH
+    forecast = build_weekly_forecast(hospital_store.get())
+    forecast.save(output)
+    print(f"Wrote {len(forecast.names)} x {HOURS_PER_WEEK} weekly forecast to {output}")
+
+
+if __name__ == '__main__':
+    main()
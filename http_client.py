@@ -0,0 +1,394 @@
+import asyncio
+import os
+import random
+import threading
+import time
+import weakref
+from collections import Counter
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from urllib.parse import urlparse
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from metrics import Histogram, register_collector
+
+
+
+'''
+Shared outbound HTTP client
+
+Every call to Google and nhs.uk goes through `get`, which adds:
+- one keep-alive connection pool per host (connection and TLS session reuse)
+- connect and read timeouts, so a hung socket can't block a worker forever
+- bounded retries with exponential backoff and full jitter for connection
+  errors, timeouts, 429 and 5xx responses, waiting as long as a Retry-After
+  header asks (up to HTTP_RETRY_AFTER_MAX; longer and the response is returned)
+- a cap on concurrent requests per host
+- a per-host circuit breaker that fails fast while a dependency is down
+
+`async_client` does the same for asyncio code (the ASGI entry point) on top
+of httpx, sharing the circuit breakers and outcome counts with `client`.
+`TokenBucket` paces the offline bulk jobs (geocoding, the travel-time grid).
+'''
+
+
+CONNECT_TIMEOUT = float(os.getenv("HTTP_CONNECT_TIMEOUT", "3.05"))
+READ_TIMEOUT = float(os.getenv("HTTP_READ_TIMEOUT", "10"))
+MAX_RETRIES = int(os.getenv("HTTP_RETRIES", "2"))
+BACKOFF_BASE = float(os.getenv("HTTP_BACKOFF_BASE", "0.2"))
+BACKOFF_MAX = float(os.getenv("HTTP_BACKOFF_MAX", "2"))
+RETRY_AFTER_MAX = float(os.getenv("HTTP_RETRY_AFTER_MAX", "10"))
+MAX_PER_HOST = int(os.getenv("HTTP_MAX_PER_HOST", "16"))
+BREAKER_THRESHOLD = int(os.getenv("HTTP_BREAKER_THRESHOLD", "5"))
+BREAKER_COOLDOWN = float(os.getenv("HTTP_BREAKER_COOLDOWN", "30"))
+
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+external_request_duration = Histogram(
+    'external_request_duration_seconds', 'Latency of each outbound request attempt', ['host'])
+
+
+class CircuitOpenError(RuntimeError):
+    """Raised instead of calling a host whose circuit breaker is open"""
+
+
+class HostBusyError(RuntimeError):
+    """Raised when a host's concurrency cap stays full for the whole timeout"""
+
+
+class CircuitBreaker:
+    """
+    Opens after `threshold` consecutive failures and rejects calls for
+    `cooldown` seconds. After that one trial call is let through: success
+    closes the breaker, failure opens it again.
+    """
+
+    def __init__(self, threshold=BREAKER_THRESHOLD, cooldown=BREAKER_COOLDOWN):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.opened_at = None
+        self.trial_running = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return 'closed'
+        if time.monotonic() - self.opened_at < self.cooldown:
+            return 'open'
+        return 'half-open'
+
+    def allow(self):
+        with self._lock:
+            state = self.state
+            if state == 'closed':
+                return True
+            if state == 'half-open' and not self.trial_running:
+                self.trial_running = True
+                return True
+            return False
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+            self.trial_running = False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.trial_running or self.failures >= self.threshold:
+                self.opened_at = time.monotonic()
+            self.trial_running = False
+
+    def abandon(self):
+        """The call was cancelled before an outcome; let another trial through"""
+        with self._lock:
+            self.trial_running = False
+
+
+def parse_retry_after(value):
+    """Seconds from a Retry-After header (delay-seconds or an HTTP date), or None"""
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        when = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if when.tzinfo is None:
+        when = when.replace(tzinfo=timezone.utc)
+    return max(0.0, (when - datetime.now(timezone.utc)).total_seconds())
+
+
+def retry_delay(response, attempt):
+    """
+    Seconds to wait before retrying: what the response's Retry-After asks
+    for, else exponential backoff with full jitter. None if Retry-After asks
+    for more than RETRY_AFTER_MAX, so the caller gets the response instead.
+    """
+    retry_after = parse_retry_after(response.headers.get('Retry-After')) if response is not None else None
+    if retry_after is None:
+        return random.uniform(0, min(BACKOFF_MAX, BACKOFF_BASE * 2 ** attempt))
+    return retry_after if retry_after <= RETRY_AFTER_MAX else None
+
+
+class TokenBucket:
+    """Blocking token bucket: at most `rate` requests per second, bursts of `burst`"""
+
+    def __init__(self, rate, burst=None):
+        self.rate = float(rate)
+        self.capacity = float(burst if burst is not None else max(1.0, self.rate))
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """Wait until a request may be made"""
+        if self.rate <= 0:
+            return
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
+
+
+class HttpClient:
+    def __init__(self, pool_size=MAX_PER_HOST, max_per_host=MAX_PER_HOST):
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=8, pool_maxsize=pool_size)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        self.max_per_host = max_per_host
+        self.outcomes = Counter()   # (host, outcome) -> count
+        self._breakers = {}
+        self._slots = {}
+        self._lock = threading.Lock()
+
+    def _host_state(self, host):
+        with self._lock:
+            if host not in self._breakers:
+                self._breakers[host] = CircuitBreaker()
+                self._slots[host] = threading.BoundedSemaphore(self.max_per_host)
+            return self._breakers[host], self._slots[host]
+
+    def _count(self, host, outcome):
+        with self._lock:
+            self.outcomes[(host, outcome)] += 1
+
+    def get(self, url, params=None, timeout=None, retries=None, **kwargs):
+        """
+        GET with pooling, timeouts, retries, a per-host cap and a circuit
+        breaker. `timeout` is a read timeout or a (connect, read) tuple.
+        Returns the final response; raises the last error if every attempt
+        failed to get one.
+        """
+        host = urlparse(url).netloc
+        breaker, slots = self._host_state(host)
+        if timeout is None:
+            timeout = (CONNECT_TIMEOUT, READ_TIMEOUT)
+        elif not isinstance(timeout, tuple):
+            timeout = (min(CONNECT_TIMEOUT, timeout), timeout)
+        if retries is None:
+            retries = MAX_RETRIES
+
+        for attempt in range(retries + 1):
+            if not slots.acquire(timeout=timeout[1]):
+                self._count(host, 'busy')
+                raise HostBusyError(f"too many concurrent requests to {host}")
+            try:
+                if not breaker.allow():
+                    self._count(host, 'rejected')
+                    raise CircuitOpenError(f"{host} is failing, not calling it for now")
+                started = time.perf_counter()
+                try:
+                    response = self.session.get(url, params=params, timeout=timeout, **kwargs)
+                    error = None
+                except (requests.ConnectionError, requests.Timeout) as e:
+                    response = None
+                    error = e
+                except Exception:
+                    # Still an outcome, or a half-open breaker would wait for its trial forever
+                    breaker.record_failure()
+                    self._count(host, 'error')
+                    raise
+                except BaseException:
+                    # Interrupted (e.g. a worker timeout): no outcome, but free the trial slot
+                    breaker.abandon()
+                    raise
+                finally:
+                    external_request_duration.observe(time.perf_counter() - started, host=host)
+            finally:
+                slots.release()
+
+            if error is None and response.status_code not in RETRY_STATUSES:
+                breaker.record_success()
+                self._count(host, 'ok' if response.ok else 'client_error')
+                return response
+
+            breaker.record_failure()
+            self._count(host, 'timeout' if isinstance(error, requests.Timeout)
+                        else 'connection_error' if error is not None else f'http_{response.status_code}')
+
+            if attempt == retries:
+                if error is not None:
+                    raise error
+                return response
+
+            delay = retry_delay(response, attempt)
+            if delay is None:
+                return response
+            time.sleep(delay)
+
+    def stats(self):
+        with self._lock:
+            outcomes = dict(self.outcomes)
+            breakers = dict(self._breakers)
+        return {
+            'outcomes': {f'{host} {outcome}': n for (host, outcome), n in outcomes.items()},
+            'breakers': {host: breaker.state for host, breaker in breakers.items()},
+        }
+
+
+class AsyncHttpClient:
+    """
+    asyncio counterpart of HttpClient. Uses one httpx.AsyncClient and one set
+    of per-host semaphores per event loop (both are bound to the loop they
+    were first used on), and the same per-host circuit breakers and outcome
+    counts as `shared`
+    """
+
+    def __init__(self, shared, max_per_host=MAX_PER_HOST):
+        self.shared = shared
+        self.max_per_host = max_per_host
+        self._loops = weakref.WeakKeyDictionary()   # event loop -> (httpx client, {host: semaphore})
+
+    def _loop_state(self):
+        loop = asyncio.get_running_loop()
+        state = self._loops.get(loop)
+        if state is None:
+            # httpx is only needed when serving through ASGI
+            import httpx
+
+            client = httpx.AsyncClient(
+                limits=httpx.Limits(max_keepalive_connections=8, max_connections=None),
+            )
+            state = self._loops[loop] = (client, {})
+        return state
+
+    def _http(self):
+        return self._loop_state()[0]
+
+    def _host_slots(self, host):
+        slots = self._loop_state()[1]
+        if host not in slots:
+            slots[host] = asyncio.Semaphore(self.max_per_host)
+        return slots[host]
+
+    async def get(self, url, params=None, timeout=None, retries=None, **kwargs):
+        """Same contract as HttpClient.get; returns an httpx.Response"""
+        import httpx
+
+        http = self._http()
+        host = urlparse(url).netloc
+        breaker, _ = self.shared._host_state(host)
+        slots = self._host_slots(host)
+        if timeout is None:
+            timeout = (CONNECT_TIMEOUT, READ_TIMEOUT)
+        elif not isinstance(timeout, tuple):
+            timeout = (min(CONNECT_TIMEOUT, timeout), timeout)
+        if retries is None:
+            retries = MAX_RETRIES
+
+        for attempt in range(retries + 1):
+            try:
+                await asyncio.wait_for(slots.acquire(), timeout[1])
+            except asyncio.TimeoutError:
+                self.shared._count(host, 'busy')
+                raise HostBusyError(f"too many concurrent requests to {host}")
+            try:
+                if not breaker.allow():
+                    self.shared._count(host, 'rejected')
+                    raise CircuitOpenError(f"{host} is failing, not calling it for now")
+                started = time.perf_counter()
+                try:
+                    response = await http.get(
+                        url, params=params,
+                        timeout=httpx.Timeout(timeout[1], connect=timeout[0]), **kwargs
+                    )
+                    error = None
+                except httpx.TransportError as e:
+                    response = None
+                    error = e
+                except Exception:
+                    # Still an outcome, or a half-open breaker would wait for its trial forever
+                    breaker.record_failure()
+                    self.shared._count(host, 'error')
+                    raise
+                except BaseException:
+                    # Cancelled: no outcome, but free the trial slot
+                    breaker.abandon()
+                    raise
+                finally:
+                    external_request_duration.observe(time.perf_counter() - started, host=host)
+            finally:
+                slots.release()
+
+            if error is None and response.status_code not in RETRY_STATUSES:
+                breaker.record_success()
+                self.shared._count(host, 'ok' if response.is_success else 'client_error')
+                return response
+
+            breaker.record_failure()
+            self.shared._count(host, 'timeout' if isinstance(error, httpx.TimeoutException)
+                               else 'connection_error' if error is not None else f'http_{response.status_code}')
+
+            if attempt == retries:
+                if error is not None:
+                    raise error
+                return response
+
+            delay = retry_delay(response, attempt)
+            if delay is None:
+                return response
+            await asyncio.sleep(delay)
+
+    async def aclose(self):
+        """Close the running loop's client"""
+        state = self._loops.pop(asyncio.get_running_loop(), None)
+        if state is not None:
+            await state[0].aclose()
+
+
+client = HttpClient()
+async_client = AsyncHttpClient(client)
+
+
+@register_collector
+def collect_http_client():
+    with client._lock:
+        outcomes = dict(client.outcomes)
+        breakers = dict(client._breakers)
+    return [
+        ('external_requests_total', 'counter', 'Outbound request outcomes by host',
+         [({'host': host, 'outcome': outcome}, n) for (host, outcome), n in sorted(outcomes.items())]),
+        ('circuit_breaker_open', 'gauge', '1 while a host\'s circuit breaker is rejecting calls',
+         [({'host': host}, int(breaker.state == 'open')) for host, breaker in sorted(breakers.items())]),
+    ]
+
+
+def get(url, params=None, **kwargs):
+    """Drop-in replacement for `requests.get` using the shared client"""
+    return client.get(url, params=params, **kwargs)
@@ -0,0 +1,180 @@
+import contextvars
+import math
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+
+
+'''
+In-process metrics in the Prometheus text format
+
+- `span(stage)` times a block of the request path into the
+  `stage_duration_seconds` histogram and the current request's timings
+  (sent back as a `Server-Timing` header when SERVER_TIMING=1)
+- `Counter` and `Histogram` for values updated as they happen
+- `register_collector(fn)` for values read at scrape time, such as the cache
+  hit/miss counts the caches already keep
+
+`render()` produces the text served at /metrics.
+'''
+
+
+SERVER_TIMING = os.getenv("SERVER_TIMING", "0") == "1"
+
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+_metrics = []
+_collectors = []
+
+# Stage timings of the request being handled: list of (stage, seconds)
+_request_timings = contextvars.ContextVar('request_timings', default=None)
+
+
+def _label_text(labelnames, values):
+    if not labelnames:
+        return ''
+    pairs = []
+    for name, value in zip(labelnames, values):
+        value = str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        pairs.append(f'{name}="{value}"')
+    return '{' + ','.join(pairs) + '}'
+
+
+def _format_value(value):
+    if math.isinf(value):
+        return '+Inf' if value > 0 else '-Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+        _metrics.append(self)
+
+    def inc(self, amount=1, **labels):
+        key = tuple(labels[name] for name in self.labelnames)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def render(self):
+        with self._lock:
+            values = dict(self._values)
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} counter"]
+        for key, value in sorted(values.items()):
+            lines.append(f"{self.name}{_label_text(self.labelnames, key)} {_format_value(value)}")
+        return lines
+
+
+class Histogram:
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(buckets))
+        self._values = {}   # labels -> [bucket counts..., sum, count]
+        self._lock = threading.Lock()
+        _metrics.append(self)
+
+    def observe(self, value, **labels):
+        key = tuple(labels[name] for name in self.labelnames)
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None:
+                entry = self._values[key] = [0] * len(self.buckets) + [0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    entry[i] += 1
+            entry[-2] += value
+            entry[-1] += 1
+
+    def render(self):
+        with self._lock:
+            values = {key: list(entry) for key, entry in self._values.items()}
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        for key, entry in sorted(values.items()):
+            for bound, count in zip(self.buckets + (math.inf,), entry[:len(self.buckets)] + [entry[-1]]):
+                labels = _label_text(self.labelnames + ('le',), key + (_format_value(float(bound)),))
+                lines.append(f"{self.name}_bucket{labels} {count}")
+            labels = _label_text(self.labelnames, key)
+            lines.append(f"{self.name}_sum{labels} {_format_value(entry[-2])}")
+            lines.append(f"{self.name}_count{labels} {entry[-1]}")
+        return lines
+
+
+stage_duration = Histogram(
+    'stage_duration_seconds', 'Time spent in each stage of the request path', ['stage'])
+request_duration = Histogram(
+    'http_request_duration_seconds', 'Time to handle a request, by endpoint', ['endpoint', 'method', 'status'])
+
+
+def register_collector(collect):
+    """
+    `collect()` is called on every scrape and returns (name, type,
+    documentation, [(labels dict, value), ...]) tuples
+    """
+    _collectors.append(collect)
+    return collect
+
+
+def start_request():
+    """Begin collecting stage timings for the current request"""
+    return _request_timings.set([])
+
+
+def end_request(token):
+    """Stop collecting and return the request's (stage, seconds) timings"""
+    timings = _request_timings.get() or []
+    _request_timings.reset(token)
+    return timings
+
+
+def record_stage(stage, seconds):
+    stage_duration.observe(seconds, stage=stage)
+    timings = _request_timings.get()
+    if timings is not None:
+        timings.append((stage, seconds))
+
+
+@contextmanager
+def span(stage):
+    """Time the enclosed block as one stage of the request path"""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_stage(stage, time.perf_counter() - start)
+
+
+def server_timing_header(timings):
+    """Server-Timing value for (stage, seconds) timings; repeated stages are summed"""
+    totals = {}
+    for stage, seconds in timings:
+        totals[stage] = totals.get(stage, 0.0) + seconds
+    return ', '.join(
+        f"{stage.replace(' ', '_').replace(':', '_')};dur={seconds * 1000:.1f}" for stage, seconds in totals.items()
+    )
+
+
+def render():
+    """All metrics in the Prometheus text exposition format"""
+    lines = []
+    for metric in list(_metrics):
+        lines.extend(metric.render())
+    for collect in list(_collectors):
+        try:
+            families = collect()
+        except Exception as e:
+            print(f"Metrics collector {collect.__name__} failed: {e}")
+            continue
+        for name, metric_type, documentation, samples in families:
+            lines.append(f"# HELP {name} {documentation}")
+            lines.append(f"# TYPE {name} {metric_type}")
+            for labels, value in samples:
+                lines.append(f"{name}{_label_text(tuple(labels), tuple(labels.values()))} {_format_value(value)}")
+    return '\n'.join(lines) + '\n'
@@ -0,0 +1,51 @@
+import copy
+import os
+import secrets
+
+from cache import make_cache
+
+
+
+'''
+Server-side store for search results
+
+Searches save their ranked hospital/vet list here under a short random id and
+only that id goes into the Flask session cookie. Entries expire after a TTL.
+The sqlite backend shares results between worker processes on one machine.
+'''
+
+
+class ResultStore:
+    def __init__(self, cache, ttl):
+        self.cache = cache
+        self.ttl = ttl
+
+    def create(self, result):
+        """Save a new result and return its id"""
+        result_id = secrets.token_urlsafe(12)
+        self.update(result_id, result)
+        return result_id
+
+    def get(self, result_id):
+        """The stored result, or None if it expired or never existed"""
+        if not result_id:
+            return None
+        result = self.cache.get(self._key(result_id))
+        # Callers may modify what they get back, so never hand out the cached object
+        return copy.deepcopy(result)
+
+    def update(self, result_id, result):
+        self.cache.set(self._key(result_id), copy.deepcopy(result), self.ttl)
+
+    def stats(self):
+        return self.cache.stats()
+
+    @staticmethod
+    def _key(result_id):
+        return f"result:{result_id}"
+
+
+def make_result_store(backend='memory', ttl=2 * 60 * 60, maxsize=10000, path=None):
+    if backend == 'sqlite' and path is None:
+        path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'results.db')
+    return ResultStore(make_cache(backend, maxsize=maxsize, path=path), ttl)
@@ -0,0 +1,221 @@
+import asyncio
+import json
+import os
+import threading
+import time
+import uuid
+
+from cache import ThreadLocalConnection
+from metrics import Counter
+
+
+
+'''
+Single-flight coalescing of identical upstream calls
+
+During a surge many requests need the same upstream result at once: the same
+NHS results page for an area, the same route from an origin cell, the same
+address geocoded. `flight.do(key, fn, *args)` makes the first caller for a
+key the leader, which calls `fn`; callers that arrive while it is in flight
+wait for that call and share its result (or its exception) instead of
+making their own. Nothing is kept once the call returns; caching stays with
+the caches.
+
+- SingleFlight coalesces threads in one process, and `do_async` coalesces
+  coroutines on the event loop
+- SQLiteSingleFlight also coalesces across worker processes on one machine:
+  the leader claims the key in a SQLite table and publishes the result
+  there (as JSON) for the other processes' leaders to pick up
+
+A waiter that hears nothing for `timeout` seconds makes the call itself, so
+a stuck or crashed leader only delays the others.
+'''
+
+
+SINGLEFLIGHT_BACKEND = os.getenv("SINGLEFLIGHT_BACKEND", "memory")
+SINGLEFLIGHT_PATH = os.getenv(
+    "SINGLEFLIGHT_PATH", os.path.join(os.path.dirname(os.path.abspath(__file__)), 'singleflight.db'))
+SINGLEFLIGHT_TIMEOUT = float(os.getenv("SINGLEFLIGHT_TIMEOUT", "15"))
+
+singleflight_calls = Counter(
+    'singleflight_calls_total',
+    'Calls through single-flight groups: leader (made the upstream call), shared (waited for another '
+    'caller\'s result) or fallback (gave up waiting and made the call)',
+    ['group', 'role'])
+
+
+class _Call:
+    def __init__(self):
+        self.done = threading.Event()
+        self.value = None
+        self.error = None
+
+
+class SingleFlight:
+    def __init__(self, group, timeout=SINGLEFLIGHT_TIMEOUT):
+        self.group = group
+        self.timeout = timeout
+        self._calls = {}
+        self._tasks = {}
+        self._lock = threading.Lock()
+
+    def do(self, key, fn, *args):
+        """fn(*args), shared with every concurrent caller using the same key"""
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+
+        if not leader:
+            if not call.done.wait(self.timeout):
+                singleflight_calls.inc(group=self.group, role='fallback')
+                return fn(*args)
+            singleflight_calls.inc(group=self.group, role='shared')
+            if call.error is not None:
+                raise call.error
+            return call.value
+
+        try:
+            call.value = self._lead(key, fn, *args)
+            return call.value
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                self._calls.pop(key, None)
+            call.done.set()
+
+    def _lead(self, key, fn, *args):
+        singleflight_calls.inc(group=self.group, role='leader')
+        return fn(*args)
+
+    async def do_async(self, key, fn_async, *args):
+        """
+        `do` for coroutines on one event loop. The upstream call runs as its
+        own task, so a caller that is cancelled or times out doesn't cancel it
+        for the others.
+        """
+        task = self._tasks.get(key)
+        if task is None:
+            singleflight_calls.inc(group=self.group, role='leader')
+            task = self._tasks[key] = asyncio.ensure_future(fn_async(*args))
+            task.add_done_callback(lambda t: self._finish_task(key, t))
+        else:
+            singleflight_calls.inc(group=self.group, role='shared')
+        return await asyncio.shield(task)
+
+    def _finish_task(self, key, task):
+        if self._tasks.get(key) is task:
+            del self._tasks[key]
+        # Mark the exception retrieved; every waiter already got it
+        if not task.cancelled():
+            task.exception()
+
+    def stats(self):
+        with self._lock:
+            return {'backend': 'memory', 'in_flight': len(self._calls) + len(self._tasks)}
+
+
+class SQLiteSingleFlight(SingleFlight):
+    """SingleFlight whose leaders also coalesce with other processes through a SQLite file"""
+
+    POLL_INTERVAL = 0.02
+    PRUNE_EVERY = 100
+
+    def __init__(self, group, path=SINGLEFLIGHT_PATH, timeout=SINGLEFLIGHT_TIMEOUT):
+        super().__init__(group, timeout)
+        self.path = path
+        self._connection = ThreadLocalConnection(path, synchronous='NORMAL')
+        self._leads = 0
+        self._connection().execute(
+            "CREATE TABLE IF NOT EXISTS flights ("
+            " key TEXT PRIMARY KEY, owner TEXT NOT NULL, started_at REAL NOT NULL,"
+            " finished_at REAL, value TEXT, error TEXT)"
+        )
+
+    def _claim(self, conn, key, owner):
+        """Become the key's leader unless another live call holds it"""
+        now = time.time()
+        return conn.execute(
+            "INSERT INTO flights (key, owner, started_at) VALUES (?, ?, ?)"
+            " ON CONFLICT(key) DO UPDATE SET owner = excluded.owner, started_at = excluded.started_at,"
+            " finished_at = NULL, value = NULL, error = NULL"
+            " WHERE flights.finished_at IS NOT NULL OR flights.started_at < ?",
+            (key, owner, now, now - self.timeout)
+        ).rowcount == 1
+
+    def _lead(self, key, fn, *args):
+        conn = self._connection()
+        key = f"{self.group}:{key}"
+        owner = uuid.uuid4().hex
+        deadline = time.monotonic() + self.timeout
+
+        waiting_for = None
+        while True:
+            # Once the call we are waiting for has finished, take its result
+            row = conn.execute(
+                "SELECT owner, finished_at, value, error FROM flights WHERE key = ?", (key,)
+            ).fetchone()
+            if row is not None and row[0] == waiting_for and row[1] is not None:
+                if row[3] is not None:
+                    singleflight_calls.inc(group=self.group, role='shared')
+                    raise RuntimeError(row[3])
+                if row[2] is not None:
+                    singleflight_calls.inc(group=self.group, role='shared')
+                    return json.loads(row[2])
+
+            if self._claim(conn, key, owner):
+                break
+            row = conn.execute("SELECT owner FROM flights WHERE key = ?", (key,)).fetchone()
+            waiting_for = row[0] if row is not None else None
+
+            if time.monotonic() >= deadline:
+                singleflight_calls.inc(group=self.group, role='fallback')
+                return fn(*args)
+            time.sleep(self.POLL_INTERVAL)
+
+        singleflight_calls.inc(group=self.group, role='leader')
+        value = error = None
+        try:
+            result = fn(*args)
+        except Exception as e:
+            error = str(e) or type(e).__name__
+            raise
+        else:
+            try:
+                value = json.dumps(result)
+            except (TypeError, ValueError):
+                # Not shareable; the others make their own call
+                pass
+            return result
+        finally:
+            conn.execute(
+                "UPDATE flights SET finished_at = ?, value = ?, error = ? WHERE key = ? AND owner = ?",
+                (time.time(), value, error, key, owner)
+            )
+            self._prune(conn)
+
+    def _prune(self, conn):
+        # Finished rows are only read by waiters polling right now
+        with self._lock:
+            self._leads += 1
+            prune = self._leads % self.PRUNE_EVERY == 0
+        if prune:
+            conn.execute("DELETE FROM flights WHERE finished_at < ?", (time.time() - 60,))
+
+    def stats(self):
+        stats = super().stats()
+        stats.update(backend='sqlite', path=self.path)
+        return stats
+
+
+def make_singleflight(group, backend=None, path=None, timeout=SINGLEFLIGHT_TIMEOUT):
+    """Build a single-flight group from config, e.g. make_singleflight('nhs', 'sqlite')"""
+    backend = backend or SINGLEFLIGHT_BACKEND
+    if backend == 'sqlite':
+        return SQLiteSingleFlight(group, path or SINGLEFLIGHT_PATH, timeout)
+    if backend == 'memory':
+        return SingleFlight(group, timeout)
+    raise ValueError(f"Unknown single-flight backend: {backend}")
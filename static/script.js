@@ -24,17 +24,8 @@ function findHospital() {
         getCurrentLocation();
     
     locationPromise
-        .then(location => {
-            return fetch('/api/find-hospital', {
-                method: 'POST',
-                headers: {
-                    'Content-Type': 'application/json'
-                },
-                body: JSON.stringify(location)
-            });
-        })
-        .then(response => response.json())
-        .then(data => {
+        .then(location => streamSearch('/api/find-hospital/stream', location, 'hospitals'))
+        .then(() => {
             window.location.href = '/map';
         })
         .catch(error => {
@@ -43,6 +34,77 @@ function findHospital() {
         });
 }
 
+// Run a streaming search: the server sends one JSON line per ranking, starting
+// with estimated travel times and refining as real ones arrive. The current
+// best option is shown on the loading screen; resolves once the final ranking
+// is stored.
+function streamSearch(url, location, key) {
+    return fetch(url, {
+        method: 'POST',
+        headers: {
+            'Content-Type': 'application/json'
+        },
+        body: JSON.stringify(location)
+    }).then(response => {
+        if (!response.ok) {
+            throw new Error(`Search failed (${response.status})`);
+        }
+        if (!response.body) {
+            // No streaming support: the ranking is stored once the body is complete
+            return response.text();
+        }
+
+        const reader = response.body.getReader();
+        const decoder = new TextDecoder();
+        let buffer = '';
+
+        function handleLine(line) {
+            if (!line.trim()) {
+                return false;
+            }
+            const event = JSON.parse(line);
+            if (event.type === 'error') {
+                throw new Error(event.message);
+            }
+            showBestSoFar(event[key] && event[key][0]);
+            return event.type === 'done';
+        }
+
+        function read() {
+            return reader.read().then(({ done, value }) => {
+                buffer += decoder.decode(value || new Uint8Array(), { stream: !done });
+                const lines = buffer.split('\n');
+                buffer = lines.pop();
+                for (const line of lines) {
+                    if (handleLine(line)) {
+                        return;
+                    }
+                }
+                if (done) {
+                    handleLine(buffer);
+                    return;
+                }
+                return read();
+            });
+        }
+
+        return read();
+    });
+}
+
+function showBestSoFar(best) {
+    const loadingText = document.querySelector('#loadingScreen .loading-text');
+    if (!loadingText || !best) {
+        return;
+    }
+    let text = `Best option so far: ${best.hospital}`;
+    if (best.duration !== null && best.duration !== undefined) {
+        const minutes = Math.max(1, Math.round(best.duration / 60));
+        text += best.duration_estimated ? ` (about ${minutes} min away)` : ` (${minutes} min away)`;
+    }
+    loadingText.textContent = text;
+}
+
 function toggleCustomAddress() {
     const section = document.getElementById('customAddressSection');
     if (section.style.display === 'none') {
@@ -81,17 +143,8 @@ function findVet() {
         getCurrentLocation();
     
     locationPromise
-        .then(location => {
-            return fetch('/api/find-vet', {
-                method: 'POST',
-                headers: {
-                    'Content-Type': 'application/json'
-                },
-                body: JSON.stringify(location)
-            });
-        })
-        .then(response => response.json())
-        .then(data => {
+        .then(location => streamSearch('/api/find-vet/stream', location, 'vets'))
+        .then(() => {
             window.location.href = '/map';
         })
         .catch(error => {
@@ -372,13 +425,10 @@ function plotAlternativeLocations() {
         .then(response => response.json())
         .then(data => {
             if (data.status === 'success' && data.hospitals && data.hospitals.length > 0) {
-                // For each alternative hospital, geocode and add a marker
+                // For each alternative hospital, add a marker (geocoding only if the server sent no coordinates)
                 data.hospitals.forEach((hospital, index) => {
-                    // Geocode the hospital address
-                    const geocoder = new google.maps.Geocoder();
-                    geocoder.geocode({ address: hospital.address }, (results, status) => {
-                        if (status === 'OK' && results[0]) {
-                            const position = results[0].geometry.location;
+                    withHospitalPosition(hospital, (position) => {
+                        if (position) {
                             
                             // Create a marker for this alternative location
                             const marker = new google.maps.Marker({
@@ -465,6 +515,18 @@ function plotAlternativeLocations() {
         });
 }
 
+function withHospitalPosition(hospital, callback) {
+    if (hospital.lat !== undefined && hospital.lng !== undefined) {
+        callback({ lat: hospital.lat, lng: hospital.lng });
+        return;
+    }
+
+    const geocoder = new google.maps.Geocoder();
+    geocoder.geocode({ address: hospital.address }, (results, status) => {
+        callback(status === 'OK' && results[0] ? results[0].geometry.location : null);
+    });
+}
+
 function updateCurrentHospitalBanner(data) {
     const banner = document.getElementById('currentHospitalBanner');
     if (!banner) return;